@@ -7,9 +7,31 @@ for simulated annealing optimization.
 '''
 
 
+import bisect
+
+import numpy as np
 import psycopg2
 
 
+# Patent -> CPC code lookups keyed by SQL table name. Filled by 
+# load_cpc_index so that repeated predictions do not have to go back to
+# SQL for the codes of every training patent.
+CPC_INDEX = {}
+
+# Main group -> (sorted subgroups, levels, range-minimum table) built 
+# from the levels table by load_level_hierarchy.
+LEVEL_HIERARCHY = {}
+
+# Stands in for level 0 (the main group itself) in range-minimum tables.
+NO_LEVEL = 100
+
+# Aggregated scores are rounded to this many decimals before ranking, so
+# that training patents whose scores differ only by floating point 
+# rounding tie whatever order their pair scores were summed in (as by
+# cpc_features).
+SCORE_DECIMALS = 10
+
+
 def get_cpc (pat_num, cur, table='cpcs'):
     '''
     INPUT: INT pat_num, PSYCOPG2 CURSOR cur, optional STRING table
@@ -25,6 +47,43 @@ def get_cpc (pat_num, cur, table='cpcs'):
     return cpc_list
 
 
+def load_cpc_index (cur, table='exp_cpcs'):
+    '''
+    INPUT: PSYCOPG2 CURSOR cur, optional STRING table
+    OUTPUT: DICT OF INT -> TUPLE OF STRINGS cpc_index
+    
+    Reads every row of the given CPC table in a single query and groups
+    the codes by patent number. The resulting index is stored in 
+    CPC_INDEX so later calls can reuse it; calling this function again
+    refreshes the stored copy (e.g. after exp_cpcs has been rebuilt).
+    '''
+    query = 'SELECT pat_num, cpc FROM %s;' % (table,)
+    cur.execute(query)
+    
+    grouped = {}
+    for (pat_num, cpc) in cur.fetchall():
+        grouped.setdefault(pat_num, []).append(cpc)
+    cpc_index = dict((pat_num, tuple(cpcs)) for (pat_num, cpcs) in 
+                     grouped.items())
+    
+    CPC_INDEX[table] = cpc_index
+    return cpc_index
+
+
+def get_cpc_index (cur, table='exp_cpcs', refresh=False):
+    '''
+    INPUT: PSYCOPG2 CURSOR cur, optional STRING table, 
+        optional BOOLEAN refresh
+    OUTPUT: DICT OF INT -> TUPLE OF STRINGS cpc_index
+    
+    Returns the stored CPC index for table, loading it from SQL the 
+    first time it is needed or whenever refresh is set to True.
+    '''
+    if refresh or table not in CPC_INDEX:
+        return load_cpc_index(cur, table)
+    return CPC_INDEX[table]
+
+
 def score_first_half (cpc_half_1, cpc_half_2, params):
     '''
     INPUT: STRING cpc_half_1, STRING cpc_half_2, LIST OF FLOATS params
@@ -52,19 +111,20 @@ def score_first_half (cpc_half_1, cpc_half_2, params):
     return score
     
 
-def compute_group_score (level_slice, params):
+def compute_group_score_from_levels (first_level, last_level, inner_level, 
+                                    params):
     '''
-    INPUT: LIST OF (STRING, INT) TUPLES level_slice, 
+    INPUT: INT first_level, INT last_level, INT inner_level, 
         LIST OF FLOATS params
     OUTPUT: FLOAT score
     
-    CPC code groups are arranged in a hierarchical fashion, with levels
-    ranging from 0-12 depending on how coarse (small numbers) or fine
-    (large numbers) the group is. This function gives a score depending
-    on how close the two CPC groups are in this hierarchy (i.e. do their
-    groups share parents).
+    Scores a pair of CPC groups given the levels of the two groups and 
+    the smallest nonzero level of any group listed between them 
+    (inner_level, None if there is no such group). Groups share parents 
+    down to the coarsest level found between them, so this is all the
+    information compute_group_score needs from the hierarchy.
     '''
-    cpc_level = sorted([level_slice[0][1],level_slice[-1][1]])
+    cpc_level = sorted([first_level, last_level])
     
     params = [0] + params
     
@@ -75,17 +135,133 @@ def compute_group_score (level_slice, params):
         return params[1]
     
     elif cpc_level[0] == cpc_level[1]:
-        for ii in range(1, cpc_level[0]):
-            if ii in [code[1] for code in level_slice[1:-1]]:
-                return sum(params[0:ii])
+        if inner_level is not None and inner_level < cpc_level[0]:
+            return sum(params[0:inner_level])
         return sum(params[0:cpc_level[0]])
     
-    else:        
-        for ii in range(1, cpc_level[0] + 1):
-            if ii in [code[1] for code in level_slice[1:-1]]:
-                return sum(params[0:ii])
+    else:
+        if inner_level is not None and inner_level <= cpc_level[0]:
+            return sum(params[0:inner_level])
         return sum(params[0:cpc_level[0] + 1])
-        
+
+
+def compute_group_score (level_slice, params):
+    '''
+    INPUT: LIST OF (STRING, INT) TUPLES level_slice, 
+        LIST OF FLOATS params
+    OUTPUT: FLOAT score
+    
+    CPC code groups are arranged in a hierarchical fashion, with levels
+    ranging from 0-12 depending on how coarse (small numbers) or fine
+    (large numbers) the group is. This function gives a score depending
+    on how close the two CPC groups are in this hierarchy (i.e. do their
+    groups share parents).
+    '''
+    inner_levels = [code[1] for code in level_slice[1:-1] if code[1] > 0]
+    inner_level = min(inner_levels) if inner_levels else None
+    
+    return compute_group_score_from_levels(level_slice[0][1], 
+                                           level_slice[-1][1], inner_level, 
+                                           params)
+
+
+def build_min_table (levels):
+    '''
+    INPUT: LIST OF INTS levels
+    OUTPUT: LIST OF LISTS OF INTS min_table
+    
+    Builds a sparse table for range-minimum queries over the nonzero 
+    levels of one CPC main group. Row k holds the minimum of each run 
+    of 2**k consecutive levels, with zeros (the main group itself) 
+    replaced by NO_LEVEL so that they are never reported as a shared 
+    parent.
+    '''
+    min_table = [[level if level > 0 else NO_LEVEL for level in levels]]
+    
+    width = 1
+    while 2 * width <= len(levels):
+        prev = min_table[-1]
+        min_table.append([min(prev[ii], prev[ii + width]) for ii in 
+                          range(len(levels) - 2 * width + 1)])
+        width *= 2
+    
+    return min_table
+    
+
+def range_min_level (min_table, first, last):
+    '''
+    INPUT: LIST OF LISTS OF INTS min_table, INT first, INT last
+    OUTPUT: INT inner_level
+    
+    Returns the smallest nonzero level between positions first and last 
+    (inclusive) of a main group, or None if the range is empty or holds
+    only zeros.
+    '''
+    if first > last:
+        return None
+    
+    k = (last - first + 1).bit_length() - 1
+    level = min(min_table[k][first], min_table[k][last - (1 << k) + 1])
+    
+    return None if level == NO_LEVEL else level
+
+
+def load_level_hierarchy (cur):
+    '''
+    INPUT: PSYCOPG2 CURSOR cur
+    OUTPUT: DICT OF STRING -> (LIST OF STRINGS, LIST OF INTS, 
+        LIST OF LISTS OF INTS) TUPLES hierarchy
+    
+    Reads the whole levels table once and splits it by main group (the 
+    part of the CPC before the "/"). Each main group maps to its sorted 
+    subgroups, the level of each subgroup and a range-minimum table over
+    those levels (see build_min_table). The hierarchy is stored in 
+    LEVEL_HIERARCHY for reuse; call again to refresh it.
+    '''
+    cur.execute('SELECT * FROM levels;')
+    
+    grouped = {}
+    for (id, cpc, level) in cur.fetchall():
+        (main_group, subgroup) = cpc.split('/')
+        grouped.setdefault(main_group, []).append((subgroup, level))
+    
+    hierarchy = {}
+    for (main_group, codes) in grouped.items():
+        codes.sort(key=lambda x: x[0])
+        subgroups = [subgroup for (subgroup, level) in codes]
+        levels = [level for (subgroup, level) in codes]
+        hierarchy[main_group] = (subgroups, levels, build_min_table(levels))
+    
+    LEVEL_HIERARCHY.clear()
+    LEVEL_HIERARCHY.update(hierarchy)
+    return hierarchy
+
+
+def get_level_hierarchy (cur, refresh=False):
+    '''
+    INPUT: PSYCOPG2 CURSOR cur, optional BOOLEAN refresh
+    OUTPUT: DICT hierarchy
+    
+    Returns the stored CPC level hierarchy, loading it from SQL the 
+    first time it is needed or whenever refresh is set to True.
+    '''
+    if refresh or not LEVEL_HIERARCHY:
+        return load_level_hierarchy(cur)
+    return LEVEL_HIERARCHY
+
+
+def group_slice_bounds (subgroups, cpc_sh_1, cpc_sh_2):
+    '''
+    INPUT: LIST OF STRINGS subgroups, STRING cpc_sh_1, STRING cpc_sh_2
+    OUTPUT: (INT, INT) TUPLE bounds
+    
+    Finds the first and last positions of the sorted subgroups that lie
+    between the two given subgroups (inclusive).
+    '''
+    cpcs = sorted([cpc_sh_1, cpc_sh_2])
+    return (bisect.bisect_left(subgroups, cpcs[0]), 
+            bisect.bisect_right(subgroups, cpcs[1]) - 1)
+
 
 def score_second_half (cpc_fh, cpc_sh_1, cpc_sh_2, params, cur):
     '''
@@ -93,27 +269,30 @@ def score_second_half (cpc_fh, cpc_sh_1, cpc_sh_2, params, cur):
         LIST OF FLOATS params, PSYCOPG2 CURSOR cur
     OUTPUT: FLOAT score
     
-    Called when the first halves of two CPC codes are identical. Pulls
-    from SQL a list of the hierarchy of the CPC group levels and feeds
-    this and the params to compute_group_score.
+    Called when the first halves of two CPC codes are identical. Looks 
+    up the hierarchy of the CPC group levels for the main group (loaded
+    from SQL once, see get_level_hierarchy), finds the slice of groups 
+    between the two codes by bisection and feeds the levels at its ends
+    and the coarsest level inside it to compute_group_score_from_levels.
     '''
-    cpcs = sorted([cpc_sh_1, cpc_sh_2])
+    (subgroups, levels, min_table) = get_level_hierarchy(cur)[cpc_fh]
+    (first, last) = group_slice_bounds(subgroups, cpc_sh_1, cpc_sh_2)
+    if first > last:
+        raise IndexError('no CPC levels between %s/%s and %s/%s' % 
+                         (cpc_fh, cpc_sh_1, cpc_fh, cpc_sh_2))
     
-    query = "SELECT * FROM levels WHERE cpc LIKE '" + cpc_fh + "/%';"
-    cur.execute(query)
-    
-    levels = [(cpc.split('/')[1], level) for (id, cpc, level) in 
-              cur.fetchall()]
-    level_slice = [(cpc, level) for (cpc, level) in levels if 
-                   (cpc >= cpcs[0]) and (cpc <= cpcs[1])]
+    inner_level = range_min_level(min_table, first + 1, last - 1)
     
-    return compute_group_score(level_slice, params)
+    return compute_group_score_from_levels(levels[first], levels[last], 
+                                           inner_level, params)
 
 
-def compute_scores (cpcs_1, pat_2, cur, params, table_2='cpcs'):
+def compute_scores (cpcs_1, pat_2, cur, params, table_2='cpcs', 
+                    cpc_index=None):
     '''
     INPUT: LIST OF STRINGS cpcs_1, INT pat_2, PSYCOPG2 CURSOR cur,
-        LIST OF FLOATS params, optional STRING table_2
+        LIST OF FLOATS params, optional STRING table_2, 
+        optional DICT cpc_index
     OUTPUT: LIST OF FLOATS scores
     
     Given a list of CPC codes for one patent and the number of another
@@ -121,9 +300,14 @@ def compute_scores (cpcs_1, pat_2, cur, params, table_2='cpcs'):
     possible pairings of both sets of CPCs. Takes information about one
     patent in the form of CPCs and the other in the form of a patent
     number to facilitate storage of difficult-to-grab CPCs (those in the
-    largest SQL tables) in higher level functions for repeated use.
+    largest SQL tables) in higher level functions for repeated use. If
+    cpc_index (see load_cpc_index) is given, the CPCs of pat_2 are read
+    from it instead of from table_2.
     '''
-    cpcs_2 = get_cpc(pat_2, cur, table_2)
+    if cpc_index is not None:
+        cpcs_2 = cpc_index.get(pat_2, ())
+    else:
+        cpcs_2 = get_cpc(pat_2, cur, table_2)
     
     scores = []
     for cpc_1 in cpcs_1:
@@ -143,27 +327,70 @@ def compute_scores (cpcs_1, pat_2, cur, params, table_2='cpcs'):
     return scores
 
 
-def predict_expert (test_pat, params, agg_func, table='cpcs', testing=False):
+def round_score (score):
+    '''
+    INPUT: FLOAT score
+    OUTPUT: FLOAT rounded
+    
+    Rounds an aggregated score to SCORE_DECIMALS decimals with np.round,
+    which every scorer uses so that they round alike.
+    '''
+    return float(np.round(score, SCORE_DECIMALS))
+
+
+def rank_experts (agg_scores, cur):
+    '''
+    INPUT: LIST OF (INT, FLOAT) TUPLES agg_scores, PSYCOPG2 CURSOR cur
+    OUTPUT: LIST OF (INT, FLOAT) TUPLES experts
+    
+    Walks the training patents in the order given by agg_scores 
+    (highest score first) and lists each expert associated with them 
+    the first time they appear, paired with the score of that patent.
+    An expert listed for the same patent in several cases is only 
+    counted once.
+    '''
+    experts = []
+    seen = set()
+    for (patent, score) in agg_scores:
+        query = 'SELECT record FROM experts WHERE pat_num = %s;'
+        cur.execute(query, [patent])
+        for expert in cur.fetchall():
+            if expert[0] not in seen:
+                seen.add(expert[0])
+                experts.append((int(expert[0]), score))
+                                        
+    return experts
+
+
+def predict_expert (test_pat, params, agg_func, table='cpcs', testing=False,
+                    cur=None):
     '''
     INPUT: INT pat_num, LIST OF FLOATS params, FUNCTION NAME agg_func,
-        optional STRING table, optional BOOLEAN testing
+        optional STRING table, optional BOOLEAN testing, 
+        optional PSYCOPG2 CURSOR cur
     OUTPUT: LIST OF (INT, FLOAT) TUPLES experts
     
     Compare the patent given by pat_num to each of the patents with an
     associated expert and compute similarity scores based on CPCs for 
-    each. Return a list of experts and their associated scores sorted 
-    from highest to lowest score. In the case where the cost function is
-    being calculated, testing should be set to True so that the test set
-    can be removed from the list of training patents.
+    each. Return a list of experts and their associated scores (rounded,
+    see round_score) sorted from highest to lowest score. In the case 
+    where the cost function is being calculated, testing should be set 
+    to True so that the test set can be removed from the list of 
+    training patents.
+    
+    The CPCs of the training patents come from the in-memory index of
+    exp_cpcs (see get_cpc_index), which is only read from SQL once per 
+    process. A cursor can be passed in as cur to reuse an open 
+    connection; otherwise a new one is opened.
     '''
-    conn = psycopg2.connect(database='patents', user='postgres')
-    cur = conn.cursor()
+    if cur is None:
+        conn = psycopg2.connect(database='patents', user='postgres')
+        cur = conn.cursor()
     
     cpcs_1 = get_cpc(test_pat, cur, table)
     
-    query = 'SELECT pat_num FROM exp_cpcs GROUP BY pat_num;'
-    cur.execute(query)
-    training_patents = [pat[0] for pat in cur.fetchall()]
+    cpc_index = get_cpc_index(cur, 'exp_cpcs')
+    training_patents = sorted(cpc_index)
     
     if testing:
         training_patents.remove(test_pat)
@@ -171,16 +398,9 @@ def predict_expert (test_pat, params, agg_func, table='cpcs', testing=False):
     agg_scores = []
     for pat_num_2 in training_patents:
         scores = compute_scores(cpcs_1, pat_num_2, cur, params, 
-                                table_2='exp_cpcs')
-        agg_scores.append((pat_num_2, agg_func(scores)))
+                                table_2='exp_cpcs', cpc_index=cpc_index)
+        agg_scores.append((pat_num_2, round_score(agg_func(scores))))
     
     agg_scores.sort(key=lambda x: x[1], reverse=True)
     
-    experts = []
-    for (patent, score) in agg_scores:
-        query = 'SELECT record FROM experts WHERE pat_num = %s;'
-        cur.execute(query, [patent])
-        experts += [(int(expert[0]), score) for expert in cur.fetchall() if 
-                    expert[0] not in [exp[0] for exp in experts]]
-                                        
-    return experts
\ No newline at end of file
+    return rank_experts(agg_scores, cur)
\ No newline at end of file
@@ -0,0 +1,275 @@
+'''
+Global store of patent citations. Every referencer-referenced pair is
+kept once in a single SQL table, indexed in both directions, whatever
+root patent's network it was found in, and the whole graph can be
+exported to a compact CSR file from which the network around any root
+patent is pulled for SimRank.
+
+(C) 2014 Erin Burnside
+'''
+
+
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import psycopg2
+from psycopg2.extras import execute_values
+
+
+# Graphs loaded from disk keyed by their path (see get_graph).
+GRAPHS = {}
+
+
+def create_citations (conn):
+    '''
+    INPUT: PSYCOPG2 CONNECTION conn
+    OUTPUT: NONE
+
+    Creates the citations table, keyed by (ref_in, ref_out) so that each
+    citation is stored once, with a second index for lookups by the
+    patent being referenced.
+    '''
+    cur = conn.cursor()
+    query = 'CREATE TABLE IF NOT EXISTS citations '
+    query += '(ref_in INT, ref_out INT, PRIMARY KEY (ref_in, ref_out));'
+    cur.execute(query)
+    query = 'CREATE INDEX IF NOT EXISTS citations_ref_out '
+    query += 'ON citations (ref_out);'
+    cur.execute(query)
+    conn.commit()
+
+
+def add_citations (edges, cur):
+    '''
+    INPUT: LIST OF (INT, INT) TUPLES edges, PSYCOPG2 CURSOR cur
+    OUTPUT: NONE
+
+    Inserts (ref_in, ref_out) pairs into the citations table, skipping
+    those already there, with multi-row INSERT statements.
+    '''
+    query = 'INSERT INTO citations (ref_in, ref_out) VALUES %s '
+    query += 'ON CONFLICT DO NOTHING;'
+    execute_values(cur, query, edges, page_size=1000)
+
+
+class EdgeWriter (object):
+    '''
+    Buffers citations found by a crawl and writes them to the citations
+    table in batches (see add_citations). Edges are deduplicated in the
+    buffer, and the buffer is due for a flush once it holds batch_size 
+    edges or interval seconds have passed since the last flush. flush 
+    does not commit, so that the caller can commit the edges together 
+    with the crawl state they belong to.
+    '''
+    
+    def __init__ (self, cur, batch_size=5000, interval=30.):
+        self.cur = cur
+        self.batch_size = batch_size
+        self.interval = interval
+        self.edges = set()
+        self.last_flush = time.time()
+    
+    def add (self, ref_in, ref_out):
+        '''
+        INPUT: INT ref_in, INT ref_out
+        OUTPUT: NONE
+        
+        Buffers the citation of ref_out by ref_in.
+        '''
+        self.edges.add((ref_in, ref_out))
+    
+    def due (self):
+        '''
+        INPUT: NONE
+        OUTPUT: BOOL due
+        
+        Returns whether the buffer is full or old enough to be flushed.
+        '''
+        return (len(self.edges) >= self.batch_size or 
+                time.time() - self.last_flush >= self.interval)
+    
+    def flush (self):
+        '''
+        INPUT: NONE
+        OUTPUT: INT n_edges
+        
+        Inserts the buffered edges, empties the buffer and returns the 
+        number of edges written.
+        '''
+        n_edges = len(self.edges)
+        if n_edges > 0:
+            add_citations(sorted(self.edges), self.cur)
+        self.edges = set()
+        self.last_flush = time.time()
+        return n_edges
+
+
+def migrate_ref_tables (conn):
+    '''
+    INPUT: PSYCOPG2 CONNECTION conn
+    OUTPUT: INT n_tables
+
+    Copies the edges of every per-root ref_<root> table into the
+    citations table, dropping duplicates, and returns how many tables
+    were copied. The ref_ tables themselves are left in place.
+    '''
+    create_citations(conn)
+    cur = conn.cursor()
+    query = 'SELECT table_name FROM information_schema.tables '
+    query += "WHERE table_name LIKE 'ref\\_%';"
+    cur.execute(query)
+    tables = [table[0] for table in cur.fetchall()]
+
+    for table in tables:
+        query = 'INSERT INTO citations (ref_in, ref_out) '
+        query += 'SELECT DISTINCT ref_in, ref_out FROM ' + table
+        query += ' ON CONFLICT DO NOTHING;'
+        cur.execute(query)
+    conn.commit()
+
+    return len(tables)
+
+
+def build_graph (cur):
+    '''
+    INPUT: PSYCOPG2 CURSOR cur
+    OUTPUT: DICT graph
+
+    Reads the citations table into CSR form. Patents are numbered by
+    their position in the sorted pat_arr; the references of patent ii
+    are out_indices[out_indptr[ii]:out_indptr[ii + 1]] and the patents
+    referencing it are in_indices[in_indptr[ii]:in_indptr[ii + 1]].
+    '''
+    cur.execute('SELECT ref_in, ref_out FROM citations;')
+    edges = np.array(cur.fetchall(), dtype=np.int64).reshape(-1, 2)
+
+    pat_arr, codes = np.unique(edges.ravel(), return_inverse=True)
+    codes = codes.reshape(-1, 2)
+    n_pats = pat_arr.shape[0]
+    out_csr = sparse.csr_matrix((np.ones(codes.shape[0], dtype=np.int8),
+                                 (codes[:, 0], codes[:, 1])),
+                                shape=(n_pats, n_pats))
+    in_csr = out_csr.T.tocsr()
+
+    graph = {'pat_arr': pat_arr,
+             'out_indptr': out_csr.indptr, 'out_indices': out_csr.indices,
+             'in_indptr': in_csr.indptr, 'in_indices': in_csr.indices}
+    return graph
+
+
+def save_graph (graph, filename):
+    '''
+    INPUT: DICT graph, STRING filename
+    OUTPUT: NONE
+
+    Writes graph to a compressed .npz file.
+    '''
+    np.savez_compressed(filename, **graph)
+
+
+def load_graph (filename):
+    '''
+    INPUT: STRING filename
+    OUTPUT: DICT graph
+
+    Reads a graph written by save_graph.
+    '''
+    npz = np.load(filename)
+    return dict((key, npz[key]) for key in npz.files)
+
+
+def export_graph (conn, filename='citations.npz'):
+    '''
+    INPUT: PSYCOPG2 CONNECTION conn, optional STRING filename
+    OUTPUT: DICT graph
+
+    Exports the citations table to filename (see build_graph) and 
+    replaces any copy of it already loaded by get_graph, so that the 
+    next get_graph sees the new citations. Returns the graph.
+    '''
+    graph = build_graph(conn.cursor())
+    save_graph(graph, filename)
+    GRAPHS[filename] = graph
+    return graph
+
+
+def get_graph (filename='citations.npz', refresh=False):
+    '''
+    INPUT: optional STRING filename, optional BOOL refresh
+    OUTPUT: DICT graph
+
+    Returns the graph stored at filename, loading it only the first time
+    (or again if refresh is set). The file is a snapshot: citations 
+    added since it was exported are not in it until export_graph is run
+    again (reference_scraper.get_all_networks does so after crawling).
+    '''
+    if refresh or filename not in GRAPHS:
+        GRAPHS[filename] = load_graph(filename)
+    return GRAPHS[filename]
+
+
+def neighbors (graph, nodes):
+    '''
+    INPUT: DICT graph, 1-DIM NUMPY ARRAY nodes
+    OUTPUT: LIST OF 1-DIM NUMPY ARRAYS out_nbrs, 
+        LIST OF 1-DIM NUMPY ARRAYS in_nbrs
+
+    Returns, for each of nodes (positions in pat_arr), the positions of
+    the patents it references and of the patents referencing it.
+    '''
+    out_nbrs = [graph['out_indices'][graph['out_indptr'][node]:
+                                     graph['out_indptr'][node + 1]]
+                for node in nodes]
+    in_nbrs = [graph['in_indices'][graph['in_indptr'][node]:
+                                   graph['in_indptr'][node + 1]]
+               for node in nodes]
+    return out_nbrs, in_nbrs
+
+
+def subgraph_edges (graph, root, n_hops=2):
+    '''
+    INPUT: DICT graph, INT root, optional INT n_hops
+    OUTPUT: PANDAS DATAFRAME edge_df
+
+    Returns the citation network of root as crawled by reference_scraper
+    up to max_level n_hops: every citation to or from a patent within
+    n_hops links of root, following citations in either direction. The
+    dataframe has the ref_in and ref_out columns of simrank.get_edge_list
+    and is empty if root is not in the graph.
+    '''
+    pat_arr = graph['pat_arr']
+    root_index = np.searchsorted(pat_arr, root)
+    if root_index == pat_arr.shape[0] or pat_arr[root_index] != root:
+        return pd.DataFrame({'ref_in': [], 'ref_out': []}, dtype=np.int64)
+
+    seen = np.zeros(pat_arr.shape[0], dtype=bool)
+    seen[root_index] = True
+    frontier = np.array([root_index])
+    ball = [frontier]
+    for hop in range(n_hops):
+        out_nbrs, in_nbrs = neighbors(graph, frontier)
+        frontier = np.unique(np.concatenate(out_nbrs + in_nbrs + [[]]))
+        frontier = frontier.astype(np.int64)
+        frontier = frontier[~seen[frontier]]
+        seen[frontier] = True
+        ball.append(frontier)
+    ball = np.concatenate(ball)
+
+    out_nbrs, in_nbrs = neighbors(graph, ball)
+    n_out = [nbrs.shape[0] for nbrs in out_nbrs]
+    n_in = [nbrs.shape[0] for nbrs in in_nbrs]
+    ref_in = np.concatenate([np.repeat(ball, n_out)] + in_nbrs)
+    ref_out = np.concatenate(out_nbrs + [np.repeat(ball, n_in)])
+
+    edges = np.unique(ref_in * pat_arr.shape[0] + ref_out)
+    edge_df = pd.DataFrame({'ref_in': pat_arr[edges // pat_arr.shape[0]],
+                            'ref_out': pat_arr[edges % pat_arr.shape[0]]})
+    return edge_df[['ref_in', 'ref_out']]
+
+
+if __name__ == "__main__":
+    conn = psycopg2.connect(database='patents', user='postgres')
+    migrate_ref_tables(conn)
+    export_graph(conn)
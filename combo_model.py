@@ -32,21 +32,25 @@ def add_next_model (df, col_name, model, params):
         df.loc[expert, col_name] = score
 
 
-def predict_top_n (pat_nums, text_table, expert_table, params, n):
+def predict_top_n (pat_nums, text_table, expert_table, params, n, 
+                   nb_model_path='naive_bayes.pkl'):
     '''
     INPUT: LIST OF INTS pat_nums, STRING text_table, 
-        STRING expert_table, LIST OF FLOATS params, INT n
+        STRING expert_table, LIST OF FLOATS params, INT n, 
+        optional STRING nb_model_path
     OUTPUT: NONE
     
     Predicts the n most relevant experts for the patents in list 
-    pat_nums and outputs each patent's top picks to a csv.
+    pat_nums and outputs each patent's top picks to a csv. The naive 
+    Bayes model is the one stored at nb_model_path, only refitted when
+    its tables change (see naive_bayes.get_model).
     '''
     conn = psycopg2.connect(database = 'patents', user = 'postgres')
     cur = conn.cursor()
     
     for test_pat in pat_nums:
         matches = naive_bayes.predict_expert(text_table, expert_table, 
-                                             test_pat, cur)
+                                             test_pat, cur, nb_model_path)
         experts = [match[0] for match in matches]
         scores = [match[1] for match in matches]
         df_matches = pd.DataFrame(scores, columns=['nb'], index=experts)
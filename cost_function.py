@@ -6,12 +6,151 @@ associated value of the cost function.
 '''
 
 
+import inspect
+import multiprocessing
+
 import psycopg2
 
+import basic_model
+import cpc_features
+import cpc_matrix
+
+
+# Connection, model and params of a cost_breakdown worker process, set 
+# by init_worker.
+WORKER = {}
+
 
-def cost_function (model, params):
+def get_test_patents (cur):
+    '''
+    INPUT: PSYCOPG2 CURSOR cur
+    OUTPUT: LIST OF (INT, INT) TUPLES test_pats
+    
+    Pulls the patents used to evaluate the cost function together with
+    their one true expert (see cost_function).
+    '''
+    query = 'SELECT * FROM one_expert_pats AS oep '
+    query += 'JOIN many_pat_experts AS mpe ON oep.index = mpe.index;'
+    cur.execute(query)
+    
+    test_pats = [(star[1], star[2]) for star in cur.fetchall()]
+    return test_pats
+
+
+def expert_cost (matches, expert):
+    '''
+    INPUT: LIST OF (INT, FLOAT) TUPLES matches, INT expert
+    OUTPUT: INT cost
+    
+    Returns the index at which expert appears in matches, or 0 if it 
+    does not appear.
+    '''
+    for (ii, match) in enumerate(matches):
+        if match[0] == expert:
+            return ii
+    return 0
+
+
+def model_args (model, params, test_pat, conn, cur):
+    '''
+    INPUT: FUNCTION NAME model, DICT OF ARGUMENTS params, INT test_pat,
+        PSYCOPG2 CONNECTION conn, PSYCOPG2 CURSOR cur
+    OUTPUT: DICT OF ARGUMENTS args
+    
+    Copies params for one call of model on test_pat, handing over the 
+    open connection or cursor if model takes one.
+    '''
+    args = dict(params)
+    args['test_pat'] = test_pat
+    
+    arg_names = inspect.getargspec(model).args
+    if 'cur' in arg_names:
+        args['cur'] = cur
+    if 'conn' in arg_names:
+        args['conn'] = conn
+    
+    return args
+
+
+def init_worker (model, params):
     '''
     INPUT: FUNCTION NAME model, DICT OF ARGUMENTS params
+    OUTPUT: NONE
+    
+    Run once in each worker process of cost_breakdown (or in this 
+    process when it runs serially). Opens the connection the worker 
+    reuses for every patent it evaluates. Indexes cached at module 
+    level by the models (e.g. basic_model.CPC_INDEX) likewise persist 
+    for the life of the worker, and those already loaded in the parent 
+    are inherited when the pool is forked.
+    '''
+    conn = psycopg2.connect(database = 'patents', user = 'postgres')
+    WORKER['conn'] = conn
+    WORKER['cur'] = conn.cursor()
+    WORKER['model'] = model
+    WORKER['params'] = params
+
+
+def evaluate_patent (test_pair):
+    '''
+    INPUT: (INT, INT) TUPLE test_pair
+    OUTPUT: (INT, INT, INT) TUPLE pat_cost
+    
+    Runs the worker's model on one test patent and returns the patent, 
+    its true expert and the cost of the prediction.
+    '''
+    (test_pat, expert) = test_pair
+    args = model_args(WORKER['model'], WORKER['params'], test_pat, 
+                      WORKER['conn'], WORKER['cur'])
+    matches = WORKER['model'](**args)
+    
+    return (test_pat, expert, expert_cost(matches, expert))
+
+
+def cost_breakdown (model, params, processes=None, chunksize=1):
+    '''
+    INPUT: FUNCTION NAME model, DICT OF ARGUMENTS params, 
+        optional INT processes, optional INT chunksize
+    OUTPUT: INT cost, LIST OF (INT, INT, INT) TUPLES pat_costs
+    
+    Computes the cost function (see cost_function) patent by patent. 
+    The test patents are spread over a pool of processes (all cores if 
+    processes is None), chunksize patents at a time; each worker keeps 
+    one connection open (see init_worker). With processes=1 they are 
+    evaluated in this process instead. Returns the total cost and the 
+    (patent, expert, cost) of every test patent, in the order of 
+    get_test_patents, so the result does not depend on how the work was
+    scheduled. model and params must be picklable (module-level 
+    functions) unless processes is 1.
+    '''
+    conn = psycopg2.connect(database = 'patents', user = 'postgres')
+    test_pats = get_test_patents(conn.cursor())
+    conn.close()
+    
+    if processes == 1:
+        init_worker(model, params)
+        try:
+            pat_costs = map(evaluate_patent, test_pats)
+        finally:
+            WORKER['conn'].close()
+            WORKER.clear()
+    else:
+        pool = multiprocessing.Pool(processes, init_worker, 
+                                    (model, params))
+        try:
+            pat_costs = pool.map(evaluate_patent, test_pats, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+    
+    cost = sum(pat_cost for (pat, expert, pat_cost) in pat_costs)
+    return cost, pat_costs
+
+
+def cost_function (model, params, processes=1):
+    '''
+    INPUT: FUNCTION NAME model, DICT OF ARGUMENTS params, 
+        optional INT processes
     OUTPUT: INT cost
     
     Pulls all patents in which the following two conditions are met:
@@ -22,23 +161,29 @@ def cost_function (model, params):
     at which the true expert appears in the prediction list (i.e. 0 if
     the true expert is at the top of the list, and 1 additional point
     for every slot further down the list before the expert appears).
-    '''
-    conn = psycopg2.connect(database = 'patents', user = 'postgres')
-    cur = conn.cursor()
     
-    query = 'SELECT * FROM one_expert_pats AS oep '
-    query += 'JOIN many_pat_experts AS mpe ON oep.index = mpe.index;'
-    cur.execute(query)
+    Unless processes is 1 the patents are evaluated in parallel 
+    (processes=None uses every core). Returns the total only; use 
+    cost_breakdown for the cost of each patent.
+    '''
+    return cost_breakdown(model, params, processes)[0]
+
+
+def feature_cost_function (params, agg_func, features):
+    '''
+    INPUT: LIST OF FLOATS params, FUNCTION NAME agg_func, DICT features
+    OUTPUT: INT cost
     
-    cost = 0
-    for star in cur.fetchall():
-        params['test_pat'] = star[1]
-        print params['test_pat'], star[2]
-        matches = model(**params)
-        for (ii, match) in enumerate(matches):
-            if match[0] == star[2]:
-                cost += ii
-                print cost
-                break
-    
-    return cost
\ No newline at end of file
+    Fast path of the cost function for the CPC model: evaluates params 
+    on precomputed match-depth features (see cpc_features) instead of 
+    rescoring the CPCs of every test patent. Takes its arguments in the
+    order used by sim_anneal_model.sim_annealing, with the features in
+    place of the model. Params the features cannot score (see 
+    cpc_matrix.ambiguous_params) are evaluated the slow way, with 
+    basic_model on the test patents in SQL.
+    '''
+    if cpc_matrix.ambiguous_params(params):
+        return cost_function(basic_model.predict_expert, 
+                             {'params': params, 'agg_func': agg_func, 
+                              'testing': True})
+    return cpc_features.features_cost(features, params, agg_func)
\ No newline at end of file
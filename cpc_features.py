@@ -0,0 +1,251 @@
+'''
+Precomputed CPC match-depth features for fast evaluation of the cost
+function. Every pair score in basic_model is a sum of a prefix of params
+picked out by the pair's match depth (see cpc_matrix), so the score of a
+test patent against a training patent only depends on how many of their
+CPC pairs fall at each depth. These counts are computed once, stored
+sparsely on disk, and any new params can then be evaluated for every
+test patent with a single sparse matrix-vector product.
+
+(C) 2014 Erin Burnside
+'''
+
+
+import numpy as np
+from scipy import sparse
+
+import basic_model
+import cpc_matrix
+
+
+def get_expert_pairs (cur, training_patents):
+    '''
+    INPUT: PSYCOPG2 CURSOR cur, LIST OF INTS training_patents
+    OUTPUT: 1-DIM NUMPY ARRAY expert_pats, 1-DIM NUMPY ARRAY expert_ids,
+        1-DIM NUMPY ARRAY expert_order, 1-DIM NUMPY ARRAY expert_labels
+
+    Pulls every expert-patent pairing for the training patents. Returns
+    for each pairing the position of the patent in training_patents,
+    the position of the expert in expert_labels and the order in which
+    the expert is listed for that patent.
+    '''
+    pat_index = dict((pat_num, ii) for (ii, pat_num) in
+                     enumerate(training_patents))
+
+    cur.execute('SELECT pat_num, record FROM experts;')
+
+    labels = {}
+    pairs = {}
+    for (pat_num, record) in cur.fetchall():
+        if pat_num not in pat_index:
+            continue
+        expert = labels.setdefault(int(record), len(labels))
+        pat_experts = pairs.setdefault(pat_index[pat_num], [])
+        if expert not in pat_experts:
+            pat_experts.append(expert)
+
+    pair_list = [(pat, expert, order) for (pat, experts) in pairs.items()
+                 for (order, expert) in enumerate(experts)]
+    expert_pats, expert_ids, expert_order = [np.array(col, dtype=np.int64)
+                                             for col in zip(*pair_list)]
+    expert_labels = np.zeros(len(labels), dtype=np.int64)
+    for (record, expert) in labels.items():
+        expert_labels[expert] = record
+
+    return expert_pats, expert_ids, expert_order, expert_labels
+
+
+def build_features (cur, test_pats, table='cpcs', exp_table='exp_cpcs'):
+    '''
+    INPUT: PSYCOPG2 CURSOR cur, LIST OF (INT, INT) TUPLES test_pats,
+        optional STRING table, optional STRING exp_table
+    OUTPUT: DICT features
+
+    For each (patent, true expert) pair in test_pats (see
+    cost_function.get_test_patents), counts how many of the CPC pairs
+    between the test patent and each training patent fall at each match
+    depth. The counts are kept as a sparse matrix with one row per
+    (test patent, training patent) pairing and one column per depth;
+    depth 0 scores nothing and is left out. Also stores the number of
+    CPCs on each side and the experts of the training patents so that
+    the cost can be evaluated without SQL.
+    '''
+    (training_patents, starts, encoded_2, ids) = \
+        cpc_matrix.encode_index(cur, exp_table)
+    hierarchy = basic_model.get_level_hierarchy(cur)
+    level_arrays = cpc_matrix.get_level_arrays(cur)
+
+    n_train = len(training_patents)
+    n_codes = np.diff(np.append(starts, encoded_2.shape[0]))
+    segments = np.repeat(np.arange(n_train), n_codes)
+
+    blocks = []
+    n_query = []
+    for (test_pat, expert) in test_pats:
+        cpcs_1 = basic_model.get_cpc(test_pat, cur, table)
+        encoded_1 = cpc_matrix.encode_cpcs(cpcs_1, hierarchy, level_arrays,
+                                           dict(ids))
+        depths = cpc_matrix.depth_matrix(encoded_1, encoded_2, level_arrays)
+
+        bins = segments * cpc_matrix.N_DEPTHS + depths
+        counts = np.bincount(bins.ravel(),
+                             minlength=n_train * cpc_matrix.N_DEPTHS)
+        counts = counts.reshape(n_train, cpc_matrix.N_DEPTHS)
+        counts[:, 0] = 0
+
+        blocks.append(sparse.csr_matrix(counts, dtype=np.int32))
+        n_query.append(len(cpcs_1))
+
+    (expert_pats, expert_ids, expert_order, expert_labels) = \
+        get_expert_pairs(cur, training_patents)
+
+    features = {'test_pats': np.array([pat for (pat, exp) in test_pats]),
+                'true_experts': np.array([exp for (pat, exp) in test_pats]),
+                'training_patents': np.array(training_patents),
+                'n_query': np.array(n_query),
+                'n_codes': n_codes,
+                'depth_counts': sparse.vstack(blocks).tocsr(),
+                'expert_pats': expert_pats,
+                'expert_ids': expert_ids,
+                'expert_order': expert_order,
+                'expert_labels': expert_labels}
+    return features
+
+
+def save_features (features, filename):
+    '''
+    INPUT: DICT features, STRING filename
+    OUTPUT: NONE
+
+    Writes features to a compressed .npz file, storing the sparse depth
+    counts by their CSR arrays.
+    '''
+    arrays = dict(features)
+    depth_counts = arrays.pop('depth_counts')
+    np.savez_compressed(filename, counts_data=depth_counts.data,
+                        counts_indices=depth_counts.indices,
+                        counts_indptr=depth_counts.indptr,
+                        counts_shape=np.array(depth_counts.shape), **arrays)
+
+
+def load_features (filename):
+    '''
+    INPUT: STRING filename
+    OUTPUT: DICT features
+
+    Reads features written by save_features.
+    '''
+    npz = np.load(filename)
+    features = dict((key, npz[key]) for key in npz.files if not
+                    key.startswith('counts_'))
+    features['depth_counts'] = sparse.csr_matrix(
+        (npz['counts_data'], npz['counts_indices'], npz['counts_indptr']),
+        shape=tuple(npz['counts_shape']))
+    return features
+
+
+def feature_scores (features, params, agg_func):
+    '''
+    INPUT: DICT features, LIST OF FLOATS params, FUNCTION NAME agg_func
+    OUTPUT: 2-DIM NUMPY ARRAY scores
+
+    Computes the aggregated score of every test patent (rows) against
+    every training patent (columns) for the given params. Only np.mean
+    and max are supported. Maxima assume nonnegative params, as produced
+    by sim_anneal_model.shift_params, so that depth 0 never wins. Means
+    are summed by depth rather than pair by pair, so like basic_model 
+    the scores are rounded to basic_model.SCORE_DECIMALS for ranking.
+    Params that basic_model scores inconsistently (see 
+    cpc_matrix.ambiguous_params) cannot be evaluated from depths and 
+    raise ValueError.
+    '''
+    if cpc_matrix.ambiguous_params(params):
+        raise ValueError('depth features cannot score ambiguous params')
+
+    table = cpc_matrix.depth_scores(params)
+    depth_counts = features['depth_counts']
+    shape = (features['test_pats'].shape[0],
+             features['training_patents'].shape[0])
+
+    if agg_func is np.mean:
+        n_pairs = np.outer(features['n_query'], features['n_codes']).ravel()
+        sums = depth_counts.dot(table)
+        scores = np.where(n_pairs > 0, sums / np.maximum(n_pairs, 1), 0)
+
+    elif agg_func in (max, np.max, np.amax):
+        indptr = depth_counts.indptr
+        filled = indptr[1:] > indptr[:-1]
+        scores = np.zeros(depth_counts.shape[0])
+        if depth_counts.nnz > 0:
+            row_max = np.maximum.reduceat(table[depth_counts.indices],
+                                          indptr[:-1][filled])
+            scores[filled] = row_max
+
+    else:
+        raise ValueError('features only support np.mean and max')
+
+    return np.round(scores, basic_model.SCORE_DECIMALS).reshape(shape)
+
+
+def expert_cost (scores, test_pat, true_expert, features):
+    '''
+    INPUT: 1-DIM NUMPY ARRAY scores, INT test_pat, INT true_expert,
+        DICT features
+    OUTPUT: INT cost
+
+    Ranks experts the way basic_model.rank_experts does (training
+    patents by descending score, the test patent itself left out, each
+    expert at its first appearance) and returns the position of the
+    true expert, or 0 if it never appears.
+    '''
+    expert_labels = features['expert_labels']
+    true_ids = np.nonzero(expert_labels == true_expert)[0]
+    if true_ids.shape[0] == 0:
+        return 0
+
+    training_patents = features['training_patents']
+    order = np.argsort(-scores, kind='mergesort')
+    positions = np.empty(order.shape[0], dtype=np.int64)
+    positions[order] = np.arange(order.shape[0])
+
+    never = np.iinfo(np.int64).max
+    width = features['expert_order'].max() + 1
+    keys = positions[features['expert_pats']] * width
+    keys += features['expert_order']
+    keys[training_patents[features['expert_pats']] == test_pat] = never
+
+    first_keys = np.empty(expert_labels.shape[0], dtype=np.int64)
+    first_keys.fill(never)
+    np.minimum.at(first_keys, features['expert_ids'], keys)
+
+    true_key = first_keys[true_ids[0]]
+    if true_key == never:
+        return 0
+    return int(np.sum(first_keys < true_key))
+
+
+def features_cost (features, params, agg_func):
+    '''
+    INPUT: DICT features, LIST OF FLOATS params, FUNCTION NAME agg_func
+    OUTPUT: INT cost
+
+    Evaluates the cost function for params entirely from features: one
+    sparse product for the scores, then the rank of each true expert.
+    '''
+    scores = feature_scores(features, params, agg_func)
+
+    cost = 0
+    for (ii, test_pat) in enumerate(features['test_pats']):
+        cost += expert_cost(scores[ii], test_pat,
+                            features['true_experts'][ii], features)
+    return cost
+
+
+if __name__ == "__main__":
+    import psycopg2
+    import cost_function
+    
+    conn = psycopg2.connect(database='patents', user='postgres')
+    cur = conn.cursor()
+    features = build_features(cur, cost_function.get_test_patents(cur))
+    save_features(features, 'cpc_features.npz')
@@ -0,0 +1,345 @@
+'''
+Batch version of the CPC scoring in basic_model. Every CPC code is
+encoded as a row of integer fields (section, class digits, subclass,
+main group and position in the group hierarchy) so that the scores of
+all pairs of query codes and training codes can be computed at once as a
+NumPy matrix instead of one string comparison at a time. Each pair is
+first reduced to a "match depth" and then looked up in a table of
+scores built from params with the same sums used by basic_model, so
+pair scores are identical to those of basic_model.compute_scores.
+basic_model tells how much of the first halves matched by comparing sums
+of parameters, so params that make two of those sums equal (such as
+zeros) are scored with basic_model itself.
+
+(C) 2014 Erin Burnside
+'''
+
+
+import bisect
+
+import numpy as np
+import psycopg2
+
+import basic_model
+
+
+# Columns of an encoded CPC array (see encode_cpcs).
+SECTION, CLASS_1, CLASS_2, SUBCLASS, HEAD, CODE, LEFT, RIGHT = range(8)
+N_FIELDS = 8
+
+# Match depths. 0-4 count matching characters in the first half,
+# FIRST_HALF + k means identical first halves with a group score of
+# sum(([0] + params[5:])[0:k]), and IDENTICAL means identical codes.
+FIRST_HALF = 5
+IDENTICAL = 19
+N_DEPTHS = 20
+
+# Flattened level arrays and encoded exp_cpcs, keyed by table name.
+LEVEL_ARRAYS = {}
+ENCODED_INDEX = {}
+
+
+def build_level_arrays (hierarchy):
+    '''
+    INPUT: DICT hierarchy
+    OUTPUT: (DICT OF STRING -> INT, 1-DIM NUMPY ARRAY,
+        2-DIM NUMPY ARRAY) TUPLE level_arrays
+
+    Flattens the per-main-group hierarchy from
+    basic_model.load_level_hierarchy into one array of levels, with the
+    offset of each main group, and a padded range-minimum table over it
+    so that the coarsest level between many pairs of positions can be
+    looked up with fancy indexing.
+    '''
+    offsets = {}
+    flat_levels = []
+    for main_group in sorted(hierarchy):
+        offsets[main_group] = len(flat_levels)
+        flat_levels += hierarchy[main_group][1]
+    flat_levels = np.array(flat_levels, dtype=np.int16)
+
+    n_levels = max(flat_levels.shape[0], 1)
+    min_table = np.empty((n_levels.bit_length(), n_levels), dtype=np.int16)
+    min_table.fill(basic_model.NO_LEVEL)
+    min_table[0, :flat_levels.shape[0]] = np.where(flat_levels > 0,
+                                                   flat_levels,
+                                                   basic_model.NO_LEVEL)
+    for k in range(1, min_table.shape[0]):
+        width = 1 << (k - 1)
+        min_table[k, :-width] = np.minimum(min_table[k - 1, :-width],
+                                           min_table[k - 1, width:])
+
+    return offsets, flat_levels, min_table
+
+
+def get_level_arrays (cur, refresh=False):
+    '''
+    INPUT: PSYCOPG2 CURSOR cur, optional BOOLEAN refresh
+    OUTPUT: TUPLE level_arrays
+
+    Returns the flattened level arrays, building them from the level
+    hierarchy the first time they are needed or whenever refresh is set
+    to True.
+    '''
+    if refresh or 'levels' not in LEVEL_ARRAYS:
+        hierarchy = basic_model.get_level_hierarchy(cur, refresh)
+        LEVEL_ARRAYS['levels'] = build_level_arrays(hierarchy)
+    return LEVEL_ARRAYS['levels']
+
+
+def encode_cpcs (cpcs, hierarchy, level_arrays, ids):
+    '''
+    INPUT: LIST OF STRINGS cpcs, DICT hierarchy, TUPLE level_arrays,
+        DICT ids
+    OUTPUT: 2-DIM NUMPY ARRAY encoded
+
+    Encodes each CPC as a row of N_FIELDS integers: the character codes
+    of the section, class digits and subclass (-1 if missing), ids of
+    the first half and of the whole code, and the first and last
+    positions in the flattened levels that the subgroup would occupy
+    (-1 and -2 if the main group has no levels). ids maps strings to
+    integers and must be shared by every array that is scored together.
+    '''
+    offsets = level_arrays[0]
+
+    encoded = np.empty((len(cpcs), N_FIELDS), dtype=np.int64)
+    for (ii, cpc) in enumerate(cpcs):
+        (cpc_fh, cpc_sh) = cpc.split('/')
+        chars = [ord(ch) for ch in cpc_fh[0:4]]
+        chars += [-1] * (4 - len(chars))
+
+        head = ids.setdefault('fh:' + cpc_fh, len(ids))
+        code = ids.setdefault(cpc, len(ids))
+
+        if cpc_fh in hierarchy:
+            subgroups = hierarchy[cpc_fh][0]
+            left = offsets[cpc_fh] + bisect.bisect_left(subgroups, cpc_sh)
+            right = offsets[cpc_fh] + bisect.bisect_right(subgroups,
+                                                          cpc_sh) - 1
+        else:
+            (left, right) = (-1, -2)
+
+        encoded[ii] = chars + [head, code, left, right]
+
+    return encoded
+
+
+def depth_matrix (encoded_1, encoded_2, level_arrays):
+    '''
+    INPUT: 2-DIM NUMPY ARRAY encoded_1, 2-DIM NUMPY ARRAY encoded_2,
+        TUPLE level_arrays
+    OUTPUT: 2-DIM NUMPY ARRAY depths
+
+    Computes the match depth of every pairing of the codes in encoded_1
+    (rows) with the codes in encoded_2 (columns), following the same
+    rules as basic_model.score_first_half and
+    basic_model.compute_group_score_from_levels.
+    '''
+    (offsets, flat_levels, min_table) = level_arrays
+    enc_1 = encoded_1[:, None, :]
+    enc_2 = encoded_2[None, :, :]
+
+    depths = np.zeros((encoded_1.shape[0], encoded_2.shape[0]),
+                      dtype=np.int8)
+    matched = np.ones(depths.shape, dtype=bool)
+    for field in (SECTION, CLASS_1, CLASS_2, SUBCLASS):
+        matched &= ((enc_1[..., field] == enc_2[..., field]) &
+                    (enc_1[..., field] >= 0))
+        depths += matched
+
+    same_fh = matched & (enc_1[..., HEAD] == enc_2[..., HEAD])
+    same_code = enc_1[..., CODE] == enc_2[..., CODE]
+    rows, cols = np.nonzero(same_fh & ~same_code)
+
+    if rows.shape[0] > 0:
+        first = np.minimum(encoded_1[rows, LEFT], encoded_2[cols, LEFT])
+        last = np.maximum(encoded_1[rows, RIGHT], encoded_2[cols, RIGHT])
+        if np.any(first < 0) or np.any(first > last):
+            raise IndexError('CPC group missing from levels table')
+
+        levels = np.sort(np.vstack((flat_levels[first],
+                                    flat_levels[last])), axis=0)
+
+        inner_first = first + 1
+        inner_last = last - 1
+        has_inner = inner_last >= inner_first
+        width = np.where(has_inner, inner_last - inner_first + 1, 1)
+        k = np.zeros(width.shape, dtype=np.int64)
+        while np.any((1 << (k + 1)) <= width):
+            k += (1 << (k + 1)) <= width
+        inner = np.minimum(min_table[k, np.where(has_inner, inner_first, 0)],
+                           min_table[k, np.where(has_inner,
+                                                 inner_last - (1 << k) + 1,
+                                                 0)])
+        inner = np.where(has_inner, inner, basic_model.NO_LEVEL)
+
+        (lo, hi) = (levels[0], levels[1])
+        group_depth = np.where(lo == hi,
+                               np.where(inner < lo, inner, lo),
+                               np.where(inner <= lo, inner, lo + 1))
+        group_depth = np.where(lo == 0, 2, group_depth)
+        group_depth = np.where((lo == 1) & (hi == 1), 0, group_depth)
+
+        depths[rows, cols] = FIRST_HALF + group_depth
+
+    depths[same_code] = IDENTICAL
+
+    return depths
+
+
+def depth_scores (params):
+    '''
+    INPUT: LIST OF FLOATS params
+    OUTPUT: 1-DIM NUMPY ARRAY table
+
+    Builds the score of each match depth from params, adding the
+    parameters up in the same order as basic_model.compute_scores so
+    that looked-up scores equal the ones it computes.
+    '''
+    params = list(params)
+    group_params = [0] + params[5:]
+
+    table = [sum(params[0:ii]) for ii in range(FIRST_HALF)]
+    table += [sum(params[:5]) + sum(group_params[0:k]) for k in
+              range(IDENTICAL - FIRST_HALF)]
+    table.append(sum(params[:-1]))
+
+    return np.array(table, dtype=float)
+
+
+def ambiguous_params (params):
+    '''
+    INPUT: LIST OF FLOATS params
+    OUTPUT: BOOLEAN ambiguous
+
+    Returns True if basic_model would mistake a partial match of first 
+    halves for a full one with these params: it checks for a full match
+    of the first four characters, and of the whole first half, by 
+    comparing the score so far to sum(params[0:4]) and sum(params[:5]),
+    which breaks down when a shorter match adds up to the same sum.
+    '''
+    sums = [sum(params[0:ii]) for ii in range(FIRST_HALF + 1)]
+    return sums[4] in sums[:4] or sums[5] in sums[:5]
+
+
+def aggregate_scores (scores, starts, agg_func):
+    '''
+    INPUT: 2-DIM NUMPY ARRAY scores, 1-DIM NUMPY ARRAY starts,
+        FUNCTION NAME agg_func
+    OUTPUT: 1-DIM NUMPY ARRAY agg_scores
+
+    Aggregates the columns of scores belonging to each training patent
+    (the segment of columns beginning at each entry of starts). Maxima
+    are computed as one segment reduction. Other agg_funcs, np.mean 
+    included, are called on each segment flattened in the order in 
+    which basic_model.compute_scores lists the pairs, so that sums are 
+    taken in the same order and agree to the last bit.
+    '''
+    if agg_func in (max, np.max, np.amax):
+        return np.maximum.reduceat(scores, starts, axis=1).max(axis=0)
+
+    ends = np.append(starts[1:], scores.shape[1])
+    if agg_func is np.mean:
+        return np.array([np.mean(scores[:, start:end].ravel()) for 
+                         (start, end) in zip(starts, ends)])
+
+    return np.array([agg_func(scores[:, start:end].ravel().tolist()) for
+                     (start, end) in zip(starts, ends)])
+
+
+def encode_index (cur, table='exp_cpcs', refresh=False):
+    '''
+    INPUT: PSYCOPG2 CURSOR cur, optional STRING table,
+        optional BOOLEAN refresh
+    OUTPUT: (LIST OF INTS, 1-DIM NUMPY ARRAY, 2-DIM NUMPY ARRAY, DICT)
+        TUPLE encoded_index
+
+    Encodes the CPCs of every patent in the CPC index of table (see
+    basic_model.get_cpc_index) as one array, with the training patents
+    in sorted order, the column at which each patent's codes start and
+    the ids used for the encoding. Stored in ENCODED_INDEX for reuse.
+    '''
+    if not refresh and table in ENCODED_INDEX:
+        return ENCODED_INDEX[table]
+
+    cpc_index = basic_model.get_cpc_index(cur, table, refresh)
+    hierarchy = basic_model.get_level_hierarchy(cur, refresh)
+    level_arrays = get_level_arrays(cur, refresh)
+
+    training_patents = sorted(cpc_index)
+    cpcs = []
+    starts = []
+    for pat_num in training_patents:
+        starts.append(len(cpcs))
+        cpcs += cpc_index[pat_num]
+
+    ids = {}
+    encoded = encode_cpcs(cpcs, hierarchy, level_arrays, ids)
+
+    ENCODED_INDEX[table] = (training_patents, np.array(starts, dtype=np.intp),
+                            encoded, ids)
+    return ENCODED_INDEX[table]
+
+
+def score_training_patents (cpcs_1, params, agg_func, cur,
+                            table='exp_cpcs'):
+    '''
+    INPUT: LIST OF STRINGS cpcs_1, LIST OF FLOATS params,
+        FUNCTION NAME agg_func, PSYCOPG2 CURSOR cur, optional STRING table
+    OUTPUT: LIST OF INTS training_patents, 1-DIM NUMPY ARRAY agg_scores
+
+    Scores the given CPCs against every training patent at once and
+    returns the training patents with their aggregated scores. For 
+    params that basic_model scores inconsistently (see ambiguous_params),
+    every training patent is scored with basic_model.compute_scores 
+    instead.
+    '''
+    (training_patents, starts, encoded_2, ids) = encode_index(cur, table)
+
+    if len(cpcs_1) == 0:
+        return training_patents, np.array([agg_func([]) for pat_num in
+                                           training_patents])
+
+    if ambiguous_params(params):
+        cpc_index = basic_model.get_cpc_index(cur, table)
+        return training_patents, np.array([
+            agg_func(basic_model.compute_scores(cpcs_1, pat_num, cur, params,
+                                                table, cpc_index)) for
+            pat_num in training_patents])
+
+    hierarchy = basic_model.get_level_hierarchy(cur)
+    level_arrays = get_level_arrays(cur)
+    encoded_1 = encode_cpcs(cpcs_1, hierarchy, level_arrays, dict(ids))
+
+    depths = depth_matrix(encoded_1, encoded_2, level_arrays)
+    scores = depth_scores(params)[depths]
+
+    return training_patents, aggregate_scores(scores, starts, agg_func)
+
+
+def predict_expert (test_pat, params, agg_func, table='cpcs', testing=False,
+                    cur=None):
+    '''
+    INPUT: INT pat_num, LIST OF FLOATS params, FUNCTION NAME agg_func,
+        optional STRING table, optional BOOLEAN testing, 
+        optional PSYCOPG2 CURSOR cur
+    OUTPUT: LIST OF (INT, FLOAT) TUPLES experts
+
+    Drop-in replacement for basic_model.predict_expert that scores all
+    training patents with score_training_patents. A cursor can be passed
+    in as cur to reuse an open connection.
+    '''
+    if cur is None:
+        conn = psycopg2.connect(database='patents', user='postgres')
+        cur = conn.cursor()
+
+    cpcs_1 = basic_model.get_cpc(test_pat, cur, table)
+    training_patents, agg_scores = score_training_patents(cpcs_1, params,
+                                                          agg_func, cur)
+
+    agg_scores = [(pat_num, basic_model.round_score(score)) for
+                  (pat_num, score) in zip(training_patents, agg_scores) if
+                  not (testing and pat_num == test_pat)]
+    agg_scores.sort(key=lambda x: x[1], reverse=True)
+
+    return basic_model.rank_experts(agg_scores, cur)
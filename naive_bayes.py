@@ -5,13 +5,22 @@ Building Naive Bayes model.
 '''
 
 
+import os
+import cPickle
+
 import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer
+from sklearn.feature_extraction.text import HashingVectorizer
 from sklearn.naive_bayes import MultinomialNB
 import numpy as np
-import psycopg2
+from scipy import sparse
+
+import table_versions
+import text_cache
 
-import patent_scraper
+
+# Fitted models keyed by the path they are stored at (see get_model).
+MODEL_STORE = {}
 
 
 def grab_all_text (text_table, expert_table, cur, test_pat):
@@ -20,11 +29,13 @@ def grab_all_text (text_table, expert_table, cur, test_pat):
         optional INT test_pat
     OUTPUT: PANDAS DATAFRAME text_df
     
-    Joins text data per patent to expert id for each expert and returns
-    this information in a dataframe.
+    Returns the text of every patent that has at least one expert, one
+    row per patent however many experts or rows in text_table (one per
+    case) it has, leaving out test_pat.
     '''
-    query = 'SELECT * FROM ' + text_table + ' AS t JOIN ' + expert_table 
-    query += ' AS e ON t.pat_num = e.pat_num;'
+    query = 'SELECT DISTINCT ON (pat_num) * FROM ' + text_table 
+    query += ' WHERE pat_num IN (SELECT pat_num FROM ' + expert_table + ')'
+    query += ' ORDER BY pat_num;'
     cur.execute(query)
     
     text_list = []
@@ -32,12 +43,38 @@ def grab_all_text (text_table, expert_table, cur, test_pat):
         pat_num = line[1]
         if pat_num != test_pat:
             raw_text = line[3] + ' ' + line[4] + ' ' + line[5]
-            expert = line[8]
-            text_list.append([pat_num, expert, raw_text])
-    df_text = pd.DataFrame(text_list, 
-                           columns = ['pat_num', 'expert', 'raw_text'])
+            text_list.append([pat_num, raw_text])
+    df_text = pd.DataFrame(text_list, columns = ['pat_num', 'raw_text'])
    
     return df_text
+
+
+def grab_experts (df_text, expert_table, cur):
+    '''
+    INPUT: PANDAS DATAFRAME df_text, STRING expert_table, 
+        PSYCOPG2 CURSOR cur
+    OUTPUT: SCIPY SPARSE MATRIX labels, 1-DIM NUMPY ARRAY classes
+    
+    Builds a sparse indicator matrix with one row per patent of df_text
+    (in the same order) and one column per expert in classes, holding 
+    the number of times the patent is listed for the expert (once per 
+    case) in expert_table.
+    '''
+    pat_index = dict((pat_num, ii) for (ii, pat_num) in 
+                     enumerate(df_text['pat_num']))
+    
+    cur.execute('SELECT pat_num, record FROM ' + expert_table + ';')
+    pairs = [(pat_index[pat_num], expert) for (pat_num, expert) in 
+             cur.fetchall() if pat_num in pat_index]
+    
+    (classes, class_codes) = np.unique([expert for (pat, expert) in pairs], 
+                                       return_inverse=True)
+    labels = sparse.csr_matrix((np.ones(len(pairs)), 
+                                ([pat for (pat, expert) in pairs], 
+                                 class_codes)), 
+                               shape=(df_text.shape[0], classes.shape[0]))
+    
+    return labels, classes
     
 
 def vectorize_text(df_text, text_col):
@@ -63,32 +100,259 @@ def naive_bayes (text_table, expert_table, test_pat, cur):
     
     Takes the names of SQL tables containing patent text and expert data
     and returns text vectorizer, Naive Bayes classifier, and a dataframe
-    tying text data to expert ids.
+    of the text of each patent.
+    
+    Each patent is vectorized once. The classifier is then fitted on 
+    one row of the TF-IDF matrix per (patent, expert) pairing, weighted
+    by the number of cases behind it, which gives the same counts as 
+    one row per line of the text/expert join.
     '''
     df_text = grab_all_text(text_table, expert_table, cur, test_pat)
+    labels, classes = grab_experts(df_text, expert_table, cur)
     tfidf_arr, tfidf_vect = vectorize_text(df_text, 'raw_text')
     
+    labels = labels.tocoo()
     nb_clf = MultinomialNB(class_prior = np.ones(446)/(446.))
-    nb_clf.fit(tfidf_arr, df_text['expert'])
+    nb_clf.fit(tfidf_arr[labels.row], classes[labels.col], 
+               sample_weight = labels.data)
     
     return tfidf_vect, nb_clf, df_text
 
 
-def predict_expert (text_table, expert_table, test_pat, cur):
+def table_signature (text_table, expert_table, cur):
+    '''
+    INPUT: STRING text_table, STRING expert_table, PSYCOPG2 CURSOR cur
+    OUTPUT: TUPLE signature
+    
+    Identifies the training data by the names of the tables and their 
+    versions, which triggers bump whenever a table changes (see 
+    table_versions). This is one primary key lookup, whatever the size 
+    of the tables. A stored model is only reused while its signature 
+    matches the tables.
+    '''
+    versions = table_versions.get_versions([text_table, expert_table], cur)
+    return (text_table, expert_table) + versions
+
+
+def fit_model (text_table, expert_table, cur):
+    '''
+    INPUT: STRING text_table, STRING expert_table, PSYCOPG2 CURSOR cur
+    OUTPUT: DICT model
+    
+    Fits the vectorizer and classifier on every patent in the tables 
+    (none left out) and returns them with the list of classes, the 
+    signature of the tables they were fitted on and how they were 
+    fitted (in memory, with a TF-IDF vectorizer).
+    '''
+    signature = table_signature(text_table, expert_table, cur)
+    tfidf_vect, nb_clf, df_text = naive_bayes(text_table, expert_table, 
+                                              None, cur)
+    
+    model = {'tfidf_vect': tfidf_vect, 'nb_clf': nb_clf, 
+             'classes': list(nb_clf.classes_), 'signature': signature,
+             'fit': 'memory', 'vectorizer': 'tfidf', 'fit_options': {}}
+    return model
+
+
+def save_model (model, path):
+    '''
+    INPUT: DICT model, STRING path
+    OUTPUT: NONE
+    
+    Pickles a fitted model to path, writing to a temporary file first so
+    that readers never see a partial model.
+    '''
+    f = open(path + '.tmp', 'wb')
+    cPickle.dump(model, f, cPickle.HIGHEST_PROTOCOL)
+    f.close()
+    os.rename(path + '.tmp', path)
+
+
+def load_model (path):
+    '''
+    INPUT: STRING path
+    OUTPUT: DICT model
+    
+    Unpickles a model written by save_model.
+    '''
+    f = open(path, 'rb')
+    model = cPickle.load(f)
+    f.close()
+    return model
+
+
+def get_model (text_table, expert_table, cur, path='naive_bayes.pkl'):
+    '''
+    INPUT: STRING text_table, STRING expert_table, PSYCOPG2 CURSOR cur,
+        optional STRING path
+    OUTPUT: DICT model
+    
+    Returns the model fitted on the current tables, from memory if this
+    process already has it, else from the file at path, refitting and 
+    saving it only if neither matches the signature of the tables. A 
+    stale model is refitted the way it was fitted: models from 
+    stream_fit with stream_fit and the same options, so that they stay
+    within its memory bound, and others with fit_model.
+    '''
+    signature = table_signature(text_table, expert_table, cur)
+    
+    model = MODEL_STORE.get(path)
+    if model is None and os.path.exists(path):
+        model = load_model(path)
+    
+    if model is not None and model['signature'] == signature:
+        MODEL_STORE[path] = model
+        return model
+    
+    if model is not None and model.get('fit') == 'stream':
+        return stream_fit(text_table, expert_table, cur.connection, path, 
+                          **model['fit_options'])
+    
+    model = fit_model(text_table, expert_table, cur)
+    save_model(model, path)
+    MODEL_STORE[path] = model
+    return model
+
+
+def grab_expert_map (expert_table, cur):
+    '''
+    INPUT: STRING expert_table, PSYCOPG2 CURSOR cur
+    OUTPUT: DICT OF INT -> LIST OF INTS expert_map, 
+        1-DIM NUMPY ARRAY classes
+    
+    Maps every patent in expert_table to its experts, listing an expert
+    once per case as in the text/expert join, and returns the sorted 
+    experts as well.
+    '''
+    cur.execute('SELECT pat_num, record FROM ' + expert_table + ';')
+    
+    expert_map = {}
+    for (pat_num, expert) in cur.fetchall():
+        expert_map.setdefault(pat_num, []).append(expert)
+    classes = np.unique([expert for experts in expert_map.values() for 
+                         expert in experts])
+    
+    return expert_map, classes
+
+
+def stream_text (text_table, expert_table, conn, chunk_size=500):
+    '''
+    INPUT: STRING text_table, STRING expert_table, 
+        PSYCOPG2 CONNECTION conn, optional INT chunk_size
+    OUTPUT: GENERATOR OF LISTS OF (INT, STRING) TUPLES chunks
+    
+    Reads the text of every patent that has an expert, once per patent 
+    as in grab_all_text, through a named (server-side) cursor and yields
+    it chunk_size patents at a time, so that no more than one chunk is 
+    ever held in memory.
+    '''
+    cur = conn.cursor(name = 'stream_' + text_table)
+    cur.itersize = chunk_size
+    
+    query = 'SELECT DISTINCT ON (pat_num) pat_num, abstr, claims, descr '
+    query += 'FROM ' + text_table + ' WHERE pat_num IN '
+    query += '(SELECT pat_num FROM ' + expert_table + ') ORDER BY pat_num;'
+    cur.execute(query)
+    
+    try:
+        while True:
+            lines = cur.fetchmany(chunk_size)
+            if not lines:
+                break
+            yield [(line[0], ' '.join(line[1:])) for line in lines]
+    finally:
+        cur.close()
+
+
+def stream_fit (text_table, expert_table, conn, path='naive_bayes.pkl', 
+                chunk_size=500, n_features=2**16):
+    '''
+    INPUT: STRING text_table, STRING expert_table, 
+        PSYCOPG2 CONNECTION conn, optional STRING path, 
+        optional INT chunk_size, optional INT n_features
+    OUTPUT: DICT model
+    
+    Out-of-core version of fit_model for corpora that do not fit in 
+    memory. The text is streamed in chunks (see stream_text), hashed 
+    into n_features columns, which needs no vocabulary, and fed to the 
+    classifier with partial_fit, each patent weighted by its number of 
+    cases per expert as in naive_bayes. Memory is bounded by one chunk 
+    plus the classifier, which keeps dense feature counts and log 
+    probabilities: experts x n_features x 16 bytes, about 470 MB for 446
+    experts at the default n_features (7.5 GB at 2**20). More features 
+    mean fewer hash collisions for a proportionally larger model.
+    
+    The hashed features are l2-normalized term frequencies without idf 
+    weights, which would need a full pass over the corpus first. The 
+    model is saved to path and put in the model store, in the format of
+    fit_model, so that get_model and the predict functions use it as 
+    long as the tables do not change, and refit it with stream_fit when
+    they do.
+    '''
+    cur = conn.cursor()
+    signature = table_signature(text_table, expert_table, cur)
+    expert_map, classes = grab_expert_map(expert_table, cur)
+    class_index = dict((expert, ii) for (ii, expert) in enumerate(classes))
+    
+    hash_vect = HashingVectorizer(stop_words = 'english', 
+                                  n_features = n_features,
+                                  alternate_sign = False)
+    nb_clf = MultinomialNB(class_prior = np.ones(len(classes))/
+                           float(len(classes)))
+    
+    for chunk in stream_text(text_table, expert_table, conn, chunk_size):
+        hash_arr = hash_vect.transform([raw_text for (pat_num, raw_text) 
+                                        in chunk])
+        
+        rows = []
+        labels = []
+        for (ii, (pat_num, raw_text)) in enumerate(chunk):
+            for expert in expert_map[pat_num]:
+                rows.append(ii)
+                labels.append(class_index[expert])
+        pairs = sparse.csr_matrix((np.ones(len(rows)), (rows, labels)), 
+                                  shape=(len(chunk), len(classes))).tocoo()
+        
+        nb_clf.partial_fit(hash_arr[pairs.row], classes[pairs.col], 
+                           classes = classes, sample_weight = pairs.data)
+    
+    model = {'tfidf_vect': hash_vect, 'nb_clf': nb_clf, 
+             'classes': list(nb_clf.classes_), 'signature': signature,
+             'fit': 'stream', 'vectorizer': 'hashing', 
+             'fit_options': {'chunk_size': chunk_size, 
+                             'n_features': n_features}}
+    save_model(model, path)
+    MODEL_STORE[path] = model
+    return model
+
+
+def predict_expert (text_table, expert_table, test_pat, cur, 
+                    model_path=None):
     '''
     INPUT: STRING text_table, STRING test_pat, PSYCOPG2 CURSOR cur,
-        SKLEARN OBJECT tfidf_vect, SKLEARN OBJECT nb_clf,
-        PANDAS DATAFRAME df_text
-    OUTPUT: PANDAS DATAFRAME df_exp
+        optional STRING model_path
+    OUTPUT: LIST OF (INT, FLOAT) TUPLES experts
     
     Uses probabilities for each label given by Naive Bayes to predict
     the experts that are most likely to be a good match for the patent
     test_pat.
+    
+    With model_path, the model fitted on all patents is taken from the 
+    model store (see get_model), so a prediction only costs transforming
+    one document. Without it, the model is refitted with test_pat left 
+    out, as needed for the cost function.
+    
+    The text of test_pat is looked up in text_table and the local text 
+    cache before it is scraped (see text_cache.resolve_text).
     '''
-    t, i, r, abstr, cl, descr = patent_scraper.scrape_patents([test_pat])
-    raw_text = ' '.join([abstr[0], cl[0], descr[0]])
+    raw_text = text_cache.resolve_text([test_pat], text_table, cur)[test_pat]
     
-    tfidf_vect, nb_clf, df_text = naive_bayes(text_table, expert_table, test_pat, cur)
+    if model_path:
+        model = get_model(text_table, expert_table, cur, model_path)
+        (tfidf_vect, nb_clf) = (model['tfidf_vect'], model['nb_clf'])
+    else:
+        tfidf_vect, nb_clf, df_text = naive_bayes(text_table, expert_table, 
+                                                  test_pat, cur)
     
     tfidf_text = tfidf_vect.transform([raw_text])
     # df_exp = pd.DataFrame(nb_clf.classes_, columns=['experts'],
@@ -101,6 +365,184 @@ def predict_expert (text_table, expert_table, test_pat, cur):
     experts.sort(key=lambda x: x[1], reverse=True)
 
     return experts
+
+
+def predict_experts_batch (pat_nums, text_table, expert_table, cur, k=10,
+                           model_path='naive_bayes.pkl', batch_size=1000):
+    '''
+    INPUT: LIST OF INTS pat_nums, STRING text_table, 
+        STRING expert_table, PSYCOPG2 CURSOR cur, optional INT k, 
+        optional STRING model_path, optional INT batch_size
+    OUTPUT: DICT OF INT -> LIST OF (INT, FLOAT) TUPLES experts
+    
+    Predicts the k most likely experts for each of many patents with 
+    the stored model (see get_model). Patents are handled batch_size at 
+    a time: their text is fetched in bulk, transformed in one sparse 
+    matrix and classified in one predict_proba call, and the top k of 
+    each row are picked with argpartition before being sorted.
+    '''
+    model = get_model(text_table, expert_table, cur, model_path)
+    classes = model['nb_clf'].classes_
+    k = min(k, len(classes))
+    
+    experts = {}
+    for start in range(0, len(pat_nums), batch_size):
+        batch = pat_nums[start:start + batch_size]
+        texts = text_cache.resolve_text(batch, text_table, cur)
+        
+        tfidf_arr = model['tfidf_vect'].transform([texts[pat_num] for 
+                                                   pat_num in batch])
+        probs = model['nb_clf'].predict_proba(tfidf_arr)
+        
+        top = np.argpartition(-probs, k - 1, axis=1)[:, :k]
+        for (ii, pat_num) in enumerate(batch):
+            top_ii = top[ii][np.argsort(-probs[ii, top[ii]], kind='mergesort')]
+            experts[pat_num] = [(classes[jj], probs[ii, jj]) for jj in top_ii]
+    
+    return experts
+
+
+def fit_counts (text_table, expert_table, cur, alpha=1.):
+    '''
+    INPUT: STRING text_table, STRING expert_table, PSYCOPG2 CURSOR cur,
+        optional FLOAT alpha
+    OUTPUT: DICT state
+    
+    Counts words once for every patent in the tables, as the starting 
+    point for exact leave-one-out predictions (see loo_probs). Keeps 
+    the raw word counts per patent (in both row and column form), the 
+    weight of each patent in the document frequencies (1, as in 
+    naive_bayes) and the patent-to-expert matrix from grab_experts, 
+    plus per-patent sums of squared and plain counts with and without 
+    the full-corpus idf weights. These sums are all that is needed to 
+    recompute TF-IDF norms when one patent is held out.
+    '''
+    df_text = grab_all_text(text_table, expert_table, cur, None)
+    labels, classes = grab_experts(df_text, expert_table, cur)
+    patents = df_text['pat_num'].values
+    
+    count_vect = CountVectorizer(stop_words = 'english')
+    counts = count_vect.fit_transform(df_text['raw_text'])
+    counts = sparse.csr_matrix(counts, dtype=float)
+    
+    weights = np.ones(patents.shape[0])
+    
+    n_docs = weights.sum()
+    doc_freq = sparse.csr_matrix((counts > 0), dtype=float).T.dot(weights)
+    idf = np.log((1. + n_docs) / (1. + doc_freq)) + 1
+    
+    squares = counts.multiply(counts)
+    state = {'count_vect': count_vect, 'patents': np.asarray(patents), 
+             'pat_index': dict((pat, ii) for (ii, pat) in enumerate(patents)),
+             'counts': counts, 'counts_csc': counts.tocsc(), 
+             'weights': weights, 'labels': labels, 'classes': classes, 
+             'n_docs': n_docs, 'doc_freq': doc_freq, 'idf': idf, 
+             'alpha': alpha,
+             'sq_idf_sq': squares.dot(idf ** 2), 'sq_idf': squares.dot(idf),
+             'sq': np.asarray(squares.sum(axis=1)).ravel(), 
+             'idf_sum': counts.dot(idf), 
+             'count_sum': np.asarray(counts.sum(axis=1)).ravel()}
+    return state
+
+
+def loo_probs (state, test_pat, raw_text=None):
+    '''
+    INPUT: DICT state, INT test_pat, optional STRING raw_text
+    OUTPUT: 1-DIM NUMPY ARRAY classes, 1-DIM NUMPY ARRAY probs
+    
+    Gives the class probabilities that refitting the TF-IDF vectorizer 
+    and MultinomialNB without test_pat (as naive_bayes does) would give
+    for raw_text, or for the stored text of test_pat if raw_text is 
+    None, without refitting. Holding out one patent only lowers the 
+    document count, the document frequencies of its own words and the 
+    class counts. The idf of every other word therefore shifts by the 
+    same amount, so each patent's TF-IDF norm and total weight follow 
+    from its precomputed sums plus a correction over the held-out 
+    patent's words, and feature counts are only needed for the words of
+    the text being classified.
+    '''
+    (counts_csc, labels) = (state['counts_csc'], state['labels'])
+    alpha = state['alpha']
+    
+    keep = np.ones(state['weights'].shape[0])
+    held_out = state['pat_index'].get(test_pat)
+    if held_out is None:
+        (held_terms, held_weight) = (np.array([], dtype=int), 0.)
+    else:
+        held_terms = state['counts'][held_out].indices
+        held_weight = state['weights'][held_out]
+        keep[held_out] = 0.
+    
+    n_docs = state['n_docs'] - held_weight
+    shift = np.log((1. + n_docs) / (1. + state['n_docs']))
+    
+    def new_idf (terms):
+        doc_freq = state['doc_freq'][terms].copy()
+        doc_freq[np.isin(terms, held_terms)] -= held_weight
+        return doc_freq, np.log((1. + n_docs) / (1. + doc_freq)) + 1
+    
+    (held_df, held_idf) = new_idf(held_terms)
+    extra = np.where(held_df > 0, 
+                     held_idf - state['idf'][held_terms] - shift, 0.)
+    base_idf = state['idf'][held_terms] + shift
+    held_counts = counts_csc[:, held_terms]
+    
+    norms = (state['sq_idf_sq'] + 2 * shift * state['sq_idf'] + 
+             shift ** 2 * state['sq'] + 
+             held_counts.multiply(held_counts).dot((base_idf + extra) ** 2 - 
+                                                   base_idf ** 2))
+    norms = np.sqrt(np.maximum(norms, 0))
+    norms[norms == 0] = 1.
+    totals = (state['idf_sum'] + shift * state['count_sum'] + 
+              held_counts.dot(extra))
+    
+    if raw_text is None:
+        text_counts = state['counts'][held_out]
+    else:
+        text_counts = state['count_vect'].transform([raw_text])
+    (terms, values) = (text_counts.indices, text_counts.data)
+    (text_df, text_idf) = new_idf(terms)
+    (terms, values, text_idf) = (terms[text_df > 0], values[text_df > 0],
+                                 text_idf[text_df > 0])
+    
+    n_features = state['idf'].shape[0] - np.sum(held_df <= 0)
+    class_rows = labels.T.dot(keep)
+    scaled_counts = sparse.diags(keep / norms, 0).dot(counts_csc[:, terms])
+    feature_counts = labels.T.dot(scaled_counts).toarray() * text_idf
+    feature_totals = labels.T.dot(keep * totals / norms)
+    
+    log_probs = (np.log(feature_counts + alpha) - 
+                 np.log(feature_totals + alpha * n_features)[:, None])
+    
+    text_tfidf = values * text_idf
+    text_norm = np.sqrt(np.sum(text_tfidf ** 2))
+    if text_norm > 0:
+        text_tfidf = text_tfidf / text_norm
+    
+    present = class_rows > 0
+    joint = log_probs[present].dot(text_tfidf)
+    probs = np.exp(joint - np.logaddexp.reduce(joint))
+    
+    return state['classes'][present], probs
+
+
+def predict_expert_loo (test_pat, state, raw_text=None):
+    '''
+    INPUT: INT test_pat, DICT state, optional STRING raw_text
+    OUTPUT: LIST OF (INT, FLOAT) TUPLES experts
+    
+    Leave-one-out counterpart of predict_expert for the cost function: 
+    ranks experts for test_pat with a model fitted without it, using 
+    loo_probs on the counts in state (see fit_counts) instead of 
+    refitting. Uses the stored text of test_pat unless raw_text is 
+    given.
+    '''
+    classes, probs = loo_probs(state, test_pat, raw_text)
+    
+    experts = [(classes[ii], probs[ii]) for ii in range(len(classes))]
+    experts.sort(key=lambda x: x[1], reverse=True)
+    
+    return experts
         
 
 if __name__ == "__main__":
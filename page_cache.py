@@ -0,0 +1,175 @@
+'''
+On-disk cache of the web pages downloaded by patent_scraper and
+reference_scraper. Each page is stored compressed under the SHA-1 of its
+URL, so the same page is only ever downloaded once whichever scraper (or
+root network) asks for it. Pages older than a maximum age are fetched
+again, the oldest pages are evicted once the cache outgrows its size
+limit, and in offline mode only cached pages are served.
+
+(C) 2014 Erin Burnside
+'''
+
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import zlib
+
+
+# Cache directory, maximum page age in seconds (None to keep pages
+# forever), maximum total size in bytes and offline (cache-only) mode;
+# changed with configure.
+SETTINGS = {'cache_dir': 'page_cache', 'max_age': None,
+            'max_bytes': 2 * 1024**3, 'offline': False}
+
+# Bytes written since the size of the cache was last checked.
+WRITTEN = {'bytes': 0}
+WRITTEN_LOCK = threading.Lock()
+
+
+def configure (cache_dir=None, max_age=None, max_bytes=None, offline=None):
+    '''
+    INPUT: optional STRING cache_dir, optional FLOAT max_age,
+        optional INT max_bytes, optional BOOL offline
+    OUTPUT: NONE
+
+    Changes the settings of the cache that are given (see SETTINGS). A
+    max_age of 0 or less keeps pages forever.
+    '''
+    if cache_dir is not None:
+        SETTINGS['cache_dir'] = cache_dir
+    if max_age is not None:
+        SETTINGS['max_age'] = max_age if max_age > 0 else None
+    if max_bytes is not None:
+        SETTINGS['max_bytes'] = max_bytes
+    if offline is not None:
+        SETTINGS['offline'] = offline
+
+
+def page_path (url):
+    '''
+    INPUT: STRING url
+    OUTPUT: STRING path
+
+    Returns the cache file of url: the hex SHA-1 of the URL, in a
+    subdirectory named after its first two characters.
+    '''
+    digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    return os.path.join(SETTINGS['cache_dir'], digest[:2], digest + '.z')
+
+
+def read_page (url):
+    '''
+    INPUT: STRING url
+    OUTPUT: STRING html
+
+    Returns the cached page of url, or None if it is not cached or is
+    older than the maximum age.
+    '''
+    path = page_path(url)
+    try:
+        age = time.time() - os.path.getmtime(path)
+        if SETTINGS['max_age'] is not None and age > SETTINGS['max_age']:
+            return None
+        f = open(path, 'rb')
+        html = zlib.decompress(f.read()).decode('utf-8')
+        f.close()
+    except (IOError, OSError):
+        return None
+    return html
+
+
+def write_page (url, html):
+    '''
+    INPUT: STRING url, STRING html
+    OUTPUT: NONE
+
+    Compresses html into the cache file of url, writing to a temporary
+    file first so that readers (in any thread) never see a partial page,
+    and evicts old pages once enough has been written to possibly take
+    the cache over its size limit.
+    '''
+    path = page_path(url)
+    if not os.path.isdir(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+
+    data = zlib.compress(html.encode('utf-8'))
+    (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path))
+    os.write(fd, data)
+    os.close(fd)
+    os.rename(tmp_path, path)
+
+    with WRITTEN_LOCK:
+        WRITTEN['bytes'] += len(data)
+        check = WRITTEN['bytes'] > SETTINGS['max_bytes'] // 20
+        if check:
+            WRITTEN['bytes'] = 0
+    if check:
+        evict()
+
+
+def evict (max_bytes=None):
+    '''
+    INPUT: optional INT max_bytes
+    OUTPUT: INT n_evicted
+
+    Deletes the least recently downloaded pages until the cache takes
+    no more than max_bytes (the configured limit if None), and returns
+    how many pages were deleted.
+    '''
+    if max_bytes is None:
+        max_bytes = SETTINGS['max_bytes']
+
+    pages = []
+    for (dir_path, dir_names, file_names) in os.walk(SETTINGS['cache_dir']):
+        for file_name in file_names:
+            if file_name.endswith('.z'):
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                pages.append((stat.st_mtime, stat.st_size, path))
+
+    pages.sort()
+    total = sum(size for (mtime, size, path) in pages)
+    n_evicted = 0
+    for (mtime, size, path) in pages:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        n_evicted += 1
+
+    return n_evicted
+
+
+def get_page (url, fetch):
+    '''
+    INPUT: STRING url, FUNCTION NAME fetch
+    OUTPUT: STRING html, BOOL cached
+
+    Returns the page at url and whether it came from the cache. Pages
+    that are not cached (or too old) are downloaded with fetch(url) and
+    cached; in offline mode an IOError is raised for them instead. fetch
+    must raise for failed downloads (error responses included), so that
+    only good pages are ever cached.
+    '''
+    html = read_page(url)
+    if html is not None:
+        return html, True
+
+    if SETTINGS['offline']:
+        raise IOError('page not in cache (offline mode): ' + url)
+
+    html = fetch(url)
+    write_page(url, html)
+    return html, False
@@ -11,6 +11,8 @@ import time
 import requests
 from bs4 import BeautifulSoup
 
+import page_cache
+
 
 def get_meta (soup_object):
     '''
@@ -50,6 +52,20 @@ def filter_text (raw_text, st_pt, end_pt):
     filt_text = raw_text[(st + len(st_pt)):end]
     return filt_text
 
+
+def download_page (url):
+    '''
+    INPUT: STRING url
+    OUTPUT: STRING html
+    
+    Downloads the page at url, raising requests.HTTPError for an error 
+    response so that it is never cached.
+    '''
+    r = requests.get(url)
+    r.raise_for_status()
+    return r.text
+
+
 def scrape_patents (pat_list):
     '''
     INPUT: LIST OF INTS pat_list
@@ -58,7 +74,9 @@ def scrape_patents (pat_list):
         LIST OF STRINGS claims, LIST OF STRINGS descriptions
     
     Scrapes and formats important data (title, inventor(s), references,
-    abstract, claims, and description) for each patent in pat_list.
+    abstract, claims, and description) for each patent in pat_list. 
+    Pages already in the page cache (see page_cache) are read from disk
+    without waiting between requests.
     '''
     titles = []
     inventors = []
@@ -69,8 +87,8 @@ def scrape_patents (pat_list):
     
     for pn in pat_list:
         url = 'http://www.freepatentsonline.com/' + str(pn) + '.html'
-        r = requests.get(url)
-        soup = BeautifulSoup(r.text)
+        html, cached = page_cache.get_page(url, download_page)
+        soup = BeautifulSoup(html)
     
         meta_fields = get_meta(soup)
         titles += meta_fields[0]
@@ -82,6 +100,7 @@ def scrape_patents (pat_list):
         claims.append(filter_text(raw_text, 'Claims:\n\n', '\n\n\n'))
         descriptions.append(filter_text(raw_text, 'Description:\n\n', '\n\n\n'))
     
-        time.sleep(10)
+        if not cached:
+            time.sleep(10)
         
     return titles, inventors, references, abstracts, claims, descriptions
\ No newline at end of file
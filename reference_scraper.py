@@ -1,18 +1,37 @@
 '''
 Collects patent reference data for creating reference graph. Main 
 function takes a "root" patent (currently will be one that is linked to 
-an expert) and inserts into a SQL table all referencer-referenced patent 
-pairs that are linked to this root.
+an expert) and inserts into the global citations table all 
+referencer-referenced patent pairs that are linked to this root.
 
 (C) 2014 Erin Burnside
 '''
 
 
+from multiprocessing.pool import ThreadPool
+import threading
 import time
+from urlparse import urlparse
 
 import requests
 from bs4 import BeautifulSoup
 import psycopg2
+from psycopg2.extras import execute_values
+
+import citation_graph
+import page_cache
+
+
+# Site crawled for references.
+BASE_URL = 'http://www.freepatentsonline.com/'
+
+# Default requests per second and burst size allowed per host.
+RATE = 2.
+BURST = 2
+
+# Rate limiters keyed by host (see get_bucket), shared by all threads.
+BUCKETS = {}
+BUCKETS_LOCK = threading.Lock()
 
 
 def get_exp_pat_nums (cur):
@@ -29,77 +48,207 @@ def get_exp_pat_nums (cur):
     return pat_nums
 
 
+def create_frontier (conn):
+    '''
+    INPUT: PSYCOPG2 CONNECTION conn
+    OUTPUT: NONE
+
+    Creates the crawl_frontier table, which records for every root the 
+    patents found in its network, the BFS level at which each was found
+    and whether its links are still 'pending' or 'done', indexed so 
+    that the pending patents of a root are found without scanning.
+    '''
+    cur = conn.cursor()
+    query = 'CREATE TABLE IF NOT EXISTS crawl_frontier (root INT, '
+    query += 'pat_num INT, level INT, status TEXT, '
+    query += 'PRIMARY KEY (root, pat_num));'
+    cur.execute(query)
+    query = 'CREATE INDEX IF NOT EXISTS crawl_frontier_status '
+    query += 'ON crawl_frontier (root, status, level);'
+    cur.execute(query)
+    conn.commit()
+
+
+def add_pending (root, pat_nums, level, cur):
+    '''
+    INPUT: INT root, LIST OF INTS pat_nums, INT level, 
+        PSYCOPG2 CURSOR cur
+    OUTPUT: NONE
+
+    Adds pat_nums to the frontier of root as pending at level, leaving 
+    alone any that are already there.
+    '''
+    query = 'INSERT INTO crawl_frontier (root, pat_num, level, status) '
+    query += 'VALUES %s ON CONFLICT DO NOTHING;'
+    execute_values(cur, query, [(root, pat_num, level, 'pending') for 
+                                pat_num in pat_nums], page_size=1000)
+
+
+def mark_completed (root, pat_nums, cur):
+    '''
+    INPUT: INT root, LIST OF INTS pat_nums, PSYCOPG2 CURSOR cur
+    OUTPUT: NONE
+
+    Marks pat_nums as done in the frontier of root.
+    '''
+    query = "UPDATE crawl_frontier SET status = 'done' "
+    query += 'WHERE root = %s AND pat_num = ANY(%s);'
+    cur.execute(query, (root, list(pat_nums)))
+
+
 def get_pending (root, cur):
     '''
     INPUT: INT root, PSYCOPG2 CURSOR cur
-    OUTPUT: LIST OF INTS pending_pats
+    OUTPUT: INT level, SET OF INTS pending_pats
 
-    For instances in which the table has been partially filled, this 
-    determines all patents (stored by patent number in the list 
-    pending_pats) that have been identified as linked to the graph but 
-    that have not yet had these links investigated. 
+    Returns the lowest BFS level of root that still has pending patents
+    and those patents, or (None, empty set) if nothing is pending. 
     '''
-    table_name = 'ref_' + str(root)
-    query = 'SELECT ref_out FROM ' + table_name
-    query += ' WHERE ref_out NOT IN (SELECT ref_in FROM ' + table_name
-    query += ') GROUP BY ref_out;'
-    cur.execute(query)
-    pending_pats = [pending[0] for pending in cur.fetchall()]
-    return pending_pats
+    query = 'SELECT level FROM crawl_frontier '
+    query += "WHERE root = %s AND status = 'pending' ORDER BY level LIMIT 1;"
+    cur.execute(query, (root,))
+    levels = cur.fetchall()
+    if levels == []:
+        return None, set()
+    
+    level = levels[0][0]
+    query = 'SELECT pat_num FROM crawl_frontier '
+    query += "WHERE root = %s AND status = 'pending' AND level = %s;"
+    cur.execute(query, (root, level))
+    pending_pats = set(pending[0] for pending in cur.fetchall())
+    return level, pending_pats
     
 
 def get_completed (root, cur):
     '''
     INPUT: INT root, PSYCOPG2 CURSOR cur
-    OUTPUT: LIST OF INTS completed_pats
+    OUTPUT: SET OF INTS completed_pats
 
-    For instances in which the table has been partially filled, this 
-    determines all patents (stored by patent number in the list 
-    completed_pats) that have been identified as linked to the graph and 
-    had all their links investigated.
+    Returns the patents of the network of root that have had all their 
+    links investigated.
     '''
-    table_name = 'ref_' + str(root)
-    query = 'SELECT ref_in FROM ' + table_name + ' GROUP BY ref_in;'
-    cur.execute(query)
-    completed_pats = [completed[0] for completed in cur.fetchall()]
+    query = 'SELECT pat_num FROM crawl_frontier '
+    query += "WHERE root = %s AND status = 'done';"
+    cur.execute(query, (root,))
+    completed_pats = set(completed[0] for completed in cur.fetchall())
     return completed_pats
 
 
-def get_referencers (pat_num):
+def is_started (root, cur):
     '''
-    INPUT: INT pat_num
-    OUTPUT: LIST OF INTS new_refs 
+    INPUT: INT root, PSYCOPG2 CURSOR cur
+    OUTPUT: BOOL started
 
-    Takes any US patent number and returns the patent numbers of all 
-    other US patents that cite the given one as a reference.
+    Returns whether root has a frontier, i.e. its crawl has started.
     '''
-    url = 'http://www.freepatentsonline.com/'
-    url += 'result.html?sort=relevance&srch=top&query_txt=REFN%2F'
-    url += str(pat_num)
-    url += '&submit=&patents=on'
+    query = 'SELECT 1 FROM crawl_frontier WHERE root = %s LIMIT 1;'
+    cur.execute(query, (root,))
+    return cur.fetchall() != []
+
+
+class TokenBucket (object):
+    '''
+    Token bucket rate limiter shared by the crawler threads. It holds at
+    most burst tokens and gains rate tokens per second; every request 
+    takes one, waiting until it is available if the bucket is empty.
+    '''
+    
+    def __init__ (self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+    
+    def take (self):
+        '''
+        INPUT: NONE
+        OUTPUT: NONE
+        
+        Takes a token, sleeping until the bucket has refilled enough to 
+        cover it. Tokens are reserved under the lock, so that waiting 
+        threads are served in turn at the given rate.
+        '''
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, 
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1.
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+def get_bucket (host, rate=RATE, burst=BURST):
+    '''
+    INPUT: STRING host, optional FLOAT rate, optional INT burst
+    OUTPUT: TOKENBUCKET bucket
+    
+    Returns the rate limiter of host, creating it with the given rate 
+    and burst the first time the host is seen.
+    '''
+    with BUCKETS_LOCK:
+        if host not in BUCKETS:
+            BUCKETS[host] = TokenBucket(rate, burst)
+        return BUCKETS[host]
+
+
+def download_page (url, rate=RATE, burst=BURST):
+    '''
+    INPUT: STRING url, optional FLOAT rate, optional INT burst
+    OUTPUT: STRING html
+    
+    Downloads url once the rate limiter of its host allows it, raising 
+    requests.HTTPError for an error response so that it is never cached.
+    '''
+    get_bucket(urlparse(url).netloc, rate, burst).take()
     r = requests.get(url)
-    soup = BeautifulSoup(r.text)
+    r.raise_for_status()
+    return r.text
+
+
+def fetch_page (url):
+    '''
+    INPUT: STRING url
+    OUTPUT: STRING html
+    
+    Returns the page at url from the page cache (see page_cache), only 
+    downloading it, and so only waiting for the rate limiter, if it is 
+    not cached.
+    '''
+    html, cached = page_cache.get_page(url, download_page)
+    return html
+
+
+def parse_referencers (html):
+    '''
+    INPUT: STRING html
+    OUTPUT: LIST OF INTS new_refs
+    
+    Reads the patent numbers out of a search page listing the patents 
+    that cite a given one.
+    '''
+    soup = BeautifulSoup(html)
 
     new_refs = []
     for td in soup.find_all('td'):
-        if td['width'] == '15%' and td.text[7].isdigit() == True:
+        if td.get('width') == '15%' and td.text[7].isdigit() == True:
             new_ref = int(td.text[7:14])
             new_refs.append(new_ref)
         
     return new_refs
-    
-    
-def get_referenced (pat_num):
-    '''
-    INPUT: INT pat_num
-    OUTPUT: LIST OF INTS new_refs 
 
-    Takes any US patent number and returns the patent numbers of all 
-    other US patents that are cited by that patent as references.
+
+def parse_referenced (html):
     '''
-    url = 'http://www.freepatentsonline.com/' + str(pat_num) + '.html'
-    r = requests.get(url)
-    soup = BeautifulSoup(r.text)    
+    INPUT: STRING html
+    OUTPUT: LIST OF INTS new_refs
+    
+    Reads the US patent references out of the meta tags of a patent 
+    page.
+    '''
+    soup = BeautifulSoup(html)
     
     new_refs = []
     for meta in soup.find_all('meta'):
@@ -111,101 +260,154 @@ def get_referenced (pat_num):
                     meta['content'][2].isdigit() == True):
                 new_refs.append(int(meta['content'][2:]))
     return new_refs
-    
-    
-def add_reference (root, ref_in, ref_out, cur, level):
+
+
+def get_referencers (pat_num, base_url=BASE_URL):
     '''
-    INPUT: INT root, INT ref_in, INT ref_out PSYCOPG2 CURSOR cur
-    OUTPUT: NONE
+    INPUT: INT pat_num, optional STRING base_url
+    OUTPUT: LIST OF INTS new_refs 
 
-    Queries the SQL table with the name "ref_<root>" to insert a row 
-    linking ref_in (the patent doing the referencing) to ref_out (the 
-    patent being referenced).
+    Takes any US patent number and returns the patent numbers of all 
+    other US patents that cite the given one as a reference.
     '''
-    table_name = 'ref_' + str(root)
-    query = 'INSERT INTO ' + table_name 
-    query += ' (ref_in, ref_out, level) VALUES (%s, %s, %s);'
-    cur.execute(query, (ref_in, ref_out, level))
+    url = base_url
+    url += 'result.html?sort=relevance&srch=top&query_txt=REFN%2F'
+    url += str(pat_num)
+    url += '&submit=&patents=on'
+    return parse_referencers(fetch_page(url))
     
     
-def get_one_network(root, conn, cur, completed_pats=[], pending_pats=[],  
-                    level=0, max_level=2):
+def get_referenced (pat_num, base_url=BASE_URL):
     '''
-    INPUT: INT root, LIST OF INTS completed_pats, LIST OF INTS 
-        pending_pats, PSYCOPG2 CONNECTION conn, PSYCOPG2 CURSOR cur
-    OUTPUT: NONE
+    INPUT: INT pat_num, optional STRING base_url
+    OUTPUT: LIST OF INTS new_refs 
 
-    If pending_pats is empty, the root is assumed to be the only pending 
-    patent and added to pending_pat.
+    Takes any US patent number and returns the patent numbers of all 
+    other US patents that are cited by that patent as references.
+    '''
+    url = base_url + str(pat_num) + '.html'
+    return parse_referenced(fetch_page(url))
 
-    The first patent on pending_pats is investigated to find all links 
-    both forwards and backwards. All links are added to the end of 
-    pending_pats, but only forward links are added to the SQL table to 
-    prevent duplication (until max_level is reached, at which point both 
-    forward and backward links are added). 
 
-    The patent being investigated is added to completed_pats, and the 
-    function is called recursively using the updated pending and 
-    completed patent lists.
+def expand_patent (job):
     '''
-    if level > max_level:
-        return
+    INPUT: (INT, STRING) TUPLE job
+    OUTPUT: (LIST OF INTS, LIST OF INTS) TUPLE links
     
-    if pending_pats == []:
-        pending_pats.append(root)
-        print pending_pats
-
-    new_pending_pats = []
+    Run by the crawler threads: fetches both the patents citing the 
+    patent of job (a patent number and base url) and those it cites.
+    '''
+    (pat_num, base_url) = job
+    return (get_referencers(pat_num, base_url), 
+            get_referenced(pat_num, base_url))
     
-    for pat_num in pending_pats:
-        
-        new_refs_in = get_referencers(pat_num)
-        for refi in new_refs_in:
-            if refi not in completed_pats and refi not in pending_pats:
-                new_pending_pats.append(refi)
-                if level == max_level:
-                    add_reference(root, refi, pat_num, cur, level)
-
-        new_refs_out = get_referenced(pat_num)
-        for refo in new_refs_out:
-            add_reference(root, pat_num, refo, cur, level)
-            if refo not in completed_pats and refo not in pending_pats:
-                new_pending_pats.append(refo)
-            conn.commit()
-        
-        completed_pats.append(pending_pats.pop(0))
-        print pat_num, level
-        time.sleep(1)
+    
+def get_one_network (root, conn, cur, max_level=2, n_workers=4, 
+                     chunk_size=50, batch_size=5000, interval=30., 
+                     base_url=BASE_URL):
+    '''
+    INPUT: INT root, PSYCOPG2 CONNECTION conn, PSYCOPG2 CURSOR cur, 
+        optional INT max_level, optional INT n_workers, 
+        optional INT chunk_size, optional INT batch_size, 
+        optional FLOAT interval, optional STRING base_url
+    OUTPUT: NONE
 
-    pending_pats += new_pending_pats
+    Crawls the network of root breadth first, one level at a time, 
+    keeping its state in the crawl_frontier table (see create_frontier).
+    A new crawl starts with the root as the only pending patent; a crawl
+    that was interrupted carries on from its lowest pending level, and 
+    a finished one returns at once.
 
-    if len(pending_pats) != 0:
-        level += 1
-        get_network(root, conn, cur, completed_pats, pending_pats, level)
+    The pending patents of a level are investigated by a pool of 
+    n_workers threads, which find their links both forwards and 
+    backwards while sharing the rate limit of the host (see 
+    fetch_page). Every new patent is pending at the next level, but 
+    only forward links are added to the SQL table to prevent 
+    duplication (until max_level is reached, at which point both 
+    forward and backward links are added). Levels 0 to max_level are 
+    investigated; the new patents linked to the max_level ones are 
+    recorded through those edges, but their own links are not followed.
+    base_url allows crawling a local copy (or stub) of the site.
+    
+    Patents are fetched chunk_size at a time and their edges buffered 
+    (see citation_graph.EdgeWriter). Whenever the buffer holds 
+    batch_size edges, interval seconds have passed or the level is 
+    over, the edges, the new pending patents and the completion of the
+    patents they came from are written and committed together, so a 
+    page whose patent is marked done is never fetched again and no 
+    edge of it is ever lost.
+    '''
+    if not is_started(root, cur):
+        add_pending(root, [root], 0, cur)
+        conn.commit()
+    
+    writer = citation_graph.EdgeWriter(cur, batch_size, interval)
+    pool = ThreadPool(n_workers)
+    try:
+        while True:
+            level, frontier = get_pending(root, cur)
+            if level is None or level > max_level:
+                break
+            known = get_completed(root, cur) | frontier
+            
+            pending = sorted(frontier)
+            done = []
+            new_frontier = set()
+            for start in range(0, len(pending), chunk_size):
+                chunk = pending[start:start + chunk_size]
+                links = pool.map(expand_patent, [(pat_num, base_url) for 
+                                                 pat_num in chunk])
+                
+                for (pat_num, (new_refs_in, new_refs_out)) in zip(chunk, 
+                                                                  links):
+                    for refi in new_refs_in:
+                        if refi not in known:
+                            new_frontier.add(refi)
+                            if level == max_level:
+                                writer.add(refi, pat_num)
+                    for refo in new_refs_out:
+                        writer.add(pat_num, refo)
+                        if refo not in known:
+                            new_frontier.add(refo)
+                done += chunk
+                
+                if writer.due() or start + chunk_size >= len(pending):
+                    writer.flush()
+                    if level < max_level:
+                        add_pending(root, new_frontier, level + 1, cur)
+                    mark_completed(root, done, cur)
+                    conn.commit()
+                    done = []
+                    new_frontier = set()
+    finally:
+        pool.close()
+        pool.join()
     
 
-def get_all_networks (db_name, user, pat_nums=[]):
+def get_all_networks (db_name, user, pat_nums=None):
     '''
-    INPUT: STRING db_name, STRING user, LIST OF INTS pat_nums
+    INPUT: STRING db_name, STRING user, optional LIST OF INTS pat_nums
     OUTPUT: NONE
     
     Scrapes reference networks for all patent numbers listed in pat_nums
-    and inserts them into tables in the specified SQL database. If no
+    and inserts them into the citations table of the specified SQL 
+    database, where networks that overlap share their edges. If no
     patent numbers are specified, will complete for all patents
-    associated with experts.
+    associated with experts. Rerunning after a crash resumes every 
+    network where it stopped (see get_one_network). The citations are 
+    then exported to citations.npz (see citation_graph.export_graph), 
+    where SimRank reads them.
     '''
     conn = psycopg2.connect(database=db_name, user=user)
     cur = conn.cursor()
-    if pat_nums == []:
+    if not pat_nums:
         pat_nums = get_exp_pat_nums(cur)
 
+    citation_graph.create_citations(conn)
+    create_frontier(conn)
     for pat_num in pat_nums:
-        query = 'CREATE TABLE ref_' + str(int(pat_num))
-        query += ' (ref_in INT, ref_out INT, level INT);'
-        cur.execute(query)
-        conn.commit()
-        get_one_network(int(pat_num), conn, cur, completed_pats=[], 
-                        pending_pats=[])
+        get_one_network(int(pat_num), conn, cur)
+    citation_graph.export_graph(conn)
 
     
 if __name__ == '__main__':
@@ -4,17 +4,34 @@ Simulated annealing optimization for parameters in Scott's model.
 (C) 2014 Erin Burnside
 '''
 
-import psycopg2
+import os
+import cPickle
+import functools
+import itertools
 import random
 import math
+import multiprocessing
 import numpy as np
 import cost_function
-import basic_model
+import cpc_features
 
 
-def shift_params (param_num, old_params):
+# Cost function, aggregation function and model of a parallel_tempering
+# worker process, set by init_chain_worker.
+CHAIN_WORKER = {}
+
+# shift_params moves parameters by multiples of STEP_GRID, and costs are
+# memoized on parameters rounded to MEMO_DIGITS decimals, so that 
+# parameters reached again by different moves hit the memo despite 
+# floating point rounding.
+STEP_GRID = 0.001
+MEMO_DIGITS = 6
+
+
+def shift_params (param_num, old_params, verbose=True):
     '''
-    INPUT: INT param_num, LIST OF FLOATS old_params
+    INPUT: INT param_num, LIST OF FLOATS old_params, 
+        optional BOOLEAN verbose
     OUTPUT: LIST OF FLOATS new_params
 
     Randomly selects one of the parameters in list. Chooses an amount 
@@ -23,11 +40,15 @@ def shift_params (param_num, old_params):
     the other end (so amounts less than zero are subtracted from one to 
     obtain the final value, while those greater than 1 are added to 
     zero). Returns the new parameters, which should be identical to the 
-    old ones except for the single changed element.
+    old ones except for the single changed element. The amount is a 
+    multiple of STEP_GRID, so that moves can lead back to parameters 
+    that were already costed. The move is printed unless verbose is 
+    False.
     '''
     ii = random.randint(0, param_num - 1)
-    step = random.uniform(-0.1, 0.1)
-    print ii, step
+    step = round(random.uniform(-0.1, 0.1) / STEP_GRID) * STEP_GRID
+    if verbose:
+        print ii, step
     
     new_params = old_params[:]
     new_params[ii] += step
@@ -39,11 +60,149 @@ def shift_params (param_num, old_params):
     
       
 
+def memo_key (params):
+    '''
+    INPUT: LIST OF FLOATS params
+    OUTPUT: TUPLE OF FLOATS key
+
+    Returns the key of params in a memo: the parameters rounded to 
+    MEMO_DIGITS decimals.
+    '''
+    return tuple(round(param, MEMO_DIGITS) for param in params)
+
+
+def memo_cost (memo, cost_func, params, agg_func, model, memo_log=None):
+    '''
+    INPUT: DICT memo, FUNCTION cost_func, LIST OF FLOATS params, 
+        FUNCTION agg_func, FUNCTION model, optional FILE memo_log
+    OUTPUT: FLOAT cost
+
+    Returns the cost of params, only calling cost_func if the same 
+    parameters (see memo_key) have not been evaluated before. memo maps
+    keys of parameters to their cost. New costs are also appended to 
+    memo_log, if given, as soon as they are known, so that they survive
+    a crash between checkpoints (see load_memo).
+    '''
+    key = memo_key(params)
+    if key not in memo:
+        memo[key] = cost_func(params, agg_func, model)
+        if memo_log is not None:
+            cPickle.dump((key, memo[key]), memo_log, cPickle.HIGHEST_PROTOCOL)
+            memo_log.flush()
+    return memo[key]
+
+
+def load_memo (filename):
+    '''
+    INPUT: STRING filename
+    OUTPUT: DICT memo
+
+    Reads the costs appended to a memo log by memo_cost, stopping at a 
+    record cut short by a crash. Returns an empty memo if there is no 
+    log.
+    '''
+    memo = {}
+    if not os.path.exists(filename):
+        return memo
+
+    f = open(filename, 'rb')
+    while True:
+        try:
+            (key, cost) = cPickle.load(f)
+        except (EOFError, ValueError, cPickle.UnpicklingError):
+            break
+        memo[key] = cost
+    f.close()
+    return memo
+
+
+def save_checkpoint (state, filename, memo_log=None):
+    '''
+    INPUT: DICT state, STRING filename, optional FILE memo_log
+    OUTPUT: NONE
+
+    Pickles the state of an annealing or tempering run together with the
+    state of the random number generator. The file is written under a 
+    temporary name and then renamed, so an interrupted write never 
+    replaces the previous checkpoint. The memo is part of the state, so
+    memo_log is emptied once the checkpoint is in place.
+    '''
+    checkpoint = dict(state)
+    checkpoint['random_state'] = random.getstate()
+
+    f = open(filename + '.tmp', 'wb')
+    cPickle.dump(checkpoint, f, cPickle.HIGHEST_PROTOCOL)
+    f.close()
+    os.rename(filename + '.tmp', filename)
+
+    if memo_log is not None:
+        memo_log.truncate(0)
+
+
+def anneal (state, cost_func, agg_func, model, checkpoint_file=None, 
+            checkpoint_every=10):
+    '''
+    INPUT: DICT state, FUNCTION cost_func, FUNCTION agg_func, 
+        FUNCTION model, optional STRING checkpoint_file, 
+        optional INT checkpoint_every
+    OUTPUT: LIST OF FLOATS old_params
+
+    Annealing loop shared by sim_annealing and resume_annealing. state 
+    holds the temperature, cooling rate, current parameters and cost, 
+    the best parameters and cost seen so far, the step count and the 
+    memo of evaluated parameters. If checkpoint_file is given, state is
+    saved there every checkpoint_every steps and when the run finishes,
+    and every new cost is logged to checkpoint_file + '.memo' in 
+    between (see memo_cost), so that a resumed run pays for no 
+    evaluation twice.
+    '''
+    memo_log = None
+    if checkpoint_file:
+        memo_log = open(checkpoint_file + '.memo', 'ab')
+
+    try:
+        while state['temp'] > 0.1:
+            new_params = shift_params(state['param_num'], state['params'])
+            print new_params
+                
+            new_cost = memo_cost(state['memo'], cost_func, new_params, 
+                                 agg_func, model, memo_log)
+            prob = pow(math.e, (-state['cost']-new_cost) / state['temp'])
+            print prob
+            
+            if (new_cost < state['cost'] or random.random() < prob):
+                state['params'] = new_params
+                state['cost'] = new_cost
+            if state['cost'] < state['best_cost']:
+                state['best_params'] = state['params']
+                state['best_cost'] = state['cost']
+            
+            print state['params']
+            print '\n\n'    
+            state['temp'] = state['temp'] * state['cool']
+            state['step'] += 1
+            
+            if checkpoint_file and state['step'] % checkpoint_every == 0:
+                save_checkpoint(state, checkpoint_file, memo_log)
+
+        if checkpoint_file:
+            save_checkpoint(state, checkpoint_file, memo_log)
+    finally:
+        if memo_log:
+            memo_log.close()
+
+    return state['params']
+
+
 def sim_annealing (param_num, cost_func, agg_func, temp, cool, model, 
-                   old_params=[]):
+                   old_params=[], checkpoint_file=None, checkpoint_every=10,
+                   memo=None):
     '''
     INPUT: INT param_num, FUNCTION cost_func, FUNCTON agg_func, 
-        INT temp, FLOAT cool
+        INT temp, FLOAT cool, FUNCTION model, 
+        optional LIST OF FLOATS old_params, 
+        optional STRING checkpoint_file, optional INT checkpoint_every,
+        optional DICT memo
     OUTPUT: LIST OF FLOATS old_params
 
     Creates a list of parameters between 0 and 1 of param_num length. 
@@ -55,36 +214,503 @@ def sim_annealing (param_num, cost_func, agg_func, temp, cool, model,
     decreases with temperature. Temperature is decreased, and the 
     parameters continue to be shifted until temperature reaches a very 
     low value (<0.1).
+
+    Costs are looked up in memo (see memo_cost) before cost_func is 
+    called; pass the memo of an earlier run to reuse its evaluations. 
+    If checkpoint_file is given, the run is checkpointed at the start 
+    and every checkpoint_every steps, and can be continued with 
+    resume_annealing.
     '''
     if old_params == []:
         old_params = [random.random() for ii in range(param_num)]
         print old_params
         print '\n\n'
+    if memo is None:
+        memo = {}
         
-    old_cost = cost_func(old_params, agg_func, model)
+    old_cost = memo_cost(memo, cost_func, old_params, agg_func, model)
     
-    while temp > 0.1:
-        new_params = shift_params(param_num, old_params)
-        print new_params
-            
-        new_cost = cost_func(new_params, agg_func, model)
-        prob = pow(math.e, (-old_cost-new_cost) / temp)
-        print prob
-        
-        if (new_cost < old_cost or random.random() < prob):
-            old_params = new_params
-            old_cost = new_cost
-        
-        print old_params
-        print '\n\n'    
-        temp = temp * cool
+    state = {'param_num': param_num, 'temp': temp, 'cool': cool, 
+             'params': old_params, 'cost': old_cost, 
+             'best_params': old_params, 'best_cost': old_cost, 'step': 0,
+             'memo': memo}
+    if checkpoint_file:
+        save_checkpoint(state, checkpoint_file)
+    
+    return anneal(state, cost_func, agg_func, model, checkpoint_file, 
+                  checkpoint_every)
+
+
+def load_checkpoint (filename):
+    '''
+    INPUT: STRING filename
+    OUTPUT: DICT state
+
+    Reads a checkpoint written by save_checkpoint and restores the 
+    random number generator to where the run left off.
+    '''
+    f = open(filename, 'rb')
+    state = cPickle.load(f)
+    f.close()
+
+    random.setstate(state.pop('random_state'))
+    return state
+
+
+def resume_annealing (checkpoint_file, cost_func, agg_func, model, 
+                      checkpoint_every=10):
+    '''
+    INPUT: STRING checkpoint_file, FUNCTION cost_func, 
+        FUNCTION agg_func, FUNCTION model, optional INT checkpoint_every
+    OUTPUT: LIST OF FLOATS old_params
+
+    Continues a sim_annealing run from its last checkpoint, keeping the
+    same checkpoint file. Costs logged after the checkpoint (see anneal)
+    are added to the memo, so the steps replayed from the checkpoint do 
+    not call cost_func again. The best parameters and cost of the whole
+    run can be read back with load_checkpoint once it has finished.
+    '''
+    state = load_checkpoint(checkpoint_file)
+    state['memo'].update(load_memo(checkpoint_file + '.memo'))
+    
+    return anneal(state, cost_func, agg_func, model, checkpoint_file, 
+                  checkpoint_every)
+    
+
+def init_chain_worker (cost_func, agg_func, model):
+    '''
+    INPUT: FUNCTION cost_func, FUNCTION agg_func, FUNCTION model
+    OUTPUT: NONE
+
+    Run once in each worker process of parallel_tempering so that the
+    cost function, aggregation function and model (which may be a large
+    object such as precomputed features) are only sent to each worker 
+    once rather than with every set of parameters.
+    '''
+    CHAIN_WORKER['cost_func'] = cost_func
+    CHAIN_WORKER['agg_func'] = agg_func
+    CHAIN_WORKER['model'] = model
+
+
+def evaluate_params (params):
+    '''
+    INPUT: LIST OF FLOATS params
+    OUTPUT: FLOAT cost
+
+    Computes the cost of params with the worker's cost function.
+    '''
+    return CHAIN_WORKER['cost_func'](params, CHAIN_WORKER['agg_func'], 
+                                     CHAIN_WORKER['model'])
+
+
+def accept_move (old_cost, new_cost, temp):
+    '''
+    INPUT: FLOAT old_cost, FLOAT new_cost, FLOAT temp
+    OUTPUT: BOOLEAN accept
+
+    Metropolis rule: always accepts an improvement, and accepts a worse
+    cost with probability exp(-(new_cost - old_cost) / temp).
+    '''
+    if new_cost <= old_cost:
+        return True
+    return random.random() < math.exp((old_cost - new_cost) / temp)
+
+
+def accept_swap (cost_1, cost_2, temp_1, temp_2):
+    '''
+    INPUT: FLOAT cost_1, FLOAT cost_2, FLOAT temp_1, FLOAT temp_2
+    OUTPUT: BOOLEAN accept
+
+    Parallel tempering rule for exchanging the states of two chains 
+    running at temperatures temp_1 and temp_2.
+    '''
+    delta = (1. / temp_1 - 1. / temp_2) * (cost_1 - cost_2)
+    if delta >= 0:
+        return True
+    return random.random() < math.exp(delta)
 
-    return old_params
+
+def memo_map (memo, map_func, params_list, memo_log=None):
+    '''
+    INPUT: DICT memo, FUNCTION map_func, LIST OF LISTS OF FLOATS 
+        params_list, optional FILE memo_log
+    OUTPUT: LIST OF FLOATS costs
+
+    Like memo_cost for several sets of parameters at once: only the 
+    ones missing from memo are costed, with a single map_func call over
+    evaluate_params, and their costs are added to memo and memo_log as 
+    they come in, so map_func should be lazy (itertools.imap or 
+    Pool.imap). Returns the costs in the order of params_list.
+    '''
+    keys = [memo_key(params) for params in params_list]
+    new_keys = []
+    new_params = []
+    for (key, params) in zip(keys, params_list):
+        if key not in memo and key not in new_keys:
+            new_keys.append(key)
+            new_params.append(params)
+
+    costs = map_func(evaluate_params, new_params)
+    for (key, cost) in itertools.izip(new_keys, costs):
+        memo[key] = cost
+        if memo_log is not None:
+            cPickle.dump((key, cost), memo_log, cPickle.HIGHEST_PROTOCOL)
+            memo_log.flush()
+    return [memo[key] for key in keys]
+
+
+def temper (state, cost_func, agg_func, model, processes=None, 
+            checkpoint_file=None, checkpoint_every=10):
+    '''
+    INPUT: DICT state, FUNCTION cost_func, FUNCTION agg_func, 
+        FUNCTION model, optional INT processes, 
+        optional STRING checkpoint_file, optional INT checkpoint_every
+    OUTPUT: LIST OF FLOATS best_params, FLOAT best_cost, 
+        LIST OF TUPLES history
+
+    Tempering loop shared by parallel_tempering and resume_tempering, 
+    the counterpart of anneal. state holds the temperature, parameters 
+    and cost of each chain, the best parameters and cost seen so far, 
+    the step count, the memo of evaluated parameters and the history of
+    (step, chain costs, best cost) after each step. Checkpoints and the
+    memo log work as in anneal.
+    '''
+    if processes is None:
+        processes = len(state['chain_params'])
+
+    init_chain_worker(cost_func, agg_func, model)
+    pool = None
+    if processes != 1:
+        pool = multiprocessing.Pool(processes, init_chain_worker, 
+                                    (cost_func, agg_func, model))
+    map_func = pool.imap if pool else itertools.imap
+
+    memo_log = None
+    if checkpoint_file:
+        memo_log = open(checkpoint_file + '.memo', 'ab')
+
+    n_chains = len(state['chain_params'])
+    chain_params = state['chain_params']
+    chain_costs = state['chain_costs']
+    try:
+        while state['temps'][0] > 0.1:
+            proposals = [shift_params(state['param_num'], params, False) 
+                         for params in chain_params]
+            new_costs = memo_map(state['memo'], map_func, proposals, 
+                                 memo_log)
+
+            for ii in range(n_chains):
+                if accept_move(chain_costs[ii], new_costs[ii], 
+                               state['temps'][ii]):
+                    chain_params[ii] = proposals[ii]
+                    chain_costs[ii] = new_costs[ii]
+                if chain_costs[ii] < state['best_cost']:
+                    state['best_params'] = chain_params[ii][:]
+                    state['best_cost'] = chain_costs[ii]
+
+            state['step'] += 1
+            step = state['step']
+            swap_every = state['swap_every']
+            if step % swap_every == 0:
+                for ii in range((step // swap_every) % 2, n_chains - 1, 2):
+                    if accept_swap(chain_costs[ii], chain_costs[ii + 1], 
+                                   state['temps'][ii], 
+                                   state['temps'][ii + 1]):
+                        (chain_params[ii], chain_params[ii + 1]) = \
+                            (chain_params[ii + 1], chain_params[ii])
+                        (chain_costs[ii], chain_costs[ii + 1]) = \
+                            (chain_costs[ii + 1], chain_costs[ii])
+
+            state['history'].append((step, chain_costs[:], 
+                                     state['best_cost']))
+            state['temps'] = [t * state['cool'] for t in state['temps']]
+
+            if checkpoint_file and step % checkpoint_every == 0:
+                save_checkpoint(state, checkpoint_file, memo_log)
+
+        if checkpoint_file:
+            save_checkpoint(state, checkpoint_file, memo_log)
+    finally:
+        if memo_log:
+            memo_log.close()
+        if pool:
+            pool.close()
+            pool.join()
+
+    return state['best_params'], state['best_cost'], state['history']
+
+
+def parallel_tempering (param_num, cost_func, agg_func, temp, cool, model, 
+                        n_chains=4, ladder=2., swap_every=10, 
+                        processes=None, seed=None, init_params=None, 
+                        checkpoint_file=None, checkpoint_every=10, 
+                        memo=None):
+    '''
+    INPUT: INT param_num, FUNCTION cost_func, FUNCTION agg_func, 
+        INT temp, FLOAT cool, FUNCTION model, optional INT n_chains, 
+        optional FLOAT ladder, optional INT swap_every, 
+        optional INT processes, optional INT seed, 
+        optional LIST OF LISTS OF FLOATS init_params, 
+        optional STRING checkpoint_file, optional INT checkpoint_every,
+        optional DICT memo
+    OUTPUT: LIST OF FLOATS best_params, FLOAT best_cost, 
+        LIST OF TUPLES history
+
+    Runs n_chains annealing chains side by side. Chain ii starts at 
+    temperature temp * ladder**ii and every chain cools by cool each 
+    step until the coldest one reaches 0.1, as in sim_annealing. At 
+    each step every chain proposes one shift_params move, and the 
+    proposals are costed in parallel by a pool of processes (n_chains 
+    of them unless processes is given; 1 runs in this process). Every 
+    swap_every steps neighbouring chains try to exchange states, which 
+    lets good parameters found at high temperatures move down the 
+    ladder. With ladder=1 the chains are simply independent restarts.
+    Proposals and acceptances are drawn here, so a seed makes the run 
+    reproducible. cost_func and model must be picklable when processes 
+    is not 1.
+
+    As in sim_annealing, proposals already in memo are not costed again,
+    and with a checkpoint_file the run can be continued with 
+    resume_tempering. Nothing is printed; returns the best parameters 
+    seen by any chain, their cost, and the progress of the run as a 
+    list of (step, chain costs, best cost) tuples.
+    '''
+    if seed is not None:
+        random.seed(seed)
+    if memo is None:
+        memo = {}
+
+    if init_params is None:
+        init_params = [[random.random() for ii in range(param_num)] for 
+                       jj in range(n_chains)]
+    chain_params = [params[:] for params in init_params]
+
+    init_chain_worker(cost_func, agg_func, model)
+    chain_costs = memo_map(memo, itertools.imap, chain_params)
+    best = min(range(n_chains), key=lambda ii: chain_costs[ii])
+
+    state = {'param_num': param_num, 'cool': cool, 
+             'temps': [temp * pow(ladder, ii) for ii in range(n_chains)], 
+             'swap_every': swap_every, 'chain_params': chain_params, 
+             'chain_costs': chain_costs, 
+             'best_params': chain_params[best][:], 
+             'best_cost': chain_costs[best], 'step': 0, 'memo': memo, 
+             'history': []}
+    if checkpoint_file:
+        save_checkpoint(state, checkpoint_file)
+
+    return temper(state, cost_func, agg_func, model, processes, 
+                  checkpoint_file, checkpoint_every)
+
+
+def resume_tempering (checkpoint_file, cost_func, agg_func, model, 
+                      processes=None, checkpoint_every=10):
+    '''
+    INPUT: STRING checkpoint_file, FUNCTION cost_func, 
+        FUNCTION agg_func, FUNCTION model, optional INT processes, 
+        optional INT checkpoint_every
+    OUTPUT: LIST OF FLOATS best_params, FLOAT best_cost, 
+        LIST OF TUPLES history
+
+    Continues a parallel_tempering run from its last checkpoint, as 
+    resume_annealing does for sim_annealing.
+    '''
+    state = load_checkpoint(checkpoint_file)
+    state['memo'].update(load_memo(checkpoint_file + '.memo'))
+
+    return temper(state, cost_func, agg_func, model, processes, 
+                  checkpoint_file, checkpoint_every)
+    
+
+class TargetReached(Exception):
+    '''
+    Raised by tracked_cost once the target cost has been reached, to 
+    stop an optimizer early.
+    '''
+    pass
+
+
+def tracked_cost (tracker, params, agg_func, model):
+    '''
+    INPUT: DICT tracker, LIST OF FLOATS params, FUNCTION agg_func, 
+        FUNCTION model
+    OUTPUT: FLOAT cost
+
+    Calls tracker['cost_func'] and records the evaluation in tracker: 
+    the number of evaluations, the cost of each one, the best 
+    parameters and cost so far, and the number of evaluations it took 
+    to first reach tracker['target_cost']. Raises TargetReached at that
+    point if tracker['stop_at_target'] is set. Bind tracker with 
+    functools.partial to get a cost function for any optimizer.
+    '''
+    cost = tracker['cost_func'](params, agg_func, model)
+    
+    tracker['evaluations'] += 1
+    tracker['history'].append(cost)
+    if tracker['best_cost'] is None or cost < tracker['best_cost']:
+        tracker['best_params'] = params[:]
+        tracker['best_cost'] = cost
+    
+    target = tracker['target_cost']
+    if (target is not None and cost <= target and 
+            tracker['evals_to_target'] is None):
+        tracker['evals_to_target'] = tracker['evaluations']
+        if tracker['stop_at_target']:
+            raise TargetReached()
+    
+    return cost
+
+
+def line_search (cost_func, agg_func, model, params, ii, cost, grid=5, 
+                 refine=4):
+    '''
+    INPUT: FUNCTION cost_func, FUNCTION agg_func, FUNCTION model, 
+        LIST OF FLOATS params, INT ii, FLOAT cost, optional INT grid, 
+        optional INT refine
+    OUTPUT: LIST OF FLOATS best_params, FLOAT best_cost
+
+    Searches for a better value of parameter ii in [0, 1] with the 
+    others held fixed: tries grid evenly spaced values, then narrows in
+    on the best of them with refine steps of golden-section search. 
+    Each step keeps one interior point of the previous one, so the 
+    search costs grid + refine + 1 evaluations (grid if refine is 0).
+    The cost is piecewise constant in each parameter, so the grid is 
+    what finds the right step; the golden-section steps only refine it.
+    Returns params unchanged unless a strictly lower cost was found.
+    '''
+    def cost_at (value):
+        trial = params[:]
+        trial[ii] = value
+        return cost_func(trial, agg_func, model)
+
+    values = [(jj + 0.5) / grid for jj in range(grid)]
+    costs = [cost_at(value) for value in values]
+    best = min(range(grid), key=lambda jj: costs[jj])
+
+    if refine > 0:
+        (lo, hi) = (max(values[best] - 1. / grid, 0.), 
+                    min(values[best] + 1. / grid, 1.))
+        ratio = (math.sqrt(5) - 1) / 2
+        (left, right) = (hi - ratio * (hi - lo), lo + ratio * (hi - lo))
+        (left_cost, right_cost) = (cost_at(left), cost_at(right))
+        values += [left, right]
+        costs += [left_cost, right_cost]
+        for step in range(refine - 1):
+            if left_cost <= right_cost:
+                (hi, right, right_cost) = (right, left, left_cost)
+                left = hi - ratio * (hi - lo)
+                left_cost = cost_at(left)
+                values.append(left)
+                costs.append(left_cost)
+            else:
+                (lo, left, left_cost) = (left, right, right_cost)
+                right = lo + ratio * (hi - lo)
+                right_cost = cost_at(right)
+                values.append(right)
+                costs.append(right_cost)
+
+    best = min(range(len(values)), key=lambda jj: costs[jj])
+    (best_value, best_cost) = (values[best], costs[best])
+
+    if best_cost < cost:
+        new_params = params[:]
+        new_params[ii] = best_value
+        return new_params, best_cost
+    return params, cost
+
+
+def coordinate_descent (param_num, cost_func, agg_func, model, 
+                        init_params=None, sweeps=5, grid=5, refine=4):
+    '''
+    INPUT: INT param_num, FUNCTION cost_func, FUNCTION agg_func, 
+        FUNCTION model, optional LIST OF FLOATS init_params, 
+        optional INT sweeps, optional INT grid, optional INT refine
+    OUTPUT: LIST OF FLOATS params, FLOAT cost
+
+    Improves one parameter at a time with line_search, cycling through 
+    all of them up to sweeps times or until a whole sweep brings no 
+    improvement. Each parameter costs grid + refine + 1 evaluations per
+    sweep (see line_search): with the defaults and 17 parameters that 
+    is 170 per sweep, and at most 851 for the whole run including the 
+    starting cost. For comparison, anneal_strategy with its defaults 
+    makes at most 226 (225 steps and the starting cost), so coordinate 
+    descent is not cheaper per run; it spends its evaluations on every
+    parameter in turn instead of on random moves.
+    '''
+    if init_params is None:
+        init_params = [random.random() for ii in range(param_num)]
+    params = init_params[:]
+    cost = cost_func(params, agg_func, model)
+
+    for sweep in range(sweeps):
+        old_cost = cost
+        for ii in range(param_num):
+            params, cost = line_search(cost_func, agg_func, model, params, 
+                                       ii, cost, grid, refine)
+        if cost >= old_cost:
+            break
+
+    return params, cost
+
+
+def anneal_strategy (param_num, cost_func, agg_func, model, temp=10000, 
+                     cool=0.95, init_params=None, **options):
+    '''
+    INPUT: INT param_num, FUNCTION cost_func, FUNCTION agg_func, 
+        FUNCTION model, optional INT temp, optional FLOAT cool, 
+        optional LIST OF FLOATS init_params
+    OUTPUT: LIST OF FLOATS params, FLOAT cost
+
+    sim_annealing wrapped in the optimizer interface. Any other options 
+    are passed on to sim_annealing.
+    '''
+    memo = options.pop('memo', {})
+    params = sim_annealing(param_num, cost_func, agg_func, temp, cool, 
+                           model, init_params or [], memo=memo, **options)
+    return params, memo_cost(memo, cost_func, params, agg_func, model)
+
+
+# Optimizers usable with optimize. Each takes param_num, cost_func, 
+# agg_func and model followed by its own keyword options.
+OPTIMIZERS = {'anneal': anneal_strategy, 
+              'coordinate': coordinate_descent}
+
+
+def optimize (strategy, param_num, cost_func, agg_func, model, 
+              target_cost=None, stop_at_target=False, **options):
+    '''
+    INPUT: STRING strategy, INT param_num, FUNCTION cost_func, 
+        FUNCTION agg_func, FUNCTION model, optional FLOAT target_cost, 
+        optional BOOLEAN stop_at_target
+    OUTPUT: LIST OF FLOATS best_params, FLOAT best_cost, DICT tracker
+
+    Runs the optimizer registered in OPTIMIZERS under strategy with the
+    given options, counting every call of cost_func (see tracked_cost).
+    Returns the best parameters and cost seen during the run and the 
+    tracker, whose 'evaluations', 'history' and 'evals_to_target' 
+    entries allow strategies to be compared by how many expensive 
+    evaluations they need.
+    '''
+    tracker = {'cost_func': cost_func, 'target_cost': target_cost, 
+               'stop_at_target': stop_at_target, 'evaluations': 0, 
+               'history': [], 'best_params': None, 'best_cost': None, 
+               'evals_to_target': None}
+    
+    try:
+        OPTIMIZERS[strategy](param_num, 
+                             functools.partial(tracked_cost, tracker), 
+                             agg_func, model, **options)
+    except TargetReached:
+        pass
+    
+    return tracker['best_params'], tracker['best_cost'], tracker
     
     
 if __name__ == "__main__":
-    print sim_annealing (17, cost_function.cost_function, np.mean, 10000, 
-                         0.95, basic_model.predict_expert)
+    features = cpc_features.load_features('cpc_features.npz')
+    print sim_annealing (17, cost_function.feature_cost_function, np.mean, 
+                         10000, 0.95, features, 
+                         checkpoint_file='sim_anneal.pkl')
     
     
 '''
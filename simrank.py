@@ -10,50 +10,83 @@ idea applies to citation of patents.
 
 
 import cPickle
+import heapq
+from cStringIO import StringIO
 
-import pandas as pd
 import numpy as np
+from scipy import sparse
 import psycopg2
 
+import citation_graph
+import reference_scraper
+import simrank_index
 
-def get_edge_list (root, conn):
+
+# Experts of every patent in CSR form, set by get_root_experts.
+ROOT_EXPERTS = {}
+
+
+def get_edge_list (root, graph=None):
     '''
-    INPUT: INT root, PSYCOPG2 CONNECTION conn
+    INPUT: INT root, optional DICT graph
     OUTPUT: PANDAS DATAFRAME edge_df
     
-    Creates a Pandas dataframe of all the edges in the specified SQL 
-    database.
+    Creates a Pandas dataframe of all the edges in the network of root,
+    pulled from the global citation store (see citation_graph). graph 
+    defaults to the one exported to citations.npz.
     '''
-    query = 'SELECT * FROM ref_' + str(root) + ';'
-    
-    edge_df = pd.io.sql.read_frame(query, conn)
-    return edge_df
+    if graph is None:
+        graph = citation_graph.get_graph()
+    return citation_graph.subgraph_edges(graph, root)
 
 
-def find_w (root, conn):
+def find_w (root, graph=None):
     '''
-    INPUT: INT root, PSYCOPG2 CONNECTION conn
-    OUTPUT: 2-DIM NUMPY ARRAY w, 2-DIM NUMPY ARRAY pat_arr
+    INPUT: INT root, optional DICT graph
+    OUTPUT: SCIPY SPARSE MATRIX w, 1-DIM NUMPY ARRAY pat_arr
     
     Uses the edge list to find the n x n matrix w used for the matrix-
-    based implementation of SimRank.
-    '''
-    edge_df = get_edge_list(root, conn)
-    pat_arr = np.unique(np.append(edge_df['ref_in'], edge_df['ref_out']))
-
-    w = np.zeros((pat_arr.shape[0], pat_arr.shape[0]))
-    for ii in range(pat_arr.shape[0]):
-        print ii
-        ii_edge_df = edge_df[edge_df['ref_in'] == pat_arr[ii]]['ref_out']
-        for jj in range(pat_arr.shape[0]):
-            if pat_arr[jj] in [pat_num for pat_num in ii_edge_df]:
-                jj_edge_df = edge_df[edge_df['ref_out'] == pat_arr[jj]]
-                w[ii][jj] = 1. / jj_edge_df.shape[0]
-                print w[ii][jj]
-                    
+    based implementation of SimRank, as a sparse CSR matrix. Patent 
+    numbers are replaced by their positions in the sorted pat_arr; 
+    w[ii][jj] is nonzero when patent ii references patent jj and holds 
+    one over the number of edges into jj. Raises ValueError if root is 
+    not in the graph (see root_position).
+    '''
+    edge_df = get_edge_list(root, graph)
+    n_edges = edge_df.shape[0]
+    
+    pat_arr, codes = np.unique(np.append(edge_df['ref_in'], 
+                                         edge_df['ref_out']), 
+                               return_inverse=True)
+    n_pats = pat_arr.shape[0]
+    in_counts = np.bincount(codes[n_edges:], minlength=n_pats)
+    
+    edges = np.unique(codes[:n_edges] * n_pats + codes[n_edges:])
+    (rows, cols) = (edges // n_pats, edges % n_pats)
+    w = sparse.csr_matrix((1. / in_counts[cols], (rows, cols)), 
+                          shape=(n_pats, n_pats))
+    root_position(pat_arr, root)
+
     return w, pat_arr
 
 
+def root_position (pat_arr, root):
+    '''
+    INPUT: 1-DIM NUMPY ARRAY pat_arr, INT root
+    OUTPUT: INT root_index
+    
+    Returns the position of root in the sorted pat_arr of its network, 
+    raising ValueError if it is not there, which means the exported 
+    citation graph has no citations of root (see 
+    citation_graph.export_graph).
+    '''
+    root_index = np.searchsorted(pat_arr, root)
+    if root_index == pat_arr.shape[0] or pat_arr[root_index] != root:
+        raise ValueError('patent %d is not in the citation graph; crawl '
+                         'it and export the graph again' % root)
+    return root_index
+
+
 def pickle_arr (sr_arr, filename):
     '''
     INPUT: 2-DIM NUMPY ARRAY s, STRING filename
@@ -63,117 +96,427 @@ def pickle_arr (sr_arr, filename):
     mid-SimRank if necessary.
     '''
     f = open(filename, 'wb')
-    cPickle.dump(sr_arr, f)
+    cPickle.dump(sr_arr, f, cPickle.HIGHEST_PROTOCOL)
     f.close()
 
 
-def add_col (root, conn):
+def save_matrix (s, pat_arr, root):
     '''
-    INPUT: INT root, PSYCOPG2 CONNECTION conn
+    INPUT: 2-DIM NUMPY ARRAY s, 1-DIM NUMPY ARRAY pat_arr, INT root
     OUTPUT: NONE
     
-    Adds a column to the simrank table corresponding to the root patent.
+    Writes the full SimRank matrix of root and its patents to 
+    s<root>.npz in binary, for update_simrank to start from.
+    '''
+    np.savez('s' + str(root) + '.npz', s=s, pat_arr=pat_arr)
+
+
+def load_matrix (root):
+    '''
+    INPUT: INT root
+    OUTPUT: 2-DIM NUMPY ARRAY s, 1-DIM NUMPY ARRAY pat_arr
+    
+    Reads a matrix written by save_matrix.
+    '''
+    npz = np.load('s' + str(root) + '.npz')
+    return npz['s'], npz['pat_arr']
+
+
+def carry_over (s_old, old_pat_arr, pat_arr):
+    '''
+    INPUT: 2-DIM NUMPY ARRAY s_old, 1-DIM NUMPY ARRAY old_pat_arr,
+        1-DIM NUMPY ARRAY pat_arr
+    OUTPUT: 2-DIM NUMPY ARRAY s_init
+    
+    Maps the scores of s_old, over the patents of old_pat_arr, onto the
+    patents of pat_arr. Patents that are new start out similar only to 
+    themselves, and patents that are gone are dropped.
+    '''
+    s_init = np.identity(pat_arr.shape[0])
+    kept = np.isin(old_pat_arr, pat_arr)
+    old_ids = np.nonzero(kept)[0]
+    new_ids = np.searchsorted(pat_arr, old_pat_arr[kept])
+    s_init[np.ix_(new_ids, new_ids)] = s_old[np.ix_(old_ids, old_ids)]
+    return s_init
+
+
+def create_scores_table (conn):
+    '''
+    INPUT: PSYCOPG2 CONNECTION conn
+    OUTPUT: NONE
+    
+    Creates the simrank_scores table, which holds one (root, pat_num, 
+    score) row per nonzero score, with an index on pat_num for looking 
+    up every root scored against a patent.
     '''
     cur = conn.cursor()
-    query = 'ALTER TABLE simrank ADD '
-    query += '%s NUMERIC DEFAULT 0;' % ('pat_' + str(root),)
+    query = 'CREATE TABLE IF NOT EXISTS simrank_scores (root INT, '
+    query += 'pat_num INT, score DOUBLE PRECISION, '
+    query += 'PRIMARY KEY (root, pat_num));'
+    cur.execute(query)
+    query = 'CREATE INDEX IF NOT EXISTS simrank_scores_pat_num '
+    query += 'ON simrank_scores (pat_num);'
     cur.execute(query)
-    conn.commit()   
+    conn.commit()
 
 
-def add_row (conn, pat_num):
+def migrate_simrank_table (conn):
     '''
-    INPUT: PSYCOPG2 CONNECTION conn, 2-DIM NUMPY ARRAY pat_arr, INT ii
-    OUTPUT: NONE
+    INPUT: PSYCOPG2 CONNECTION conn
+    OUTPUT: INT n_roots
     
-    Adds row for
+    Copies the nonzero scores of every pat_<root> column of the old, 
+    wide simrank table into simrank_scores and returns the number of 
+    roots copied. The simrank table itself is left in place.
     '''
+    create_scores_table(conn)
     cur = conn.cursor()
-    query1 = 'SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS' 
-    query1 += " WHERE table_name = 'simrank';"
-    cur.execute(query1)
-    new_row = tuple([pat_num] + [0 for ii in range(cur.fetchall()[0][0] - 1)])
-    query2 = 'INSERT INTO simrank VALUES ' + str(new_row) + ';'
-    cur.execute(query2)
-    conn.commit() 
+    query = "SELECT column_name FROM information_schema.columns "
+    query += "WHERE table_name = 'simrank' AND column_name LIKE 'pat\\_%';"
+    cur.execute(query)
+    columns = [column[0] for column in cur.fetchall()]
+    
+    for column in columns:
+        query = 'INSERT INTO simrank_scores (root, pat_num, score) '
+        query += 'SELECT %s, pat_num, ' + column + ' FROM simrank '
+        query += 'WHERE ' + column + ' != 0 ON CONFLICT DO NOTHING;'
+        cur.execute(query, (int(column[4:]),))
+    conn.commit()
+    
+    return len(columns)
 
 
-def insert_scores (s, root, pat_arr, conn):
+def insert_scores (scores, root, pat_arr, conn):
     '''
-    INPUT: 2-DIM NUMPY ARRAY s, 2-DIM NUMPY ARRAY pat_arr, INT root,
+    INPUT: 1-DIM NUMPY ARRAY scores, INT root, 1-DIM NUMPY ARRAY pat_arr,
          PSYCOPG2 CONNECTION conn
     OUTPUT: NONE
     
-    Pulls final scores from s matrix and inserts into SQL for future 
-    retrieval.
+    Inserts the nonzero scores of the patents in pat_arr against the 
+    root into SQL for future retrieval, replacing any earlier scores of
+    the root. All rows go in with a single COPY, in one transaction.
     '''
-    root_index = np.where(pat_arr == root)[0]
     cur = conn.cursor()
-    for (ii, score) in enumerate(s[root_index][0]):
-        pat_num = pat_arr[ii]
-        if score != 0:
-            query1 = 'SELECT * FROM simrank WHERE pat_num = ' 
-            query1 += str(pat_num) + ';'
-            cur.execute(query1)
-            if cur.fetchall() == []:
-                add_row(conn, pat_num)
-            query2 = 'UPDATE simrank SET pat_' + str(root)
-            query2 += ' = %s WHERE pat_num = %s;'
-            cur.execute(query2, (score, pat_num))
-            conn.commit()
-
-
-def simrank (root, conn, c, w=None):
-    '''
-    INPUT: INT root, PSYCOPG2 CONNECTION conn, INT c
-    OUTPUT: NONE
+    cur.execute('DELETE FROM simrank_scores WHERE root = %s;', (int(root),))
+    
+    rows = StringIO()
+    for ii in np.nonzero(scores)[0]:
+        rows.write('%d\t%d\t%r\n' % (root, pat_arr[ii], float(scores[ii])))
+    rows.seek(0)
+    cur.copy_from(rows, 'simrank_scores', 
+                  columns=('root', 'pat_num', 'score'))
+    conn.commit()
+
+
+def iterate_simrank (w, c, s_init=None, tol=1e-6, max_iter=100):
+    '''
+    INPUT: SCIPY SPARSE MATRIX w, INT c, optional 2-DIM NUMPY ARRAY 
+        s_init, optional FLOAT tol, optional INT max_iter
+    OUTPUT: 2-DIM NUMPY ARRAY s, INT n_iter
+    
+    Iterates the full n x n SimRank matrix, s = c w^T s w with ones on 
+    the diagonal, starting from s_init (the identity if None) until no 
+    score changes by more than tol in one iteration or after max_iter 
+    iterations, and returns the scores and the number of iterations.
+    '''
+    if s_init is None:
+        s_init = np.identity(w.shape[0])
+    
+    s_new = s_init
+    for n_iter in range(1, max_iter + 1):
+        s_old = s_new
+        # (c w^T s_old) w, with both products taken sparse-by-dense
+        s_new = c * w.T.dot(w.T.dot(s_old).T).T
+        np.fill_diagonal(s_new, 1)
+        if np.abs(s_new - s_old).max() < tol:
+            break
+    
+    return s_new, n_iter
+
+
+def diagonal_correction (w, c, n_walks=100, walk_len=10, n_sweeps=20, 
+                         seed=0, block_size=1000):
+    '''
+    INPUT: SCIPY SPARSE MATRIX w, INT c, optional INT n_walks, 
+        optional INT walk_len, optional INT n_sweeps, optional INT seed,
+        optional INT block_size
+    OUTPUT: 1-DIM NUMPY ARRAY diag
+    
+    Estimates the diagonal d for which the linearized SimRank s = c w^T 
+    s w + d has ones on its diagonal, which makes it equal to the 
+    SimRank of iterate_simrank. The diagonal of s is a linear function 
+    of d: s_kk = sum over t and jj of c^t d_jj p_t(k, jj)^2, where 
+    p_t(k, jj) is the chance that a walk following citations backwards 
+    from k (the columns of w) is at jj after t steps. Each squared 
+    chance is estimated without bias from the pairs of n_walks random 
+    walks of walk_len steps from k that meet there, and d is then found
+    with up to n_sweeps Jacobi sweeps.
+    
+    Walks are run for block_size patents at a time, so memory stays 
+    linear in the size of the network. The error of each score falls as
+    one over the square root of n_walks.
+    '''
+    n_pats = w.shape[0]
+    citers = w.T.tocsr()
+    (indptr, indices) = (citers.indptr, citers.indices)
+    random_state = np.random.RandomState(seed)
+    n_pairs = float(n_walks * (n_walks - 1))
+    
+    rows = [np.arange(n_pats)]
+    cols = [np.arange(n_pats)]
+    values = [np.ones(n_pats)]
+    for start in range(0, n_pats, block_size):
+        origins = np.repeat(np.arange(start, min(start + block_size, 
+                                                 n_pats)), n_walks)
+        nodes = origins
+        for step in range(1, walk_len + 1):
+            degrees = indptr[nodes + 1] - indptr[nodes]
+            moving = degrees > 0
+            (origins, nodes, degrees) = (origins[moving], nodes[moving], 
+                                         degrees[moving])
+            if nodes.shape[0] == 0:
+                break
+            picks = (random_state.random_sample(nodes.shape[0]) * 
+                     degrees).astype(np.int64)
+            nodes = indices[indptr[nodes] + picks]
+            
+            keys, counts = np.unique(origins * n_pats + nodes, 
+                                     return_counts=True)
+            met = counts > 1
+            rows.append(keys[met] // n_pats)
+            cols.append(keys[met] % n_pats)
+            values.append(c ** step * counts[met] * (counts[met] - 1.) / 
+                          n_pairs)
+    
+    a = sparse.csr_matrix((np.concatenate(values), 
+                           (np.concatenate(rows), np.concatenate(cols))), 
+                          shape=(n_pats, n_pats))
+    a_diag = a.diagonal()
+    diag = np.empty(n_pats)
+    diag.fill(1. - c)
+    for sweep in range(n_sweeps):
+        change = (1. - a.dot(diag)) / a_diag
+        diag += change
+        if np.abs(change).max() < 1e-12:
+            break
+    
+    return diag
+
+
+def single_source (w, root_index, c, tol=1e-6, max_iter=100, diag=None):
+    '''
+    INPUT: SCIPY SPARSE MATRIX w, INT root_index, INT c, 
+        optional FLOAT tol, optional INT max_iter, 
+        optional 1-DIM NUMPY ARRAY diag
+    OUTPUT: 1-DIM NUMPY ARRAY scores, INT n_iter
+    
+    Computes only the root's row of SimRank, with the linearized 
+    formulation s = c w^T s w + d, where the diagonal correction d is 
+    diag, estimated by diagonal_correction if None so that the scores 
+    are on the scale of iterate_simrank (the root scores 1 with itself).
+    The row is the series sum over t of c^t (w^T)^t d w^t e_root, 
+    evaluated from the inside out, so it takes 2 sparse matrix-vector 
+    products per term and never an n x n matrix.
+    
+    The series is cut once a term is smaller than tol, or after max_iter
+    terms past the first. Each column of w sums to at most 1, so term t
+    is at most c^t times the largest entries of d and of w^t e_root. 
+    Returns the scores and the number of terms used past the first.
+    '''
+    if diag is None:
+        diag = diagonal_correction(w, c)
+    
+    walk = np.zeros(w.shape[0])
+    walk[root_index] = 1.
+    walks = [walk]
+    
+    residual = diag.max()
+    while len(walks) <= max_iter and residual >= tol:
+        walks.append(w.dot(walks[-1]))
+        residual = (diag.max() * c ** (len(walks) - 1) * 
+                    np.abs(walks[-1]).max())
+    n_iter = len(walks) - 1
+    
+    scores = diag * walks.pop()
+    while walks:
+        scores = diag * walks.pop() + c * w.T.dot(scores)
+    
+    return scores, n_iter
+
+
+def simrank (root, conn, c, w=None, pat_arr=None, single=False, 
+             graph=None, tol=1e-6, max_iter=100, save=False):
+    '''
+    INPUT: INT root, PSYCOPG2 CONNECTION conn, INT c, 
+        optional SCIPY SPARSE MATRIX w, optional 1-DIM NUMPY ARRAY pat_arr,
+        optional BOOL single, optional DICT graph, optional FLOAT tol, 
+        optional INT max_iter, optional BOOL save
+    OUTPUT: INT n_iter
     
     Complete calculated of SimRank for a specified root patent with 
-    reference network already present in SQL.
+    reference network already in the global citation store. A w and 
+    pat_arr from an earlier find_w can be passed in to skip building 
+    them again, and graph to use a graph other than the exported one 
+    (see get_edge_list). Returns the number of iterations needed to 
+    converge to tol (at most max_iter).
+    
+    By default the full n x n similarity matrix is iterated (see 
+    iterate_simrank), which needs memory quadratic in the size of the 
+    network. With save, it is written out with pat_arr (see 
+    save_matrix) so that update_simrank can start from it. With single,
+    only the root's scores are computed (see single_source), in memory 
+    linear in the size of the network.
+    They are on the same scale as those of the full matrix, up to the 
+    sampling error of the diagonal correction, so roots scored either 
+    way can be compared in predict_expert. Raises ValueError if root is
+    not in the graph or in pat_arr (see root_position).
     '''
-    if not w:
-        w, pat_arr = find_w(root, conn)
+    if w is None:
+        w, pat_arr = find_w(root, graph)
         pickle_arr(w, 'w' + str(root) + '.pkl')
+    root_index = root_position(pat_arr, root)
     
-    s_new = np.identity(w.shape[0])
-    for ii in range(10):
-        s_old = s_new
-        s_new = np.dot(np.dot(c * w.T,s_old),w)
-        for jj in range(s_new.shape[0]):
-            s_new[jj][jj] = 1
+    if single:
+        scores, n_iter = single_source(w, root_index, c, tol, max_iter)
+    else:
+        s, n_iter = iterate_simrank(w, c, None, tol, max_iter)
+        if save:
+            save_matrix(s, pat_arr, root)
+        scores = s[root_index]
     
-    add_col(root, conn)
-    insert_scores(s_new, root, pat_arr, conn)
+    create_scores_table(conn)
+    insert_scores(scores, root, pat_arr, conn)
+    return n_iter
+
+
+def update_simrank (root, conn, c, graph=None, tol=1e-6, max_iter=100):
+    '''
+    INPUT: INT root, PSYCOPG2 CONNECTION conn, INT c, 
+        optional DICT graph, optional FLOAT tol, optional INT max_iter
+    OUTPUT: INT n_iter
+    
+    Warm-started version of simrank for a root whose network has gained
+    edges since its matrix was saved (see simrank with save). This is 
+    not an incremental update: the saved matrix is carried over to the 
+    new network (see carry_over) and full dense iterations continue 
+    from there to tol. When only a few edges changed, the carried-over 
+    matrix is already close to the new fixed point, so fewer iterations
+    are needed than from the identity. The new matrix is saved in turn.
+    Returns the number of iterations.
+    '''
+    (s_old, old_pat_arr) = load_matrix(root)
     
+    w, pat_arr = find_w(root, graph)
+    root_index = root_position(pat_arr, root)
+    pickle_arr(w, 'w' + str(root) + '.pkl')
+    
+    s_init = carry_over(s_old, old_pat_arr, pat_arr)
+    s, n_iter = iterate_simrank(w, c, s_init, tol, max_iter)
+    save_matrix(s, pat_arr, root)
+    
+    create_scores_table(conn)
+    insert_scores(s[root_index], root, pat_arr, conn)
+    return n_iter
+
 
-def predict_expert (pat_num, conn):
+def load_root_experts (cur):
+    '''
+    INPUT: PSYCOPG2 CURSOR cur
+    OUTPUT: DICT root_experts
+    
+    Reads the experts of every patent into CSR form: the experts of 
+    roots[ii] are labels[expert_ids[indptr[ii]:indptr[ii + 1]]].
+    '''
+    cur.execute('SELECT pat_num, record FROM experts;')
+    pairs = np.unique(np.array(cur.fetchall(), dtype=np.int64).reshape(-1, 2),
+                      axis=0)
+    
+    roots, root_ids = np.unique(pairs[:, 0], return_inverse=True)
+    labels, expert_ids = np.unique(pairs[:, 1], return_inverse=True)
+    indptr = np.searchsorted(root_ids, np.arange(roots.shape[0] + 1))
+    
+    root_experts = {'roots': roots, 'indptr': indptr, 
+                    'expert_ids': expert_ids, 'labels': labels}
+    return root_experts
+
+
+def get_root_experts (cur, refresh=False):
+    '''
+    INPUT: PSYCOPG2 CURSOR cur, optional BOOL refresh
+    OUTPUT: DICT root_experts
+    
+    Returns the experts of every patent (see load_root_experts), reading
+    them from SQL only the first time (or again if refresh is set).
+    '''
+    if refresh or 'roots' not in ROOT_EXPERTS:
+        ROOT_EXPERTS.update(load_root_experts(cur))
+    return ROOT_EXPERTS
+
+
+def predict_expert (pat_num, conn, k=None, index_path=None, nbrs=None):
+    '''
+    INPUT: INT pat_num, PSYCOPG2 CONNECTION conn, optional INT k,
+        optional STRING index_path, optional LIST OF INTS nbrs
+    OUTPUT: LIST OF (INT, FLOAT) TUPLES experts
+    
+    Scores each expert by the highest SimRank score between pat_num and
+    any root patent of the expert and returns the k best experts (all 
+    of them if k is None) sorted by score. Experts with no scored root 
+    are left out.
+    
+    The scores of pat_num are read with one indexed query; the experts 
+    of each root come from the in-memory mapping of get_root_experts, 
+    and the maximum per expert is taken in one np.maximum.at call.
+    
+    If pat_num has no stored scores (it was never in the network of a 
+    root) and index_path is given, its scores against the expert 
+    patents are estimated from the Monte Carlo index at index_path 
+    instead (see simrank_index). A brand-new patent is cited by nobody,
+    so it can only be placed in the graph through its own references: 
+    with an index built with references, nbrs are taken as those 
+    references, and fetched with reference_scraper.get_referenced if 
+    not given. Such an index scores forward-reference similarity, so 
+    its scores rank the experts of pat_num among themselves but are 
+    not on the scale of the stored (backward) scores.
+    '''
     cur = conn.cursor()
-    query = "SELECT column_name FROM information_schema.columns "
-    query += "WHERE table_name = 'simrank';"
-    cur.execute(query)
-    col_names = cur.fetchall()
-    col_names.remove(col_names[0])
-        
-    query = 'SELECT * FROM simrank WHERE pat_num = ' + str(pat_num) + ';'
-    cur.execute(query)
-    scores = list(cur.fetchall()[0])
-    scores.remove(scores[0])
-    
-    pat_scores = [(int(col_names[ii][0][4:]), float(score)) for 
-                  (ii, score) in enumerate(scores)]
-    
-    experts_dict = {}
-    for (pat_num, score) in pat_scores:
-        query = 'SELECT record FROM experts WHERE pat_num = ' 
-        query += str(pat_num) + ';'
-        cur.execute(query)
-        new_experts = [(int(expert[0]), score) for expert in cur.fetchall()]
-        for (expert, score) in new_experts:
-            if expert not in experts_dict or experts_dict[expert] < score:
-                experts_dict[expert] = score
-                
-    experts = experts_dict.items()
-    experts.sort(key=lambda x: x[1], reverse=True)
+    root_experts = get_root_experts(cur)
+    query = 'SELECT root, score FROM simrank_scores WHERE pat_num = %s;'
+    cur.execute(query, (int(pat_num),))
+    rows = np.array(cur.fetchall(), dtype=float).reshape(-1, 2)
+    
+    if rows.shape[0] == 0 and index_path:
+        index = simrank_index.get_index(index_path)
+        if nbrs is None and bool(index['references']):
+            nbrs = reference_scraper.get_referenced(pat_num)
+        (pat_nums, scores) = simrank_index.similar_patents(index, pat_num, 
+                                                           nbrs)
+        rows = np.column_stack((pat_nums, scores)).astype(float)
+    
+    roots = root_experts['roots']
+    indptr = root_experts['indptr']
+    root_ids = np.searchsorted(roots, rows[:, 0].astype(np.int64))
+    root_ids = np.minimum(root_ids, roots.shape[0] - 1)
+    found = roots[root_ids] == rows[:, 0]
+    (root_ids, root_scores) = (root_ids[found], rows[found, 1])
+    
+    n_experts = indptr[root_ids + 1] - indptr[root_ids]
+    offsets = np.repeat(indptr[root_ids] - np.cumsum(n_experts) + n_experts,
+                        n_experts)
+    expert_ids = root_experts['expert_ids'][offsets + 
+                                            np.arange(n_experts.sum())]
+    
+    best = np.empty(root_experts['labels'].shape[0])
+    best.fill(-np.inf)
+    np.maximum.at(best, expert_ids, np.repeat(root_scores, n_experts))
+    
+    scored = np.nonzero(best > -np.inf)[0]
+    experts = [(int(root_experts['labels'][ii]), float(best[ii])) for 
+               ii in scored]
+    if k is None:
+        experts.sort(key=lambda x: x[1], reverse=True)
+    else:
+        experts = heapq.nlargest(k, experts, key=lambda x: x[1])
     
     return experts
     
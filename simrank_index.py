@@ -0,0 +1,325 @@
+'''
+Monte Carlo SimRank over the global citation graph (see citation_graph).
+The SimRank score of two patents equals the expected value of c^t, where
+t is the first step at which two random walks started from them reach
+the same patent. Walks follow citations backwards (to the citing
+patents), as in simrank, or with references forwards (to the cited
+patents), scoring two patents as similar when they cite similar
+patents; the index built below is of the latter kind, so that brand-new
+patents can be queried, and its scores are not comparable to the
+backward scores stored in simrank_scores. Walks are made to coalesce
+(and so to meet at all) by choosing every step with a hash of the walk,
+step and patent instead of fresh random numbers, so that any two walks
+at the same patent at the same step move on together.
+
+The walks of the expert patents are computed once and stored as an index
+sorted by position, while the walks of a query patent are generated on
+the fly. Its similarity to every expert patent is then found with one
+binary search per walk and step, whether or not the query was ever a
+SimRank root (see simrank.simrank) and even if it is not in the graph,
+as long as its neighbors are known. The number of walks trades accuracy
+(the error falls as one over its square root) against the size of the
+index, and the walk length truncates the series at c^walk_len.
+
+(C) 2014 Erin Burnside
+'''
+
+
+import heapq
+
+import numpy as np
+import psycopg2
+
+import citation_graph
+
+
+# Indexes loaded from disk keyed by their path (see get_index).
+INDEXES = {}
+
+# Constants of the splitmix64 mixing function used by walk_hash.
+GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+MIX_2 = np.uint64(0x94D049BB133111EB)
+PRIME = np.uint64(1000003)
+
+
+def walk_hash (seed, walks, step, pat_nums):
+    '''
+    INPUT: INT seed, 1-DIM NUMPY ARRAY walks, INT step,
+        1-DIM NUMPY ARRAY pat_nums
+    OUTPUT: 1-DIM NUMPY ARRAY hashes
+
+    Returns a pseudo-random 64-bit hash of (seed, walk, step, patent)
+    for each pair of walks (or a single walk) and pat_nums. The same 
+    arguments always give the same hash, which is what makes walks 
+    meeting at a patent continue together.
+    '''
+    key = np.uint64(seed) * PRIME + np.asarray(walks).astype(np.uint64)
+    key = key * PRIME + np.uint64(step)
+    x = np.asarray(pat_nums).astype(np.uint64) ^ key
+    x = x + GOLDEN
+    x = (x ^ (x >> np.uint64(30))) * MIX_1
+    x = (x ^ (x >> np.uint64(27))) * MIX_2
+    return x ^ (x >> np.uint64(31))
+
+
+def walk_step (index, nodes, walks, step):
+    '''
+    INPUT: DICT index, 1-DIM NUMPY ARRAY nodes, 1-DIM NUMPY ARRAY walks,
+        INT step
+    OUTPUT: 1-DIM NUMPY ARRAY next_nodes
+
+    Moves walks at nodes (positions in pat_arr, -1 for walks that have
+    ended) one step along the graph of index, to a neighbor picked by
+    walk_hash; walks is the number of each walk (or of all of them). 
+    Walks at patents without neighbors end.
+    '''
+    indptr = index['indptr']
+    walks = np.broadcast_to(walks, nodes.shape)
+    next_nodes = np.empty(nodes.shape[0], dtype=np.int64)
+    next_nodes.fill(-1)
+
+    moving = nodes >= 0
+    moving[moving] = indptr[nodes[moving] + 1] > indptr[nodes[moving]]
+    live_nodes = nodes[moving]
+    degrees = indptr[live_nodes + 1] - indptr[live_nodes]
+
+    hashes = walk_hash(int(index['seed']), walks[moving], step,
+                       index['pat_arr'][live_nodes])
+    picks = (hashes % degrees.astype(np.uint64)).astype(np.int64)
+    next_nodes[moving] = index['indices'][indptr[live_nodes] + picks]
+
+    return next_nodes
+
+
+def build_index (graph, pat_nums, n_walks=100, walk_len=10, c=0.8, seed=0,
+                 references=False):
+    '''
+    INPUT: DICT graph, LIST OF INTS pat_nums, optional INT n_walks,
+        optional INT walk_len, optional FLOAT c, optional INT seed,
+        optional BOOL references
+    OUTPUT: DICT index
+
+    Runs n_walks coalescing walks of walk_len steps from each of
+    pat_nums that is in graph (normally the expert patents). For every
+    walk and step, the positions reached are stored sorted as keys 
+    (walk, step, position) flattened into one integer (sorted_keys), 
+    together with the patents they came from (order), so that the 
+    patents at any position at any step of any walk can be found by 
+    binary search over the whole index. Walks follow citations 
+    backwards (to the patents citing the current one), as in simrank; 
+    with references they follow them forwards instead, which lets 
+    brand-new patents, cited by nobody yet, be queried through their 
+    own references.
+    '''
+    pat_arr = graph['pat_arr']
+    pat_nums = np.intersect1d(pat_nums, pat_arr)
+    direction = 'out' if references else 'in'
+
+    index = {'pat_arr': pat_arr,
+             'indptr': graph[direction + '_indptr'],
+             'indices': graph[direction + '_indices'],
+             'pat_nums': pat_nums,
+             'n_walks': np.array(n_walks), 'walk_len': np.array(walk_len),
+             'c': np.array(c), 'seed': np.array(seed),
+             'references': np.array(references)}
+
+    shape = (n_walks, walk_len + 1, pat_nums.shape[0])
+    order = np.empty(shape, dtype=np.int32)
+    sorted_keys = np.empty(shape, dtype=np.int64)
+    for walk in range(n_walks):
+        nodes = np.searchsorted(pat_arr, pat_nums)
+        for step in range(walk_len + 1):
+            if step > 0:
+                nodes = walk_step(index, nodes, walk, step)
+            order[walk, step] = np.argsort(nodes, kind='mergesort')
+            sorted_keys[walk, step] = walk_keys(index, walk, step, 
+                                                nodes[order[walk, step]])
+
+    index['order'] = order
+    index['sorted_keys'] = sorted_keys
+    return index
+
+
+def walk_keys (index, walks, steps, nodes):
+    '''
+    INPUT: DICT index, 1-DIM NUMPY ARRAY walks, 1-DIM NUMPY ARRAY steps,
+        1-DIM NUMPY ARRAY nodes
+    OUTPUT: 1-DIM NUMPY ARRAY keys
+
+    Flattens (walk, step, position) triples into integers that sort in 
+    the same order as the triples (positions of ended walks, -1, first).
+    '''
+    n_nodes = index['pat_arr'].shape[0] + 1
+    n_steps = int(index['walk_len']) + 1
+    return (np.asarray(walks, dtype=np.int64) * n_steps + steps) * n_nodes \
+        + nodes + 1
+
+
+def save_index (index, filename):
+    '''
+    INPUT: DICT index, STRING filename
+    OUTPUT: NONE
+
+    Writes index to a compressed .npz file.
+    '''
+    np.savez_compressed(filename, **index)
+
+
+def load_index (filename):
+    '''
+    INPUT: STRING filename
+    OUTPUT: DICT index
+
+    Reads an index written by save_index.
+    '''
+    npz = np.load(filename)
+    return dict((key, npz[key]) for key in npz.files)
+
+
+def get_index (filename='simrank_index.npz', refresh=False):
+    '''
+    INPUT: optional STRING filename, optional BOOL refresh
+    OUTPUT: DICT index
+
+    Returns the index stored at filename, loading it only the first time
+    (or again if refresh is set).
+    '''
+    if refresh or filename not in INDEXES:
+        INDEXES[filename] = load_index(filename)
+    return INDEXES[filename]
+
+
+def query_walks (index, pat_num, nbrs=None):
+    '''
+    INPUT: DICT index, INT pat_num, optional LIST OF INTS nbrs
+    OUTPUT: 2-DIM NUMPY ARRAY positions
+
+    Runs the walks of pat_num on the fly, returning the position (in
+    pat_arr, -1 once a walk has ended) of each walk (rows) at each step
+    (columns). A patent that is not in the graph has nothing at step 0;
+    its first step is picked among nbrs, the patent numbers of its
+    neighbors in the direction of the index, exactly as it would be if
+    the patent were in the graph.
+    '''
+    pat_arr = index['pat_arr']
+    n_walks = int(index['n_walks'])
+    walk_len = int(index['walk_len'])
+    walks = np.arange(n_walks)
+
+    positions = np.empty((n_walks, walk_len + 1), dtype=np.int64)
+    positions.fill(-1)
+    start = np.searchsorted(pat_arr, pat_num)
+    if start < pat_arr.shape[0] and pat_arr[start] == pat_num:
+        positions[:, 0] = start
+        first_step = 1
+    elif nbrs is not None and len(nbrs) > 0:
+        nbrs = np.sort(nbrs)
+        picks = walk_hash(int(index['seed']), walks, 1, pat_num)
+        picks = nbrs[(picks % np.uint64(nbrs.shape[0])).astype(np.int64)]
+        nodes = np.minimum(np.searchsorted(pat_arr, picks), 
+                           pat_arr.shape[0] - 1)
+        positions[:, 1] = np.where(pat_arr[nodes] == picks, nodes, -1)
+        first_step = 2
+    else:
+        return positions
+
+    for step in range(first_step, walk_len + 1):
+        positions[:, step] = walk_step(index, positions[:, step - 1], 
+                                       walks, step)
+
+    return positions
+
+
+def meeting_scores (index, positions):
+    '''
+    INPUT: DICT index, 2-DIM NUMPY ARRAY positions
+    OUTPUT: 1-DIM NUMPY ARRAY pat_ids, 1-DIM NUMPY ARRAY scores
+
+    Estimates the SimRank score of the walks in positions (see
+    query_walks) against every indexed patent they meet, as the average
+    over walks of c^t for the first step t at which they meet. Walks 
+    that meet stay together, so this takes one binary search of the 
+    index per walk and step. Returns the positions of those patents in
+    the index's pat_nums and their scores.
+    '''
+    (walks, steps) = np.nonzero(positions >= 0)
+    keys = walk_keys(index, walks, steps, positions[walks, steps])
+    sorted_keys = index['sorted_keys'].ravel()
+    lo = np.searchsorted(sorted_keys, keys)
+    n_found = np.searchsorted(sorted_keys, keys, 'right') - lo
+    
+    found = np.repeat(lo - np.cumsum(n_found) + n_found, n_found)
+    found += np.arange(n_found.sum())
+    walks = np.repeat(walks, n_found)
+    steps = np.repeat(steps, n_found)
+    pat_ids = index['order'].ravel()[found]
+
+    n_pats = index['pat_nums'].shape[0]
+    keys = walks * n_pats + pat_ids
+    first = np.lexsort((steps, keys))
+    first = first[np.unique(keys[first], return_index=True)[1]]
+
+    pat_ids, pat_codes = np.unique(pat_ids[first], return_inverse=True)
+    scores = np.bincount(pat_codes, float(index['c']) ** steps[first])
+    return pat_ids, scores / int(index['n_walks'])
+
+
+def similar_patents (index, pat_num, nbrs=None):
+    '''
+    INPUT: DICT index, INT pat_num, optional LIST OF INTS nbrs
+    OUTPUT: 1-DIM NUMPY ARRAY pat_nums, 1-DIM NUMPY ARRAY scores
+
+    Returns every indexed patent with a nonzero estimated SimRank score
+    against pat_num, and the scores (see query_walks for nbrs).
+    '''
+    positions = query_walks(index, pat_num, nbrs)
+    pat_ids, scores = meeting_scores(index, positions)
+    return index['pat_nums'][pat_ids], scores
+
+
+def top_similar (index, pat_num, k=10, nbrs=None):
+    '''
+    INPUT: DICT index, INT pat_num, optional INT k,
+        optional LIST OF INTS nbrs
+    OUTPUT: LIST OF (INT, FLOAT) TUPLES similar
+
+    Returns the k indexed patents most similar to pat_num, best first.
+    '''
+    pat_nums, scores = similar_patents(index, pat_num, nbrs)
+    similar = [(int(pat), float(score)) for (pat, score) in
+               zip(pat_nums, scores)]
+    return heapq.nlargest(k, similar, key=lambda x: x[1])
+
+
+def pair_similarity (index, pat_1, pat_2, nbrs_1=None, nbrs_2=None):
+    '''
+    INPUT: DICT index, INT pat_1, INT pat_2, optional LIST OF INTS
+        nbrs_1, optional LIST OF INTS nbrs_2
+    OUTPUT: FLOAT score
+
+    Estimates the SimRank score of any two patents by running the walks
+    of both on the fly.
+    '''
+    if pat_1 == pat_2:
+        return 1.
+
+    positions_1 = query_walks(index, pat_1, nbrs_1)
+    positions_2 = query_walks(index, pat_2, nbrs_2)
+    met = (positions_1 == positions_2) & (positions_1 >= 0)
+
+    met_walks = met.any(axis=1)
+    first_steps = met.argmax(axis=1)[met_walks]
+    score = np.sum(float(index['c']) ** first_steps)
+    return score / int(index['n_walks'])
+
+
+if __name__ == "__main__":
+    conn = psycopg2.connect(database='patents', user='postgres')
+    cur = conn.cursor()
+    cur.execute('SELECT pat_num FROM experts GROUP BY pat_num;')
+    exp_pats = [pat_num[0] for pat_num in cur.fetchall()]
+
+    graph = citation_graph.get_graph('citations.npz')
+    save_index(build_index(graph, exp_pats, references=True), 
+               'simrank_index.npz')
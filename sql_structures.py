@@ -30,6 +30,9 @@ into usable SQL tables in the 'patents' database. These tables will include:
 * 'levels' : A table with all CPC codes in order and the "level" of each 
     code. The level indicates how granular the code is intended to be 
     and which codes are considered subsets of other codes.
+* 'table_versions' : A table with the version of 'experts' and 
+    'patent_text', bumped by triggers on every change to them so that 
+    models fitted on the tables know when to refit (see table_versions).
 
 (C) 2014 Erin Burnside
 '''
@@ -40,6 +43,7 @@ import psycopg2
 import csv
 from sqlalchemy import create_engine
 import patent_scraper
+import table_versions
 
 
 def add_to_cpcs (data_file, cutoff):
@@ -107,10 +111,25 @@ def add_to_experts (ctp_data_file, etc_data_file, engine):
     df.drop('case', axis=1, inplace=True)
     
     df.to_sql('experts', engine)
+    track_versions(['experts'], engine)
     
     return df_ctp
     
 
+def track_versions (table_names, engine):
+    '''
+    INPUT: LIST OF STRINGS table_names, SQLALCHEMY ENGINE engine
+    OUTPUT: NONE
+
+    Sets up the triggers that bump the version of the newly created 
+    tables on every later change (see table_versions.track_tables), so 
+    that models fitted on them are refitted.
+    '''
+    conn = engine.raw_connection()
+    table_versions.track_tables(table_names, conn)
+    conn.close()
+    
+
 def use_scraper(df, pat_column):
     '''
     INPUT: PANDAS DATAFRAME df, STRING pat_column
@@ -156,6 +175,7 @@ def add_pat_text_tables(df, pat_column, engine):
     
     df_text = df[['pat_num','titles','abstr','claims','descr']]
     df_text.to_sql('patent_text', engine)
+    track_versions(['patent_text'], engine)
     
     create_one_to_many(df, 'pat_num', 'inventors').to_sql('inventors', engine)
     create_one_to_many(df, 'pat_num', 'refs').to_sql('references', engine)
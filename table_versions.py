@@ -0,0 +1,108 @@
+'''
+Change markers for SQL tables. A statement-level trigger on every tracked
+table bumps its version in the table_versions table whenever an INSERT,
+UPDATE, DELETE or TRUNCATE touches it, in the same transaction as the
+change and whichever program makes it, so anything derived from the
+table (such as the fitted naive_bayes model) can tell whether it is
+stale with one primary key lookup instead of scanning the table. The
+versions table and the triggers are set up once with track_tables.
+
+(C) 2014 Erin Burnside
+'''
+
+
+import psycopg2
+
+
+def create_versions (cur):
+    '''
+    INPUT: PSYCOPG2 CURSOR cur
+    OUTPUT: NONE
+
+    Creates the table_versions table, holding the version of each table
+    and when it was last bumped, if it does not exist yet, and the
+    trigger function that bumps the version of the table it fires on.
+    '''
+    query = 'CREATE TABLE IF NOT EXISTS table_versions '
+    query += '(table_name TEXT PRIMARY KEY, version INT, '
+    query += 'updated_at TIMESTAMP);'
+    cur.execute(query)
+
+    query = 'CREATE OR REPLACE FUNCTION bump_table_version() '
+    query += 'RETURNS trigger AS $$ BEGIN '
+    query += 'INSERT INTO table_versions (table_name, version, updated_at) '
+    query += 'VALUES (TG_TABLE_NAME, 1, now()) '
+    query += 'ON CONFLICT (table_name) DO UPDATE '
+    query += 'SET version = table_versions.version + 1, updated_at = now(); '
+    query += 'RETURN NULL; END; $$ LANGUAGE plpgsql;'
+    cur.execute(query)
+
+
+def bump_version (table_name, cur):
+    '''
+    INPUT: STRING table_name, PSYCOPG2 CURSOR cur
+    OUTPUT: NONE
+
+    Marks table_name as changed by incrementing its version (from 0 if
+    it has none yet), as its trigger does.
+    '''
+    query = 'INSERT INTO table_versions (table_name, version, updated_at) '
+    query += 'VALUES (%s, 1, now()) ON CONFLICT (table_name) DO UPDATE '
+    query += 'SET version = table_versions.version + 1, updated_at = now();'
+    cur.execute(query, (table_name,))
+
+
+def track_table (table_name, cur):
+    '''
+    INPUT: STRING table_name, PSYCOPG2 CURSOR cur
+    OUTPUT: NONE
+
+    (Re)creates the version trigger of table_name and bumps its version
+    once, since the table may have been recreated (dropping its old
+    trigger) since the version was last read.
+    '''
+    trigger = table_name + '_version'
+    cur.execute('DROP TRIGGER IF EXISTS ' + trigger + ' ON ' + table_name +
+                ';')
+    query = 'CREATE TRIGGER ' + trigger + ' AFTER INSERT OR UPDATE OR '
+    query += 'DELETE OR TRUNCATE ON ' + table_name + ' FOR EACH STATEMENT '
+    query += 'EXECUTE PROCEDURE bump_table_version();'
+    cur.execute(query)
+    bump_version(table_name, cur)
+
+
+def track_tables (table_names, conn):
+    '''
+    INPUT: LIST OF STRINGS table_names, PSYCOPG2 CONNECTION conn
+    OUTPUT: NONE
+
+    Sets up version tracking of table_names (see track_table), creating
+    the versions table first if needed. Run once whenever the tables
+    are created; reading versions never creates anything.
+    '''
+    cur = conn.cursor()
+    create_versions(cur)
+    for table_name in table_names:
+        track_table(table_name, cur)
+    conn.commit()
+
+
+def get_versions (table_names, cur):
+    '''
+    INPUT: LIST OF STRINGS table_names, PSYCOPG2 CURSOR cur
+    OUTPUT: TUPLE OF INTS versions
+
+    Returns the version of each of table_names, in the same order, with
+    0 for tables that were never bumped. Only reads: the versions table
+    must have been created by track_tables.
+    '''
+    query = 'SELECT table_name, version FROM table_versions '
+    query += 'WHERE table_name IN %s;'
+    cur.execute(query, (tuple(table_names),))
+    versions = dict(cur.fetchall())
+    return tuple(versions.get(table_name, 0) for table_name in table_names)
+
+
+if __name__ == '__main__':
+    track_tables(['patent_text', 'experts'],
+                 psycopg2.connect(database='patents', user='postgres'))
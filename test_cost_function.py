@@ -0,0 +1,113 @@
+'''
+Tests that the serial cost function returns the cost of every test
+patent quietly, and that the pool of processes returns the same
+breakdown in the same order however the work is scheduled.
+
+(C) 2014 Erin Burnside
+'''
+
+
+import sys
+import time
+import unittest
+from cStringIO import StringIO
+
+import cost_function
+
+
+# (pat_num, true expert) pairs of the one_expert_pats table.
+TEST_PATS = [(11, 101), (12, 102), (13, 103)]
+
+# Ranked (expert, score) predictions of the stand-in model.
+MATCHES = {11: [(101, 0.9), (102, 0.5)], 12: [(101, 0.8), (102, 0.7)],
+           13: [(101, 0.6), (102, 0.4)]}
+
+
+def fake_model (test_pat, weight):
+    '''
+    INPUT: INT test_pat, FLOAT weight
+    OUTPUT: LIST OF (INT, FLOAT) TUPLES matches
+
+    Stands in for a model such as basic_model.predict_expert.
+    '''
+    return MATCHES[test_pat]
+
+
+def slow_model (test_pat, weight):
+    '''
+    INPUT: INT test_pat, FLOAT weight
+    OUTPUT: LIST OF (INT, FLOAT) TUPLES matches
+
+    fake_model, taking longest on the first test patents so that the
+    workers of a pool finish them last.
+    '''
+    time.sleep(0.05 * (TEST_PATS[-1][0] - test_pat))
+    return fake_model(test_pat, weight)
+
+
+class FakeCursor (object):
+
+    def execute (self, query, args=None):
+        pass
+
+    def fetchall (self):
+        return [(index, pat_num, expert) for (index, (pat_num, expert)) in
+                enumerate(TEST_PATS)]
+
+
+class FakeConnection (object):
+
+    def __init__ (self):
+        self.closed = False
+
+    def cursor (self):
+        return FakeCursor()
+
+    def close (self):
+        self.closed = True
+
+
+class CostBreakdownTest (unittest.TestCase):
+
+    def setUp (self):
+        self.conns = []
+        def connect (**kwargs):
+            self.conns.append(FakeConnection())
+            return self.conns[-1]
+        self.real_connect = cost_function.psycopg2.connect
+        cost_function.psycopg2.connect = connect
+
+    def tearDown (self):
+        cost_function.psycopg2.connect = self.real_connect
+
+    def test_serial_breakdown (self):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            (cost, pat_costs) = cost_function.cost_breakdown(
+                fake_model, {'weight': 1.}, processes=1)
+            total = cost_function.cost_function(fake_model, {'weight': 1.})
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+        self.assertEqual(printed, '')
+        self.assertEqual(pat_costs, [(11, 101, 0), (12, 102, 1),
+                                     (13, 103, 0)])
+        self.assertEqual(cost, 1)
+        self.assertEqual(total, 1)
+        self.assertTrue(all(conn.closed for conn in self.conns))
+        self.assertEqual(cost_function.WORKER, {})
+
+    def test_pool_matches_serial (self):
+        serial = cost_function.cost_breakdown(fake_model, {'weight': 1.},
+                                              processes=1)
+        for processes in (None, 2):
+            self.assertEqual(cost_function.cost_breakdown(
+                slow_model, {'weight': 1.}, processes=processes), serial)
+        self.assertEqual([(pat_num, expert) for (pat_num, expert, pat_cost)
+                          in serial[1]], TEST_PATS)
+
+
+if __name__ == '__main__':
+    unittest.main()
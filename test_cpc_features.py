@@ -0,0 +1,116 @@
+'''
+Tests that the cost computed from precomputed CPC match-depth features
+agrees with the cost of basic_model's rankings on a fixed random corpus,
+ties included, and that ambiguous params are costed with basic_model.
+
+(C) 2014 Erin Burnside
+'''
+
+
+import unittest
+
+import numpy as np
+
+import basic_model
+import cost_function
+import cpc_features
+import cpc_matrix
+from test_cpc_matrix import CorpusCursor, make_corpus
+
+
+class FeatureCursor (CorpusCursor):
+    '''
+    CorpusCursor that also answers the queries of
+    cpc_features.build_features and cost_function.get_test_patents.
+    '''
+
+    def __init__ (self, corpus, test_pats):
+        CorpusCursor.__init__(self, corpus)
+        self.test_pats = test_pats
+
+    def execute (self, query, args=None):
+        if query.startswith('SELECT pat_num, record FROM experts'):
+            self.rows = [(pat_num, expert) for (pat_num, experts) in
+                         sorted(self.corpus['experts'].items()) for
+                         expert in experts]
+        elif 'FROM one_expert_pats' in query:
+            self.rows = [(ii, pat_num, expert) for (ii, (pat_num, expert))
+                         in enumerate(self.test_pats)]
+        else:
+            CorpusCursor.execute(self, query, args)
+
+
+class FeatureConnection (object):
+
+    def __init__ (self, cur):
+        self.cur = cur
+
+    def cursor (self):
+        return self.cur
+
+    def close (self):
+        pass
+
+
+class FeatureCostTest (unittest.TestCase):
+
+    def setUp (self):
+        self.corpus = make_corpus(n_training=60)
+        self.test_pats = [(pat_num, experts[0]) for (pat_num, experts) in
+                          sorted(self.corpus['experts'].items())[::3]]
+        self.cur = FeatureCursor(self.corpus, self.test_pats)
+        basic_model.CPC_INDEX.clear()
+        basic_model.LEVEL_HIERARCHY.clear()
+        cpc_matrix.LEVEL_ARRAYS.clear()
+        cpc_matrix.ENCODED_INDEX.clear()
+        self.features = cpc_features.build_features(self.cur,
+                                                    self.test_pats)
+
+    def basic_model_cost (self, params, agg_func):
+        cost = 0
+        for (test_pat, expert) in self.test_pats:
+            matches = basic_model.predict_expert(test_pat, params, agg_func,
+                                                 testing=True, cur=self.cur)
+            cost += cost_function.expert_cost(matches, expert)
+        return cost
+
+    def test_mean_matches_basic_model (self):
+        random_state = np.random.RandomState(4)
+        for trial in range(20):
+            params = list(random_state.uniform(0., 1., 17))
+            self.assertEqual(cpc_features.features_cost(self.features,
+                                                        params, np.mean),
+                             self.basic_model_cost(params, np.mean))
+
+    def test_tied_means_match_basic_model (self):
+        params = [0.1] * 17
+        self.assertEqual(cpc_features.features_cost(self.features, params,
+                                                     np.mean),
+                         self.basic_model_cost(params, np.mean))
+
+    def test_max_matches_basic_model (self):
+        params = list(np.random.RandomState(5).uniform(0., 1., 17))
+        self.assertEqual(cpc_features.features_cost(self.features, params,
+                                                    max),
+                         self.basic_model_cost(params, max))
+
+    def test_ambiguous_params_use_basic_model (self):
+        params = list(np.random.RandomState(6).uniform(0., 1., 17))
+        params[3] = 0.
+        params[4] = 0.
+        self.assertRaises(ValueError, cpc_features.features_cost,
+                          self.features, params, np.mean)
+
+        real_connect = cost_function.psycopg2.connect
+        cost_function.psycopg2.connect = \
+            lambda **kwargs: FeatureConnection(self.cur)
+        try:
+            cost = cost_function.feature_cost_function(params, np.mean,
+                                                       self.features)
+        finally:
+            cost_function.psycopg2.connect = real_connect
+        self.assertEqual(cost, self.basic_model_cost(params, np.mean))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+'''
+Tests that the batch CPC scorer of cpc_matrix ranks experts exactly as
+basic_model does on a fixed random corpus of CPC codes.
+
+(C) 2014 Erin Burnside
+'''
+
+
+import unittest
+
+import numpy as np
+
+import basic_model
+import cpc_matrix
+
+
+def make_corpus (seed=0, n_training=40, n_test=8):
+    '''
+    INPUT: optional INT seed, optional INT n_training, optional INT n_test
+    OUTPUT: DICT corpus
+
+    Builds a levels table over a few main groups and random CPC codes
+    from it for training patents (each with one or two experts) and for
+    test patents.
+    '''
+    random_state = np.random.RandomState(seed)
+    first_halves = [section + cls + subclass + group for section in 'AB'
+                    for cls in ('01', '02') for subclass in 'BC'
+                    for group in ('1', '12')]
+
+    levels = []
+    codes = []
+    for first_half in first_halves:
+        levels.append((len(levels), first_half + '/00', 0))
+        codes.append(first_half + '/00')
+        for subgroup in range(1, 12):
+            code = first_half + '/%02d' % subgroup
+            levels.append((len(levels), code, random_state.randint(1, 6)))
+            codes.append(code)
+
+    def draw_cpcs ():
+        return [codes[ii] for ii in
+                random_state.choice(len(codes), random_state.randint(1, 6),
+                                    replace=False)]
+
+    corpus = {'levels': levels, 'exp_cpcs': {}, 'cpcs': {}, 'experts': {}}
+    for pat_num in range(1000, 1000 + n_training):
+        corpus['exp_cpcs'][pat_num] = draw_cpcs()
+        corpus['cpcs'][pat_num] = corpus['exp_cpcs'][pat_num]
+        corpus['experts'][pat_num] = [int(expert) for expert in
+                                      random_state.randint(0, 15, 2)]
+    for pat_num in range(5000, 5000 + n_test):
+        corpus['cpcs'][pat_num] = draw_cpcs()
+
+    return corpus
+
+
+class CorpusCursor (object):
+    '''
+    Stands in for a psycopg2 cursor over the tables of a corpus from
+    make_corpus.
+    '''
+
+    def __init__ (self, corpus):
+        self.corpus = corpus
+        self.rows = []
+
+    def execute (self, query, args=None):
+        if query.startswith('SELECT * FROM levels'):
+            self.rows = self.corpus['levels']
+        elif query.startswith('SELECT pat_num, cpc FROM exp_cpcs'):
+            self.rows = [(pat_num, cpc) for (pat_num, cpcs) in
+                         sorted(self.corpus['exp_cpcs'].items()) for
+                         cpc in cpcs]
+        elif query.startswith('SELECT * FROM cpcs'):
+            self.rows = [(args[0], cpc) for cpc in
+                         self.corpus['cpcs'].get(args[0], [])]
+        elif query.startswith('SELECT record FROM experts'):
+            self.rows = [(expert,) for expert in
+                         self.corpus['experts'].get(args[0], [])]
+        else:
+            raise ValueError('unexpected query: ' + query)
+
+    def fetchall (self):
+        return list(self.rows)
+
+
+class BatchScorerTest (unittest.TestCase):
+
+    def setUp (self):
+        self.corpus = make_corpus()
+        self.cur = CorpusCursor(self.corpus)
+        basic_model.CPC_INDEX.clear()
+        basic_model.LEVEL_HIERARCHY.clear()
+        cpc_matrix.LEVEL_ARRAYS.clear()
+        cpc_matrix.ENCODED_INDEX.clear()
+
+    def assert_same_experts (self, params, agg_func):
+        test_pats = [1000, 1007, 1021] + sorted(self.corpus['cpcs'])[-8:]
+        for test_pat in test_pats:
+            testing = test_pat in self.corpus['exp_cpcs']
+            expected = basic_model.predict_expert(test_pat, params, agg_func,
+                                                  testing=testing,
+                                                  cur=self.cur)
+            found = cpc_matrix.predict_expert(test_pat, params, agg_func,
+                                              testing=testing, cur=self.cur)
+            self.assertEqual(found, expected)
+
+    def test_mean_matches_basic_model (self):
+        random_state = np.random.RandomState(1)
+        for trial in range(5):
+            params = list(random_state.uniform(0.1, 3., 17))
+            self.assert_same_experts(params, np.mean)
+
+    def test_max_matches_basic_model (self):
+        params = list(np.random.RandomState(2).uniform(0.1, 3., 17))
+        self.assert_same_experts(params, max)
+
+    def test_ambiguous_params_match_basic_model (self):
+        params = list(np.random.RandomState(3).uniform(0.1, 3., 17))
+        params[3] = 0.
+        params[4] = 0.
+        self.assertTrue(cpc_matrix.ambiguous_params(params))
+        self.assert_same_experts(params, np.mean)
+
+    def test_ambiguous_params (self):
+        self.assertFalse(cpc_matrix.ambiguous_params([1.] * 17))
+        self.assertFalse(cpc_matrix.ambiguous_params([1., 0.] + [1.] * 15))
+        self.assertTrue(cpc_matrix.ambiguous_params([1.] * 3 + [0.] +
+                                                    [1.] * 13))
+        self.assertTrue(cpc_matrix.ambiguous_params([1.] * 4 + [0.] +
+                                                    [1.] * 12))
+        self.assertTrue(cpc_matrix.ambiguous_params([1., 1., 2., -2.] +
+                                                    [1.] * 13))
+
+
+if __name__ == '__main__':
+    unittest.main()
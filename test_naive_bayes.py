@@ -0,0 +1,209 @@
+'''
+Tests that stored naive Bayes models are refitted the way they were
+fitted when their tables change, and that the leave-one-out
+probabilities of loo_probs match refitting TF-IDF and MultinomialNB
+without the held-out patent.
+
+(C) 2014 Erin Burnside
+'''
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.naive_bayes import MultinomialNB
+
+import naive_bayes
+
+
+def make_texts (seed=0, n_pats=30, n_experts=6):
+    '''
+    INPUT: optional INT seed, optional INT n_pats, optional INT n_experts
+    OUTPUT: DICT OF INT -> STRING texts, LIST OF (INT, INT) TUPLES pairs
+
+    Draws the text of n_pats patents from a small shared vocabulary plus
+    a word of their own, and their (patent, expert) rows, with some
+    patents listed for two experts or twice for the same one (two
+    cases). The last expert has a single patent.
+    '''
+    random_state = np.random.RandomState(seed)
+    vocabulary = ['word%s' % chr(ord('a') + ii) for ii in range(20)]
+
+    texts = {}
+    pairs = []
+    for ii in range(n_pats):
+        pat_num = 5000000 + ii
+        words = random_state.choice(vocabulary, random_state.randint(5, 30))
+        texts[pat_num] = ' '.join(list(words) + ['own%d' % ii])
+        expert = 100 + ii % (n_experts - 1)
+        pairs.append((pat_num, expert))
+        if ii % 4 == 0:
+            pairs.append((pat_num, 100 + (ii + 1) % (n_experts - 1)))
+        if ii % 7 == 0:
+            pairs.append((pat_num, expert))
+    pairs.append((5000000 + n_pats - 1, 100 + n_experts - 1))
+    return texts, pairs
+
+
+class TextCursor (object):
+    '''
+    Stands in for a psycopg2 cursor over the text and expert tables of
+    make_texts.
+    '''
+
+    def __init__ (self, texts, pairs):
+        self.texts = texts
+        self.pairs = pairs
+        self.rows = []
+
+    def execute (self, query, args=None):
+        if query.startswith('SELECT DISTINCT ON (pat_num) * FROM'):
+            self.rows = [(ii, pat_num, 'title', self.texts[pat_num], '', '')
+                         for (ii, pat_num) in enumerate(sorted(self.texts))]
+        elif query.startswith('SELECT pat_num, record FROM'):
+            self.rows = list(self.pairs)
+        else:
+            raise ValueError('unexpected query: ' + query)
+
+    def fetchall (self):
+        return list(self.rows)
+
+
+def refit_probs (texts, pairs, test_pat, raw_text):
+    '''
+    INPUT: DICT OF INT -> STRING texts, LIST OF (INT, INT) TUPLES pairs,
+        INT test_pat, STRING raw_text
+    OUTPUT: 1-DIM NUMPY ARRAY classes, 1-DIM NUMPY ARRAY probs
+
+    Fits TF-IDF and MultinomialNB from scratch without test_pat, as
+    naive_bayes does, and returns the class probabilities of raw_text.
+    '''
+    pat_nums = [pat_num for pat_num in sorted(texts) if pat_num != test_pat]
+    pat_index = dict((pat_num, ii) for (ii, pat_num) in enumerate(pat_nums))
+    tfidf_vect = TfidfVectorizer(stop_words = 'english')
+    tfidf_arr = tfidf_vect.fit_transform([texts[pat_num] for pat_num in
+                                          pat_nums])
+
+    kept = [(pat_index[pat_num], expert) for (pat_num, expert) in pairs if
+            pat_num in pat_index]
+    rows = sorted(set(kept))
+    weights = [kept.count(row) for row in rows]
+    classes = np.unique([expert for (pat, expert) in rows])
+    nb_clf = MultinomialNB(class_prior = np.ones(len(classes)) /
+                           float(len(classes)))
+    nb_clf.fit(tfidf_arr[[pat for (pat, expert) in rows]],
+               [expert for (pat, expert) in rows], sample_weight = weights)
+
+    probs = nb_clf.predict_proba(tfidf_vect.transform([raw_text]))[0]
+    return nb_clf.classes_, probs
+
+
+class ConnectionCursor (object):
+    '''
+    Stands in for a psycopg2 cursor, with only the connection it belongs
+    to.
+    '''
+
+    def __init__ (self):
+        self.connection = object()
+
+
+class RefitTest (unittest.TestCase):
+
+    def setUp (self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'naive_bayes.pkl')
+        self.cur = ConnectionCursor()
+        self.calls = []
+        naive_bayes.MODEL_STORE.clear()
+
+        def stream_fit (text_table, expert_table, conn, path, **options):
+            self.calls.append(('stream', conn, path, options))
+            model = {'signature': ('v', 2), 'fit': 'stream'}
+            naive_bayes.MODEL_STORE[path] = model
+            return model
+
+        def fit_model (text_table, expert_table, cur):
+            self.calls.append(('memory', cur))
+            return {'signature': ('v', 2), 'fit': 'memory'}
+
+        self.patched = {}
+        for (name, value) in (('stream_fit', stream_fit),
+                              ('fit_model', fit_model),
+                              ('table_signature', lambda *args: ('v', 2))):
+            self.patched[name] = getattr(naive_bayes, name)
+            setattr(naive_bayes, name, value)
+
+    def tearDown (self):
+        for (name, value) in self.patched.items():
+            setattr(naive_bayes, name, value)
+        naive_bayes.MODEL_STORE.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_streamed_model_is_streamed_again (self):
+        options = {'chunk_size': 100, 'n_features': 2**10}
+        naive_bayes.save_model({'signature': ('v', 1), 'fit': 'stream',
+                                'vectorizer': 'hashing',
+                                'fit_options': options}, self.path)
+
+        model = naive_bayes.get_model('patent_text', 'experts', self.cur,
+                                      self.path)
+
+        self.assertEqual(self.calls, [('stream', self.cur.connection,
+                                       self.path, options)])
+        self.assertEqual(model['fit'], 'stream')
+
+    def test_other_models_are_fitted_in_memory (self):
+        naive_bayes.save_model({'signature': ('v', 1)}, self.path)
+
+        model = naive_bayes.get_model('patent_text', 'experts', self.cur,
+                                      self.path)
+
+        self.assertEqual(self.calls, [('memory', self.cur)])
+        self.assertEqual(naive_bayes.load_model(self.path), model)
+
+    def test_current_model_is_reused (self):
+        naive_bayes.save_model({'signature': ('v', 2), 'fit': 'stream'},
+                               self.path)
+
+        naive_bayes.get_model('patent_text', 'experts', self.cur, self.path)
+
+        self.assertEqual(self.calls, [])
+
+
+class LeaveOneOutTest (unittest.TestCase):
+
+    def setUp (self):
+        (self.texts, self.pairs) = make_texts()
+        self.state = naive_bayes.fit_counts('patent_text', 'experts',
+                                            TextCursor(self.texts,
+                                                       self.pairs))
+
+    def assert_matches_refit (self, test_pat, raw_text=None):
+        (classes, probs) = naive_bayes.loo_probs(self.state, test_pat,
+                                                 raw_text)
+        if raw_text is None:
+            raw_text = self.texts[test_pat]
+        (expected_classes, expected_probs) = refit_probs(self.texts,
+                                                         self.pairs,
+                                                         test_pat, raw_text)
+        self.assertEqual(list(classes), list(expected_classes))
+        self.assertTrue(np.abs(probs - expected_probs).max() < 1e-12)
+
+    def test_held_out_patents_match_refit (self):
+        for test_pat in sorted(self.texts)[:-1]:
+            self.assert_matches_refit(test_pat)
+
+    def test_only_patent_of_expert_matches_refit (self):
+        self.assert_matches_refit(max(self.texts))
+
+    def test_new_text_matches_refit (self):
+        self.assert_matches_refit(None, 'worda wordb wordb own1 unseen')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+'''
+Tests the reference crawler against a stub of the patent site served
+locally, checking the edges it records and that it never fetches a page
+twice.
+
+(C) 2014 Erin Burnside
+'''
+
+
+import BaseHTTPServer
+import shutil
+import SocketServer
+import tempfile
+import threading
+import unittest
+
+import citation_graph
+import page_cache
+import reference_scraper
+
+
+# (ref_in, ref_out) citations of the stub site; 1000001 is the root.
+CITATIONS = [(1000001, 1000002), (1000001, 1000003), (1000004, 1000001),
+             (1000002, 1000005), (1000005, 1000006), (1000007, 1000004)]
+
+
+def patent_page (pat_num):
+    '''
+    INPUT: INT pat_num
+    OUTPUT: STRING html
+
+    Stub patent page listing the references of pat_num in meta tags.
+    '''
+    metas = ['<meta scheme="references" content="US%d">' % ref_out for
+             (ref_in, ref_out) in CITATIONS if ref_in == pat_num]
+    return '<html><head>%s</head></html>' % ''.join(metas)
+
+
+def result_page (pat_num):
+    '''
+    INPUT: INT pat_num
+    OUTPUT: STRING html
+
+    Stub search page listing the patents that cite pat_num.
+    '''
+    rows = ['<tr><td width="15%%">Patent %d</td></tr>' % ref_in for
+            (ref_in, ref_out) in CITATIONS if ref_out == pat_num]
+    return '<html><body><table>%s</table></body></html>' % ''.join(rows)
+
+
+class StubHandler (BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Serves patent_page and result_page, recording every request path in
+    the requests list of the server.
+    '''
+
+    def do_GET (self):
+        self.server.requests.append(self.path)
+        if self.path.startswith('/result.html'):
+            query_txt = self.path.split('query_txt=REFN%2F')[1]
+            html = result_page(int(query_txt.split('&')[0]))
+        else:
+            html = patent_page(int(self.path[1:-len('.html')]))
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.end_headers()
+        self.wfile.write(html)
+
+    def log_message (self, format, *args):
+        pass
+
+
+class StubServer (SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+
+class FakeFrontier (object):
+    '''
+    Stands in for the crawl_frontier table, with the functions of
+    reference_scraper that use it.
+    '''
+
+    def __init__ (self):
+        self.rows = {}
+
+    def is_started (self, root, cur):
+        return any(key[0] == root for key in self.rows)
+
+    def add_pending (self, root, pat_nums, level, cur):
+        for pat_num in pat_nums:
+            self.rows.setdefault((root, pat_num), [level, 'pending'])
+
+    def mark_completed (self, root, pat_nums, cur):
+        for pat_num in pat_nums:
+            self.rows[(root, pat_num)][1] = 'done'
+
+    def get_pending (self, root, cur):
+        levels = [level for ((row_root, pat_num), (level, status)) in
+                  self.rows.items() if row_root == root and
+                  status == 'pending']
+        if levels == []:
+            return None, set()
+        return min(levels), set(pat_num for ((row_root, pat_num),
+                                             (level, status)) in
+                                self.rows.items() if row_root == root and
+                                status == 'pending' and
+                                level == min(levels))
+
+    def get_completed (self, root, cur):
+        return set(pat_num for ((row_root, pat_num), (level, status)) in
+                   self.rows.items() if row_root == root and
+                   status == 'done')
+
+
+class FakeConnection (object):
+
+    def commit (self):
+        pass
+
+
+class CrawlTest (unittest.TestCase):
+
+    def setUp (self):
+        self.server = StubServer(('127.0.0.1', 0), StubHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        host = '127.0.0.1:%d' % self.server.server_address[1]
+        self.base_url = 'http://%s/' % host
+        reference_scraper.BUCKETS[host] = reference_scraper.TokenBucket(
+            1000., 1000)
+
+        self.cache_dir = tempfile.mkdtemp()
+        self.settings = dict(page_cache.SETTINGS)
+        page_cache.configure(cache_dir=self.cache_dir)
+
+        self.edges = []
+        self.frontier = FakeFrontier()
+        self.patched = {}
+        self.patch(citation_graph, 'add_citations',
+                   lambda edges, cur: self.edges.extend(edges))
+        for name in ('is_started', 'add_pending', 'mark_completed',
+                     'get_pending', 'get_completed'):
+            self.patch(reference_scraper, name,
+                       getattr(self.frontier, name))
+
+    def patch (self, module, name, value):
+        self.patched[(module, name)] = getattr(module, name)
+        setattr(module, name, value)
+
+    def tearDown (self):
+        for ((module, name), value) in self.patched.items():
+            setattr(module, name, value)
+        page_cache.SETTINGS.update(self.settings)
+        shutil.rmtree(self.cache_dir)
+        del reference_scraper.BUCKETS['127.0.0.1:%d' %
+                                      self.server.server_address[1]]
+        self.server.shutdown()
+        self.server.server_close()
+
+    def crawl (self, root):
+        reference_scraper.get_one_network(root, FakeConnection(), None,
+                                          max_level=1, n_workers=2,
+                                          chunk_size=2,
+                                          base_url=self.base_url)
+
+    def test_edges_and_fetches (self):
+        self.crawl(1000001)
+
+        self.assertEqual(sorted(self.edges),
+                         [(1000001, 1000002), (1000001, 1000003),
+                          (1000002, 1000005), (1000004, 1000001),
+                          (1000007, 1000004)])
+        expected = []
+        for pat_num in (1000001, 1000002, 1000003, 1000004):
+            expected.append('/%d.html' % pat_num)
+            expected.append('/result.html?sort=relevance&srch=top&'
+                            'query_txt=REFN%%2F%d&submit=&patents=on' %
+                            pat_num)
+        self.assertEqual(sorted(self.server.requests), sorted(expected))
+
+    def test_no_page_fetched_twice (self):
+        self.crawl(1000001)
+        self.crawl(1000001)
+        self.crawl(1000003)
+
+        self.assertEqual(len(set(self.server.requests)),
+                         len(self.server.requests))
+        self.assertEqual(len(self.server.requests), 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+'''
+Tests that sim_annealing and parallel_tempering memoize costs across
+moves and across a crash and resume, without changing the course of the
+run, and that line_search makes one evaluation per golden-section step.
+
+(C) 2014 Erin Burnside
+'''
+
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+import sim_anneal_model
+
+
+class CountingCost (object):
+    '''
+    Stands in for cost_function.cost_function: a smooth cost of the
+    parameters that counts its calls, and fails on call fail_at if given.
+    '''
+
+    def __init__ (self, fail_at=None, target=0.3):
+        self.calls = 0
+        self.fail_at = fail_at
+        self.target = target
+
+    def __call__ (self, params, agg_func, model):
+        if self.calls == self.fail_at:
+            raise RuntimeError('lost the database connection')
+        self.calls += 1
+        return sum((param - self.target) ** 2 for param in params)
+
+
+class MemoTest (unittest.TestCase):
+
+    def setUp (self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown (self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_rounded_params_hit_memo (self):
+        cost_func = CountingCost()
+        memo = {}
+        sim_anneal_model.memo_cost(memo, cost_func, [0.1 + 0.2, 0.5],
+                                   None, None)
+        sim_anneal_model.memo_cost(memo, cost_func, [0.3, 0.5], None, None)
+        self.assertEqual(cost_func.calls, 1)
+
+    def test_steps_are_on_grid (self):
+        random.seed(0)
+        params = [0.5] * 3
+        for step in range(50):
+            params = sim_anneal_model.shift_params(3, params)
+        for param in params:
+            self.assertAlmostEqual(param * 1000, round(param * 1000))
+
+    def test_resume_reuses_evaluations (self):
+        whole_file = os.path.join(self.tmp_dir, 'whole.pkl')
+        whole_cost = CountingCost()
+        random.seed(0)
+        sim_anneal_model.sim_annealing(3, whole_cost, None, 10, 0.9, None,
+                                       checkpoint_file=whole_file,
+                                       checkpoint_every=5)
+        whole = sim_anneal_model.load_checkpoint(whole_file)
+
+        crashed_file = os.path.join(self.tmp_dir, 'crashed.pkl')
+        crashed_cost = CountingCost(fail_at=13)
+        random.seed(0)
+        self.assertRaises(RuntimeError, sim_anneal_model.sim_annealing, 3,
+                          crashed_cost, None, 10, 0.9, None,
+                          checkpoint_file=crashed_file, checkpoint_every=5)
+        self.assertTrue(sim_anneal_model.load_checkpoint(crashed_file)
+                        ['step'] < crashed_cost.calls)
+
+        resumed_cost = CountingCost()
+        sim_anneal_model.resume_annealing(crashed_file, resumed_cost, None,
+                                          None, checkpoint_every=5)
+        resumed = sim_anneal_model.load_checkpoint(crashed_file)
+
+        self.assertEqual(crashed_cost.calls + resumed_cost.calls,
+                         whole_cost.calls)
+        self.assertEqual(resumed['best_params'], whole['best_params'])
+        self.assertEqual(resumed['best_cost'], whole['best_cost'])
+
+
+class TemperingTest (unittest.TestCase):
+
+    def setUp (self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown (self):
+        shutil.rmtree(self.tmp_dir)
+
+    def temper (self, cost_func, checkpoint_file):
+        return sim_anneal_model.parallel_tempering(3, cost_func, None, 10,
+                                                   0.9, None, n_chains=3,
+                                                   swap_every=5,
+                                                   processes=1, seed=0,
+                                                   checkpoint_file=
+                                                   checkpoint_file,
+                                                   checkpoint_every=5)
+
+    def test_returns_progress_quietly (self):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            (best_params, best_cost, history) = self.temper(CountingCost(),
+                                                            None)
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+        self.assertEqual(printed, '')
+        self.assertEqual([step for (step, costs, best) in history],
+                         range(1, len(history) + 1))
+        self.assertEqual(history[-1][2], best_cost)
+        self.assertEqual(len(best_params), 3)
+
+    def test_resume_reuses_evaluations (self):
+        whole_cost = CountingCost()
+        whole = self.temper(whole_cost,
+                            os.path.join(self.tmp_dir, 'whole.pkl'))
+
+        crashed_file = os.path.join(self.tmp_dir, 'crashed.pkl')
+        crashed_cost = CountingCost(fail_at=40)
+        self.assertRaises(RuntimeError, self.temper, crashed_cost,
+                          crashed_file)
+
+        resumed_cost = CountingCost()
+        resumed = sim_anneal_model.resume_tempering(crashed_file,
+                                                    resumed_cost, None,
+                                                    None, processes=1,
+                                                    checkpoint_every=5)
+
+        self.assertEqual(crashed_cost.calls + resumed_cost.calls,
+                         whole_cost.calls)
+        self.assertEqual(resumed, whole)
+
+
+class LineSearchTest (unittest.TestCase):
+
+    def test_one_evaluation_per_golden_section_step (self):
+        for refine in range(6):
+            cost_func = CountingCost(target=0.37)
+            params = [0.37, 0.9, 0.37]
+            (new_params, cost) = sim_anneal_model.line_search(
+                cost_func, None, None, params, 1, 1., grid=5, refine=refine)
+            self.assertEqual(cost_func.calls,
+                             5 + refine + 1 if refine else 5)
+            self.assertEqual(new_params[0], 0.37)
+
+    def test_refines_between_grid_points (self):
+        cost_func = CountingCost(target=0.37)
+        params = [0.9]
+        (grid_params, grid_cost) = sim_anneal_model.line_search(
+            cost_func, None, None, params, 0, 1., grid=5, refine=0)
+        (new_params, cost) = sim_anneal_model.line_search(
+            cost_func, None, None, params, 0, 1., grid=5, refine=8)
+        self.assertAlmostEqual(grid_params[0], 0.3)
+        self.assertTrue(cost < grid_cost)
+        self.assertAlmostEqual(new_params[0], 0.37, places=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+'''
+Tests of SimRank on a small random citation network, checking the 
+single-source scores against the full dense iteration, and that a root
+missing from the exported graph is reported until it is exported again.
+
+(C) 2014 Erin Burnside
+'''
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import citation_graph
+import simrank
+
+
+class EdgeCursor (object):
+    '''
+    Stands in for a psycopg2 cursor reading the citations table.
+    '''
+
+    def __init__ (self, edges):
+        self.edges = edges
+
+    def execute (self, query, args=None):
+        pass
+
+    def fetchall (self):
+        return list(self.edges)
+
+
+class EdgeConnection (object):
+
+    def __init__ (self, edges):
+        self.edges = edges
+
+    def cursor (self):
+        return EdgeCursor(self.edges)
+
+
+def random_edges (n_pats=300, seed=1):
+    '''
+    INPUT: optional INT n_pats, optional INT seed
+    OUTPUT: SET OF (INT, INT) TUPLES edges
+
+    Draws the citations of a network in which each patent cites 1 to 5
+    random others.
+    '''
+    random_state = np.random.RandomState(seed)
+    edges = set()
+    for ii in range(n_pats):
+        for jj in random_state.randint(0, n_pats, random_state.randint(1, 6)):
+            if jj != ii:
+                edges.add((1000 + ii, 1000 + jj))
+    return edges
+
+
+def random_graph (n_pats=300, seed=1):
+    '''
+    INPUT: optional INT n_pats, optional INT seed
+    OUTPUT: DICT graph
+
+    Builds the citation graph of random_edges.
+    '''
+    return citation_graph.build_graph(EdgeCursor(random_edges(n_pats, seed)))
+
+
+class SingleSourceTest (unittest.TestCase):
+
+    def setUp (self):
+        self.graph = random_graph()
+        (self.w, self.pat_arr) = simrank.find_w(1000, self.graph)
+        self.c = 0.8
+        (self.s, n_iter) = simrank.iterate_simrank(self.w, self.c, None,
+                                                   1e-12, 500)
+
+    def test_exact_diagonal_gives_dense_scores (self):
+        w = self.w
+        diag = 1 - np.diag(self.c * w.T.dot(w.T.dot(self.s).T).T)
+        for root_index in range(0, w.shape[0], 7):
+            scores, n_iter = simrank.single_source(w, root_index, self.c,
+                                                   1e-14, 500, diag)
+            self.assertTrue(np.allclose(scores, self.s[root_index],
+                                        atol=1e-10))
+
+    def test_estimated_diagonal_matches_dense_scale (self):
+        w = self.w
+        diag = simrank.diagonal_correction(w, self.c, n_walks=400,
+                                           walk_len=30)
+        errors = []
+        for root_index in range(0, w.shape[0], 7):
+            scores, n_iter = simrank.single_source(w, root_index, self.c,
+                                                   1e-12, 100, diag)
+            self.assertAlmostEqual(scores[root_index], 1., delta=0.01)
+            errors.append(np.abs(scores - self.s[root_index]).max())
+        self.assertTrue(max(errors) < 0.01)
+
+    def test_default_diagonal (self):
+        root_index = np.searchsorted(self.pat_arr, 1000)
+        scores, n_iter = simrank.single_source(self.w, root_index, self.c,
+                                               1e-12, 30)
+        self.assertTrue(np.abs(scores - self.s[root_index]).max() < 0.05)
+
+
+
+class WarmStartTest (unittest.TestCase):
+
+    def test_warm_start_saves_iterations (self):
+        edges = random_edges()
+        (w, pat_arr) = simrank.find_w(1000, citation_graph.build_graph(
+            EdgeCursor(edges)))
+        (s_old, n_iter) = simrank.iterate_simrank(w, 0.8, None, 1e-10, 500)
+
+        edges.update([(1003, 1150), (1042, 1007), (1099, 1000)])
+        (w, new_pat_arr) = simrank.find_w(1000, citation_graph.build_graph(
+            EdgeCursor(edges)))
+        (s_fresh, n_fresh) = simrank.iterate_simrank(w, 0.8, None, 1e-10, 500)
+        s_init = simrank.carry_over(s_old, pat_arr, new_pat_arr)
+        (s_warm, n_warm) = simrank.iterate_simrank(w, 0.8, s_init, 1e-10, 500)
+
+        self.assertTrue(n_warm < n_fresh)
+        self.assertTrue(np.abs(s_warm - s_fresh).max() < 1e-8)
+
+    def test_carry_over (self):
+        s_old = np.array([[1., .5, .2], [.5, 1., .3], [.2, .3, 1.]])
+        s_init = simrank.carry_over(s_old, np.array([10, 20, 30]),
+                                    np.array([10, 15, 30]))
+        expected = np.array([[1., 0., .2], [0., 1., 0.], [.2, 0., 1.]])
+        self.assertTrue(np.array_equal(s_init, expected))
+
+
+class MissingRootTest (unittest.TestCase):
+
+    def test_missing_root_raises (self):
+        graph = random_graph()
+        for single in (False, True):
+            self.assertRaises(ValueError, simrank.simrank, 999, None, 0.8,
+                              single=single, graph=graph)
+
+    def test_root_position (self):
+        pat_arr = np.array([10, 20, 30])
+        self.assertEqual(simrank.root_position(pat_arr, 20), 1)
+        self.assertRaises(ValueError, simrank.root_position, pat_arr, 25)
+        self.assertRaises(ValueError, simrank.root_position, pat_arr, 40)
+
+    def test_export_replaces_loaded_graph (self):
+        tmp_dir = tempfile.mkdtemp()
+        filename = os.path.join(tmp_dir, 'citations.npz')
+        edges = random_edges()
+        try:
+            citation_graph.export_graph(EdgeConnection(edges), filename)
+            citation_graph.get_graph(filename)
+            self.assertRaises(ValueError, simrank.find_w, 999,
+                              citation_graph.get_graph(filename))
+
+            edges.add((999, 1000))
+            citation_graph.export_graph(EdgeConnection(edges), filename)
+            (w, pat_arr) = simrank.find_w(999,
+                                          citation_graph.get_graph(filename))
+            self.assertTrue(999 in pat_arr)
+            self.assertTrue(999 in citation_graph.load_graph(filename)
+                            ['pat_arr'])
+        finally:
+            citation_graph.GRAPHS.pop(filename, None)
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+'''
+Tests of the Monte Carlo SimRank index on a small citation graph, and of
+its use by simrank.predict_expert for patents that were never crawled.
+
+(C) 2014 Erin Burnside
+'''
+
+
+import unittest
+
+import numpy as np
+
+import citation_graph
+import simrank
+import simrank_index
+
+
+# (ref_in, ref_out) citations of the test graph; 1-3 are expert patents.
+EDGES = [(1, 10), (1, 11), (2, 10), (2, 12), (3, 11), (3, 12), (4, 13),
+         (10, 20), (11, 20), (12, 21), (13, 21)]
+
+# (pat_num, record) rows of the experts table.
+EXPERTS = [(1, 101), (2, 102), (3, 103), (3, 101)]
+
+
+class FakeCursor (object):
+    '''
+    Stands in for a psycopg2 cursor, answering the few queries of
+    citation_graph.build_graph and simrank.predict_expert.
+    '''
+
+    def __init__ (self, scores=()):
+        self.scores = list(scores)
+        self.rows = []
+
+    def execute (self, query, args=None):
+        if 'FROM citations' in query:
+            self.rows = EDGES
+        elif 'FROM experts' in query:
+            self.rows = EXPERTS
+        elif 'FROM simrank_scores' in query:
+            self.rows = self.scores
+
+    def fetchall (self):
+        return list(self.rows)
+
+
+class FakeConnection (object):
+
+    def __init__ (self, cur):
+        self.cur = cur
+
+    def cursor (self):
+        return self.cur
+
+
+class NewPatentTest (unittest.TestCase):
+
+    def setUp (self):
+        self.graph = citation_graph.build_graph(FakeCursor())
+        self.index = simrank_index.build_index(self.graph, [1, 2, 3],
+                                               n_walks=200,
+                                               references=True)
+        simrank.ROOT_EXPERTS.clear()
+
+    def test_never_seen_patent_has_neighbours (self):
+        (pat_nums, scores) = simrank_index.similar_patents(self.index,
+                                                           999999,
+                                                           [10, 11])
+        self.assertTrue(pat_nums.shape[0] > 0)
+        self.assertTrue(np.all(scores > 0))
+        self.assertTrue(1 in pat_nums)
+
+    def test_never_seen_patent_without_nbrs_has_none (self):
+        (pat_nums, scores) = simrank_index.similar_patents(self.index,
+                                                           999999)
+        self.assertEqual(pat_nums.shape[0], 0)
+
+    def test_predict_expert_fetches_references (self):
+        fetched = []
+        def get_referenced (pat_num):
+            fetched.append(pat_num)
+            return [10, 11]
+
+        simrank_index.INDEXES['test.npz'] = self.index
+        real_get_referenced = simrank.reference_scraper.get_referenced
+        simrank.reference_scraper.get_referenced = get_referenced
+        try:
+            conn = FakeConnection(FakeCursor())
+            experts = simrank.predict_expert(999999, conn,
+                                             index_path='test.npz')
+        finally:
+            simrank.reference_scraper.get_referenced = real_get_referenced
+            del simrank_index.INDEXES['test.npz']
+
+        self.assertEqual(fetched, [999999])
+        self.assertTrue(len(experts) > 0)
+        self.assertEqual(experts[0][0], 101)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+'''
+Tests that table versions are read without any DDL and that tracking a
+table installs a statement-level trigger that bumps its version.
+
+(C) 2014 Erin Burnside
+'''
+
+
+import unittest
+
+import table_versions
+
+
+class RecordingCursor (object):
+    '''
+    Stands in for a psycopg2 cursor, recording every query and answering
+    reads of table_versions from a dict.
+    '''
+
+    def __init__ (self, versions):
+        self.versions = versions
+        self.queries = []
+        self.rows = []
+
+    def execute (self, query, args=None):
+        self.queries.append(query)
+        if query.startswith('SELECT table_name, version'):
+            self.rows = [(table_name, self.versions[table_name]) for
+                         table_name in args[0] if
+                         table_name in self.versions]
+
+    def fetchall (self):
+        return list(self.rows)
+
+
+class RecordingConnection (object):
+
+    def __init__ (self, cur):
+        self.cur = cur
+        self.commits = 0
+
+    def cursor (self):
+        return self.cur
+
+    def commit (self):
+        self.commits += 1
+
+
+class VersionsTest (unittest.TestCase):
+
+    def test_get_versions_only_reads (self):
+        cur = RecordingCursor({'experts': 3})
+        versions = table_versions.get_versions(['patent_text', 'experts'],
+                                               cur)
+        self.assertEqual(versions, (0, 3))
+        self.assertEqual(len(cur.queries), 1)
+        self.assertTrue(cur.queries[0].startswith('SELECT'))
+
+    def test_track_tables_installs_triggers (self):
+        cur = RecordingCursor({})
+        conn = RecordingConnection(cur)
+        table_versions.track_tables(['patent_text', 'experts'], conn)
+
+        triggers = [query for query in cur.queries if
+                    query.startswith('CREATE TRIGGER')]
+        self.assertEqual(len(triggers), 2)
+        for (trigger, table_name) in zip(triggers,
+                                         ['patent_text', 'experts']):
+            self.assertTrue('INSERT OR UPDATE OR DELETE OR TRUNCATE ON ' +
+                            table_name + ' FOR EACH STATEMENT' in trigger)
+        self.assertEqual(conn.commits, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+'''
+Resolves the text of patents (abstract, claims and description joined
+as for training) without going to the web when it can be avoided: the
+patent_text table is checked first, then a local cache of compressed
+text files, and only the remaining patents are scraped, after which
+their text is written to the cache for next time.
+
+(C) 2014 Erin Burnside
+'''
+
+
+import gzip
+import os
+
+import patent_scraper
+
+
+# Default directory of the compressed text files, one per patent.
+CACHE_DIR = 'text_cache'
+
+
+def cache_path (pat_num, cache_dir=CACHE_DIR):
+    '''
+    INPUT: INT pat_num, optional STRING cache_dir
+    OUTPUT: STRING path
+
+    Returns the path of the cache file of pat_num.
+    '''
+    return os.path.join(cache_dir, str(pat_num) + '.txt.gz')
+
+
+def read_cached (pat_num, cache_dir=CACHE_DIR):
+    '''
+    INPUT: INT pat_num, optional STRING cache_dir
+    OUTPUT: STRING text
+
+    Returns the cached text of pat_num, or None if it is not cached.
+    '''
+    path = cache_path(pat_num, cache_dir)
+    if not os.path.exists(path):
+        return None
+
+    f = gzip.open(path, 'rb')
+    text = f.read().decode('utf-8')
+    f.close()
+    return text
+
+
+def write_cached (pat_num, text, cache_dir=CACHE_DIR):
+    '''
+    INPUT: INT pat_num, STRING text, optional STRING cache_dir
+    OUTPUT: NONE
+
+    Compresses text into the cache file of pat_num, writing to a
+    temporary file first so that readers never see a partial file.
+    '''
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+
+    path = cache_path(pat_num, cache_dir)
+    f = gzip.open(path + '.tmp', 'wb')
+    f.write(text)
+    f.close()
+    os.rename(path + '.tmp', path)
+
+
+def grab_table_text (pat_nums, text_table, cur):
+    '''
+    INPUT: LIST OF INTS pat_nums, STRING text_table, PSYCOPG2 CURSOR cur
+    OUTPUT: DICT OF INT -> STRING texts
+
+    Fetches the text of those of pat_nums that are in text_table, all in
+    one query.
+    '''
+    texts = {}
+    if pat_nums:
+        query = 'SELECT * FROM ' + text_table + ' WHERE pat_num IN %s;'
+        cur.execute(query, [tuple(pat_nums)])
+        for line in cur.fetchall():
+            texts[line[1]] = line[3] + ' ' + line[4] + ' ' + line[5]
+    return texts
+
+
+def resolve_text (pat_nums, text_table, cur, cache_dir=CACHE_DIR):
+    '''
+    INPUT: LIST OF INTS pat_nums, STRING text_table, PSYCOPG2 CURSOR cur,
+        optional STRING cache_dir
+    OUTPUT: DICT OF INT -> STRING texts
+
+    Returns the text of every patent in pat_nums, looking in text_table
+    first, then in the cache, and scraping the rest in a single call to
+    patent_scraper.scrape_patents. Scraped text is written back to the
+    cache only: text_table is the training corpus of naive_bayes, and
+    adding to it would change what the models are fitted on.
+    '''
+    texts = grab_table_text(pat_nums, text_table, cur)
+
+    missing = []
+    for pat_num in pat_nums:
+        if pat_num in texts:
+            continue
+        text = read_cached(pat_num, cache_dir)
+        if text is None:
+            missing.append(pat_num)
+        else:
+            texts[pat_num] = text
+
+    if missing:
+        t, i, r, abstr, cl, descr = patent_scraper.scrape_patents(missing)
+        for (ii, pat_num) in enumerate(missing):
+            texts[pat_num] = ' '.join([abstr[ii], cl[ii], descr[ii]])
+            write_cached(pat_num, texts[pat_num], cache_dir)
+
+    return texts